@@ -0,0 +1,131 @@
+"""
+Benchmark for swattools.merge on synthetic hrus rasters.
+
+Run from the app directory:
+    python -m benchmarks.merge_benchmark
+    python -m benchmarks.merge_benchmark --sizes 1000 5000 10000 --verify-up-to 1000
+"""
+import argparse
+import time
+
+from scipy import ndimage
+import numpy as np
+
+from swatluu import swattools
+
+
+NODATA = -2147483647
+
+
+def create_synthetic_hrus(size, hru_size=25, dominant_ratio=0.6, seed=0):
+    """
+    Creates a square hrus raster made of blocky hru patches with a
+    circular watershed boundary (cells outside of it are nodata).
+
+    Parameters
+    ----------
+    size: int
+        Number of rows and columns in the raster
+    hru_size: int
+        Approximate width (in cells) of each hru patch
+    dominant_ratio: float
+        Fraction of the hru ids that will be treated as dominant
+    seed: int
+        Seed for the random number generator
+
+    Returns
+    -------
+    hrus, dominant_hrus: tuple of arrays
+        Synthetic hrus raster and the array of dominant hru ids
+    """
+    rng = np.random.RandomState(seed)
+
+    # coarse grid of hru ids upsampled into patches
+    blocks = -(-size // hru_size)
+    hru_count = max(blocks * blocks // 4, 2)
+    coarse = rng.randint(1, hru_count + 1, size=(blocks, blocks))
+    hrus = np.repeat(np.repeat(coarse, hru_size, axis=0), hru_size, axis=1)
+    hrus = np.ascontiguousarray(hrus[:size, :size], dtype=np.int32)
+
+    # circular watershed, everything outside of it is nodata
+    rows, cols = np.ogrid[:size, :size]
+    center = (size - 1) / 2.0
+    outside = (rows - center) ** 2 + (cols - center) ** 2 > (size / 2.0) ** 2
+    hrus[outside] = NODATA
+
+    hru_ids = np.arange(1, hru_count + 1)
+    dominant_hrus = np.sort(rng.choice(
+        hru_ids, size=int(len(hru_ids) * dominant_ratio), replace=False))
+
+    return hrus, dominant_hrus
+
+
+def legacy_merge(hrus, dominant_hrus, nodata_value):
+    """
+    Per-pixel implementation of the Euclidean allocation merge that
+    swattools.merge replaced. Kept here to verify the vectorized
+    output and to time the speed up.
+    """
+    inside_watershed_indexes = np.nonzero(hrus != nodata_value)
+    outside_watershed_indexes = np.nonzero(hrus == nodata_value)
+
+    hrus_test = hrus.copy()
+    hrus_test[outside_watershed_indexes] = 1
+    dominant_hrus_set = set(dominant_hrus)
+
+    for i in range(0, len(inside_watershed_indexes[0])):
+        if hrus_test[inside_watershed_indexes[0][i]][
+                inside_watershed_indexes[1][i]] in dominant_hrus_set:
+            hrus_test[inside_watershed_indexes[0][i]][
+                inside_watershed_indexes[1][i]] = 0
+        else:
+            hrus_test[inside_watershed_indexes[0][i]][
+                inside_watershed_indexes[1][i]] = 1
+
+    indexes = ndimage.distance_transform_edt(hrus_test, return_indices=True)[1]
+    rows = indexes[0]
+    cols = indexes[1]
+
+    for i in range(0, len(rows)):
+        for j in range(0, len(rows[0])):
+            hrus[i][j] = hrus[rows[i][j]][cols[i][j]]
+
+    hrus[outside_watershed_indexes] = nodata_value
+
+    return hrus
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', nargs='+', type=int,
+                        default=[1000, 5000, 10000],
+                        help='raster widths (cells) to benchmark')
+    parser.add_argument('--verify-up-to', type=int, default=1000,
+                        help='compare against (and time) the legacy per-pixel '
+                             'merge for sizes up to this width')
+    args = parser.parse_args()
+
+    print('{0:>8} {1:>14} {2:>12} {3:>12} {4:>9}'.format(
+        'size', 'cells', 'merge (s)', 'legacy (s)', 'identical'))
+
+    for size in args.sizes:
+        hrus, dominant_hrus = create_synthetic_hrus(size)
+
+        start = time.perf_counter()
+        merged = swattools.merge(hrus, dominant_hrus, NODATA, in_place=False)
+        merge_time = time.perf_counter() - start
+
+        legacy_time = '-'
+        identical = '-'
+        if size <= args.verify_up_to:
+            start = time.perf_counter()
+            expected = legacy_merge(hrus.copy(), dominant_hrus, NODATA)
+            legacy_time = '{0:.2f}'.format(time.perf_counter() - start)
+            identical = str(np.array_equal(merged, expected))
+
+        print('{0:>8} {1:>14} {2:>12.2f} {3:>12} {4:>9}'.format(
+            size, size * size, merge_time, legacy_time, identical))
+
+
+if __name__ == '__main__':
+    main()
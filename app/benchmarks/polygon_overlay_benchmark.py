@@ -0,0 +1,125 @@
+"""
+Benchmark for geotools.label_polygon_cells on synthetic field polygons.
+
+Run from the app directory:
+    python -m benchmarks.polygon_overlay_benchmark
+    python -m benchmarks.polygon_overlay_benchmark --sizes 1000 5000 --fields 500 5000
+"""
+import argparse
+import time
+
+from matplotlib.path import Path
+import numpy as np
+
+from swatluu import geotools
+
+
+def create_synthetic_fields(size, field_count, seed=0):
+    """
+    Creates field polygons (irregular convex-ish heptagons) scattered
+    over a square raster with 1 unit cells and the upper left corner at
+    (0, size).
+
+    Parameters
+    ----------
+    size: int
+        Number of rows and columns in the raster
+    field_count: int
+        Number of field polygons
+    seed: int
+        Seed for the random number generator
+
+    Returns
+    -------
+    polygons, x_axis, y_axis: tuple
+        List of polygon point arrays and the cell centre coordinates
+        of the raster's columns and rows
+    """
+    rng = np.random.RandomState(seed)
+
+    # fields are roughly sized so they would cover the raster once
+    radius = size / np.sqrt(field_count) / 2.0
+    centres = rng.rand(field_count, 2) * size
+    angles = np.sort(rng.rand(field_count, 7), axis=1) * 2 * np.pi
+    radii = radius * (0.5 + rng.rand(field_count, 7))
+    points = np.stack((
+        centres[:, :1] + radii * np.cos(angles),
+        centres[:, 1:] + radii * np.sin(angles)), axis=2)
+    polygons = [np.vstack((field, field[:1])) for field in points]
+
+    x_axis = np.arange(size) + 0.5
+    y_axis = size - np.arange(size) - 0.5
+
+    return polygons, x_axis, y_axis
+
+
+def legacy_label_polygon_cells(polygons, x_axis, y_axis):
+    """
+    Full-grid implementation that tests every raster cell against every
+    polygon. Kept here to verify the windowed output and to time the
+    speed up.
+    """
+    grid_x, grid_y = np.meshgrid(x_axis, y_axis)
+    points = np.column_stack((grid_x.ravel(), grid_y.ravel()))
+
+    labels = np.zeros(grid_x.shape, dtype=int)
+    for i, polygon in enumerate(polygons):
+        in_poly = geotools.matplotlib_pip(points, Path(polygon))
+        labels[in_poly.reshape(grid_x.shape)] = i + 1
+
+    return labels
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', nargs='+', type=int,
+                        default=[1000, 5000],
+                        help='raster widths (cells) to benchmark')
+    parser.add_argument('--fields', nargs='+', type=int,
+                        default=[100, 1000],
+                        help='number of field polygons to benchmark')
+    parser.add_argument('--verify-up-to', type=int, default=1000,
+                        help='compare against (and time) the legacy full-grid '
+                             'scan for sizes up to this width')
+    args = parser.parse_args()
+
+    print('{0:>8} {1:>8} {2:>10} {3:>10} {4:>12} {5:>12} {6:>9}'.format(
+        'size', 'fields', 'index (s)', 'query (s)', 'window (s)',
+        'legacy (s)', 'identical'))
+
+    for size in args.sizes:
+        for field_count in args.fields:
+            polygons, x_axis, y_axis = create_synthetic_fields(
+                size, field_count)
+
+            start = time.perf_counter()
+            polygon_index = geotools.PolygonBoundsIndex(polygons)
+            index_time = time.perf_counter() - start
+
+            # look up the fields around each field's centre
+            start = time.perf_counter()
+            for bounds in polygon_index.bounds:
+                centre = (bounds[:2] + bounds[2:]) / 2.0
+                polygon_index.query(np.concatenate((centre, centre)))
+            query_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            labels = geotools.label_polygon_cells(
+                polygons, x_axis, y_axis, polygon_index)
+            window_time = time.perf_counter() - start
+
+            legacy_time = '-'
+            identical = '-'
+            if size <= args.verify_up_to:
+                start = time.perf_counter()
+                expected = legacy_label_polygon_cells(polygons, x_axis, y_axis)
+                legacy_time = '{0:.2f}'.format(time.perf_counter() - start)
+                identical = str(np.array_equal(labels, expected))
+
+            print('{0:>8} {1:>8} {2:>10.3f} {3:>10.3f} {4:>12.2f} {5:>12} '
+                  '{6:>9}'.format(size, field_count, index_time, query_time,
+                                  window_time, legacy_time, identical))
+
+
+if __name__ == '__main__':
+    main()
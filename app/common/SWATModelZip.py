@@ -9,6 +9,7 @@ import boto3
 import fiona
 
 from s3upload.models import S3Upload
+from .txtinout import TxtInOutIndex
 from .utils import create_working_directory, fix_file_permissions
 
 UPLOAD_KEYS = ["workspace", "local", "aws"]
@@ -494,16 +495,13 @@ def check_for_matching_number_of_hrus_in_hru1_and_txtinout(model_directory: str)
     hru1_shp = os.path.join(model_directory, "Watershed", "Shapes", "hru1.shp")
     hru_dir = os.path.join(model_directory, "Scenarios", "Default", "TxtInOut")
 
-    hru_files = glob.glob(os.path.join(hru_dir, "*.hru"))
-
-    # Only count hru files that have integers as filenames
-    number_of_hru_files = 0
-    for hru in hru_files:
-        try:
-            int(os.path.splitext(os.path.basename(hru))[0])
-            number_of_hru_files += 1
-        except ValueError:
-            pass
+    # Only count hru files that have integers as filenames - the index of
+    # their headers is saved for the tools processing the model
+    try:
+        number_of_hru_files = len(TxtInOutIndex.load(hru_dir))
+    except ValueError:
+        # a header could not be read, the tools will report it
+        number_of_hru_files = len(TxtInOutIndex.list_hru_files(hru_dir))
 
     sf = fiona.open(hru1_shp, "r")
     number_of_hrus_in_hru1 = len(sf)
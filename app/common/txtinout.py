@@ -0,0 +1,185 @@
+"""
+Reads the headers of the .hru files in a SWAT model's TxtInOut
+directory and keeps them in an index saved next to the directory, so
+the upload validation and the tools share a single read of the files.
+"""
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+# header (first line) of a TxtInOut .hru file, e.g. " .hru file Watershed
+# HRU:1 Subbasin:1 HRU:1 Luse:URLD Soil: CALHOUN Slope 0-9999 10/31/2009"
+HRU_HEADER_PATTERN = re.compile(
+    r'HRU:\s*(?P<hru_id>[-+.\d]+)\s+Subbasin:\s*(?P<subbasin_id>[-+.\d]+)'
+    r'\s+HRU:.*?Luse:\s*(?P<landuse_abbrev>\S*)\s+Soil:\s*(?P<soil_code>.*?)'
+    r'\s+Slope\s+(?P<slope_range>\S+)')
+
+# bytes read from the start of each .hru file (holds the header)
+HRU_HEADER_BYTES = 1024
+
+# threads reading .hru headers at the same time (the reads are mostly
+# waiting on the file system, e.g. NFS)
+HRU_HEADER_READ_WORKERS = 16
+
+
+def read_hru_header(hru_filepath):
+    """
+    Reads the header of a .hru file and returns its hru id, subbasin
+    id, landuse abbreviation, soil code and slope range.
+    """
+    with open(hru_filepath, 'rb', buffering=0) as hru_file:
+        header = hru_file.read(HRU_HEADER_BYTES)
+    header = header.split(b'\n', 1)[0].decode(errors='surrogateescape')
+
+    match = HRU_HEADER_PATTERN.search(header)
+    if not match:
+        raise ValueError('Unable to read the header of ' + hru_filepath)
+
+    return (int(float(match.group('hru_id'))),
+            int(float(match.group('subbasin_id'))),
+            match.group('landuse_abbrev'),
+            match.group('soil_code'),
+            match.group('slope_range'))
+
+
+class TxtInOutIndex(object):
+    """
+    Attributes of every hru file (named with the hru's number, e.g.
+    000010001.hru) in a TxtInOut directory, read from the file headers
+    and stored as one array per attribute in file name order.
+
+    Use TxtInOutIndex.load to share an index: it is saved next to the
+    TxtInOut directory and reused until the directory's modification
+    time changes (i.e. files are added, removed or renamed).
+
+    Attributes
+    ----------
+    txt_in_out_dir: string
+        Location of the TxtInOut directory
+    directory_mtime: int
+        Modification time (ns) of the directory when it was indexed
+    filenames: array
+        Name of each hru file
+    hru_ids, subbasin_ids: array
+        Hru and subbasin id of each hru file
+    landuse_abbrevs, soil_codes, slope_ranges: array
+        Landuse abbreviation, soil code and slope range of each hru file
+    """
+
+    COLUMNS = ('filenames', 'hru_ids', 'subbasin_ids', 'landuse_abbrevs',
+               'soil_codes', 'slope_ranges')
+
+    def __init__(self, txt_in_out_dir, directory_mtime, columns):
+        self.txt_in_out_dir = txt_in_out_dir
+        self.directory_mtime = directory_mtime
+        for name in self.COLUMNS:
+            setattr(self, name, columns[name])
+
+    def __len__(self):
+        return len(self.filenames)
+
+    @staticmethod
+    def get_cache_filepath(txt_in_out_dir):
+        """
+        Filepath of the saved index (beside TxtInOut, so saving it does
+        not change the directory's modification time).
+        """
+        return os.path.normpath(txt_in_out_dir) + '_hru_index.npz'
+
+    @staticmethod
+    def list_hru_files(txt_in_out_dir):
+        """
+        Sorted names of the .hru files named with an integer (leaves out
+        output.hru, outputb.hru, etc.).
+        """
+        filenames = []
+        for entry in os.scandir(txt_in_out_dir):
+            name, extension = os.path.splitext(entry.name)
+            if extension == '.hru' and name.isdigit():
+                filenames.append(entry.name)
+
+        return sorted(filenames)
+
+    @classmethod
+    def build(cls, txt_in_out_dir, workers=HRU_HEADER_READ_WORKERS):
+        """
+        Indexes a TxtInOut directory, reading the hru file headers with
+        a pool of threads.
+
+        Parameters
+        ----------
+        txt_in_out_dir: string
+            Location of the TxtInOut directory
+        workers: int
+            Number of headers read at the same time
+
+        Returns
+        -------
+        txt_in_out_index: TxtInOutIndex
+            The index of the directory
+        """
+        directory_mtime = os.stat(txt_in_out_dir).st_mtime_ns
+        filenames = cls.list_hru_files(txt_in_out_dir)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            headers = list(pool.map(
+                read_hru_header,
+                [os.path.join(txt_in_out_dir, filename)
+                 for filename in filenames]))
+
+        columns = list(zip(*headers)) or [[]] * 5
+        return cls(txt_in_out_dir, directory_mtime, {
+            'filenames': np.array(filenames, dtype=str),
+            'hru_ids': np.array(columns[0], dtype=np.int64),
+            'subbasin_ids': np.array(columns[1], dtype=np.int64),
+            'landuse_abbrevs': np.array(columns[2], dtype=str),
+            'soil_codes': np.array(columns[3], dtype=str),
+            'slope_ranges': np.array(columns[4], dtype=str),
+        })
+
+    def save(self):
+        """ Saves the index beside the TxtInOut directory. """
+        cache_filepath = self.get_cache_filepath(self.txt_in_out_dir)
+        with open(cache_filepath + '.tmp', 'wb') as cache_file:
+            np.savez(
+                cache_file, directory_mtime=np.int64(self.directory_mtime),
+                **{name: getattr(self, name) for name in self.COLUMNS})
+        os.replace(cache_filepath + '.tmp', cache_filepath)
+
+    @classmethod
+    def load(cls, txt_in_out_dir, workers=HRU_HEADER_READ_WORKERS):
+        """
+        Loads the saved index of a TxtInOut directory, indexing (and
+        saving) it again when there is none or the directory changed.
+
+        Parameters
+        ----------
+        txt_in_out_dir: string
+            Location of the TxtInOut directory
+        workers: int
+            Number of headers read at the same time when indexing
+
+        Returns
+        -------
+        txt_in_out_index: TxtInOutIndex
+            The index of the directory
+        """
+        directory_mtime = os.stat(txt_in_out_dir).st_mtime_ns
+        try:
+            with np.load(cls.get_cache_filepath(txt_in_out_dir)) as cache:
+                if int(cache['directory_mtime']) == directory_mtime:
+                    return cls(txt_in_out_dir, directory_mtime, {
+                        name: cache[name] for name in cls.COLUMNS})
+        except (IOError, KeyError, ValueError):
+            pass
+
+        txt_in_out_index = cls.build(txt_in_out_dir, workers)
+        try:
+            txt_in_out_index.save()
+        except OSError:
+            # the index is still used when it cannot be saved
+            pass
+
+        return txt_in_out_index
@@ -2,12 +2,12 @@ import glob
 import os
 import shutil
 
+from django.conf import settings
 from django.core.mail import send_mail
 from django.utils import timezone
-from matplotlib.path import Path
-from osgeo import gdal, ogr
-from scipy import stats
+from osgeo import gdal
 import numpy as np
+import pandas as pd
 import shapefile
 import xlsxwriter
 
@@ -15,6 +15,32 @@ from common.utils import find_objectid_and_hru_id_indexes
 from swatluu import geotools
 from swatluu import swattools
 from swatusers.models import UserTask
+from . import swatoutput
+
+
+# abbreviations used in the Field_Response.shp attribute names when
+# several aggregation methods are selected
+AGGREGATION_METHOD_ABBREVIATIONS = {
+    'mean': 'mean',
+    'mode': 'mode',
+    'geomean': 'gmean',
+    'area_weighted_mean': 'awmean',
+}
+
+# codes used in the attribute names of a batch (several years or output
+# types), e.g. R2001GMEAN for the geomean of the 2001 runoff
+BATCH_AGGREGATION_METHOD_CODES = {
+    'mean': 'MEAN',
+    'mode': 'MODE',
+    'geomean': 'GMEAN',
+    'area_weighted_mean': 'AWMN',
+}
+
+# formats of the field to hru mapping, see create_hru_field_workbook
+HRU_FIELD_FORMATS = ('xlsx', 'csv', 'parquet')
+
+# ways of assigning hrus1 cells to fields, see label_fields
+FIELD_LABELLING_METHODS = ('cell_centre', 'all_touched', 'point_in_polygon')
 
 
 class FieldSWATProcess(object):
@@ -36,9 +62,6 @@ class FieldSWATProcess(object):
             self.fieldswat_fields_shapefile_filepath = ''
             self.fieldswat_output_type = ''
             self.fieldswat_aggregation_method = ''
-            self.swatoutput_years = ''
-            self.swatoutput_runoff = ''
-            self.swatoutput_sediment = ''
             self.fieldswat_selected_year = ''
         else:
             self.user_id = data['user_id']
@@ -57,17 +80,62 @@ class FieldSWATProcess(object):
             self.fieldswat_output_type = data['fieldswat_output_type']
             self.fieldswat_aggregation_method = data[
                 'fieldswat_aggregation_method']
-            self.swatoutput_years = data['swatoutput_years']
-            self.swatoutput_runoff = data['swatoutput_runoff']
-            self.swatoutput_sediment = data['swatoutput_sediment']
             self.fieldswat_selected_year = data['fieldswat_selected_year']
 
+        # how hrus1 cells are assigned to fields: 'cell_centre' and
+        # 'all_touched' rasterize the fields, 'point_in_polygon' tests
+        # the cell centroids against each field
+        if data == '':
+            self.fieldswat_field_labelling = 'cell_centre'
+        else:
+            self.fieldswat_field_labelling = data.get(
+                'fieldswat_field_labelling', 'cell_centre')
+
+        # several aggregation methods can be calculated in one run
+        if isinstance(self.fieldswat_aggregation_method, str):
+            self.fieldswat_aggregation_methods = [
+                self.fieldswat_aggregation_method]
+        else:
+            self.fieldswat_aggregation_methods = list(
+                self.fieldswat_aggregation_method)
+
+        # format of the field to hru mapping: 'xlsx' writes HRU_FIELD.xlsx
+        # with one row per field, 'csv' and 'parquet' write one
+        # (field, hru) pair per row
+        if data == '':
+            self.fieldswat_hru_field_format = 'xlsx'
+        else:
+            self.fieldswat_hru_field_format = data.get(
+                'fieldswat_hru_field_format', 'xlsx')
+
+        # batch mode aggregates every selected (year, output type) pair in
+        # one task, the fields are labelled and the hrus merged only once
+        if data == '':
+            self.fieldswat_selected_years = []
+            self.fieldswat_output_types = []
+        else:
+            self.fieldswat_selected_years = data.get(
+                'fieldswat_selected_years', [self.fieldswat_selected_year])
+            self.fieldswat_output_types = data.get(
+                'fieldswat_output_types', [self.fieldswat_output_type])
+        self.fieldswat_batch_mode = len(self.fieldswat_selected_years) > 1 \
+            or len(self.fieldswat_output_types) > 1
+
+        # SWATOutput.mdb hru table, loaded from its cache on first use
+        self.swatoutput_data = None
+
         self.hrus = ''
         self.dominant_hrus = ''
+        self.dominant_hru_ids = ''
         self.hrus_info = ''
         self.tool_name = 'Field SWAT'
         self.logger = logger
 
+        # intermediate rasters (converted hrus1)
+        self.raster_workspace = geotools.RasterWorkspace(
+            os.path.join(self.process_root_dir, 'RasterWorkspace'))
+        self.hrus1_tif_filepath = ''
+
     def setup_logger(self):
         self.logger.info('Task ID: ' + self.task_id)
         self.logger.info('User: ' + self.user_email)
@@ -97,9 +165,11 @@ class FieldSWATProcess(object):
 
         # convert hrus1 grid to tif
         try:
+            self.hrus1_tif_filepath = \
+                self.raster_workspace.create_filepath_like(
+                    'hrus1.tif', self.output_dir + '/Raster/hrus1')
             geotools.convert_adf_to_tif(
-                self.output_dir + '/Raster/hrus1',
-                self.output_dir + '/Raster/hrus1/hrus1.tif')
+                self.output_dir + '/Raster/hrus1', self.hrus1_tif_filepath)
         except Exception as e:
             self.logger.error(str(e))
             self.logger.error('Unable to convert raster from .adf to .tif.')
@@ -143,8 +213,7 @@ class FieldSWATProcess(object):
                 'An error occurred while fetching the hrus1 raster details.')
 
         try:
-            grid_x_reshape, grid_y_reshape = self.set_gridx_and_gridy_matrices(
-                hrus1_info)
+            grid_x, grid_y = self.set_gridx_and_gridy_matrices(hrus1_info)
         except Exception as e:
             self.logger.error(str(e))
             self.logger.error(
@@ -156,7 +225,7 @@ class FieldSWATProcess(object):
 
         try:
             clu = self.create_hru_field_workbook(
-                grid_x_reshape, grid_y_reshape, hrus1_info['nodata'])
+                self.label_fields(grid_x, grid_y), hrus1_info['nodata'])
         except Exception as e:
             self.logger.error(str(e))
             self.logger.error(
@@ -167,8 +236,12 @@ class FieldSWATProcess(object):
                 'An error occurred while creating the hru field workbook.')
 
         try:
-            field_shapefile, output_data, hru_output_data = self.update_field_info(
-                hrus1_info['nodata'], clu)
+            if self.fieldswat_batch_mode:
+                field_shapefile, field_columns, hru_ids, hru_columns = \
+                    self.update_field_series(hrus1_info['nodata'], clu)
+            else:
+                field_shapefile, field_columns, hru_ids, hru_columns = \
+                    self.update_field_info(hrus1_info['nodata'], clu)
         except Exception as e:
             self.logger.error(str(e))
             self.logger.error(
@@ -178,7 +251,7 @@ class FieldSWATProcess(object):
             raise Exception('An error occurred while updating field info.')
 
         try:
-            self.create_new_field_shapefile(field_shapefile, output_data)
+            self.create_new_field_shapefile(field_shapefile, field_columns)
         except Exception as e:
             self.logger.error(str(e))
             self.logger.error(
@@ -191,7 +264,7 @@ class FieldSWATProcess(object):
         hru_shapefile = self.output_dir + '/Output/HRU_Response.shp'
 
         try:
-            self.update_hru_shapefile(hru_shapefile, hru_output_data)
+            self.update_hru_shapefile(hru_shapefile, hru_ids, hru_columns)
         except Exception as e:
             self.logger.error(str(e))
             self.logger.error(
@@ -265,8 +338,7 @@ class FieldSWATProcess(object):
         """
         self.logger.info('Reading hrus1.tif into numpy array.')
 
-        hrus, hrus_info = geotools.read_raster(
-            os.path.join(self.output_dir, 'Raster', 'hrus1', 'hrus1.tif'))
+        hrus, hrus_info = geotools.read_raster(self.hrus1_tif_filepath)
 
         self.logger.info('Reading hru1.shp into numpy array.')
 
@@ -294,11 +366,21 @@ class FieldSWATProcess(object):
         # after the threshold was applied (OBJECTID in hru1.shp)
         dominant_hrus = sorted_hru[:, 0]
 
-        # merge non-dominant hrus into nearby dominant hrus
-        hrus = swattools.merge(hrus, dominant_hrus, hrus_info[1])
+        dominant_hru_ids = sorted_hru[:, hru1_field_positions['hru_id']]
+
+        # merge non-dominant hrus into nearby dominant hrus, reusing the
+        # merge cached by an earlier task on the same model
+        hrus, _ = swattools.merge_with_cache(
+            swattools.MergeCache(
+                settings.MERGE_CACHE_DIR, settings.MERGE_CACHE_MAX_BYTES),
+            hrus, dominant_hrus, dominant_hru_ids, hrus_info[1],
+            os.path.join(self.fieldswat_swat_model_dir, 'Watershed',
+                         'Shapes', 'hru1.dbf'),
+            self.logger)
 
         self.hrus = hrus
         self.dominant_hrus = dominant_hrus
+        self.dominant_hru_ids = dominant_hru_ids
         self.hrus_info = hrus_info
 
     def copy_shapefile_to_output_directory(self):
@@ -333,7 +415,7 @@ class FieldSWATProcess(object):
         for the hru1 raster.
         """
         # open the tif raster with gdal
-        hru1_file = gdal.Open(self.output_dir + '/Raster/hrus1/hrus1.tif')
+        hru1_file = gdal.Open(self.hrus1_tif_filepath)
 
         # get number of columns and rows for the raster
         cols = hru1_file.RasterXSize
@@ -358,100 +440,150 @@ class FieldSWATProcess(object):
         return hrus1_info
 
     def set_gridx_and_gridy_matrices(self, hrus1_info):
+        """
+        Sets up the x coordinate of each hrus1 column and the y coordinate
+        of each hrus1 row (located at the cell centroids). Per cell
+        coordinates are never built, the axes are broadcast against
+        each other when needed.
+
+        Parameters
+        ----------
+        hrus1_info: dictionary
+            Contains the rows, cols, pixel resolution, origin and nodata
+            value for the hrus1 raster
+
+        Returns
+        -------
+        grid_x, grid_y: tuple of arrays
+            x coordinate for each column and y coordinate for each row
+        """
         self.logger.info('Setting up grid matrices.')
         # set delta x and y to the pixel resolution
-        delta_x = int(hrus1_info['pixel_resolution'])
-        delta_y = int(hrus1_info['pixel_resolution'])
+        delta = int(hrus1_info['pixel_resolution'])
 
         # get origin for hrus1 raster file
-        x_origin = float(hrus1_info['origin'][0])
-        y_origin = float(hrus1_info['origin'][1])
-
-        self.logger.info('Building grid_x.')
-        # build x grid
-        grid_x = np.zeros(
-            (hrus1_info['rows'], hrus1_info['cols']), dtype=float)
-        grid_x[0:hrus1_info['rows'], 0] = x_origin + (delta_x / 2)
-        for i in range(1, hrus1_info['cols']):
-            grid_x[0:hrus1_info['rows'], i] = grid_x[0:hrus1_info['rows'],
-                                                     i - 1] + delta_x
-
-        self.logger.info('Building grid_y.')
-        # build y grid
-        grid_y = np.zeros(
-            (hrus1_info['rows'], hrus1_info['cols']), dtype=float)
-        grid_y[0, 0:hrus1_info['cols']] = y_origin - (delta_y / 2)
-        for i in range(1, hrus1_info['rows']):
-            grid_y[i, 0:hrus1_info['cols']] = grid_y[i - 1,
-                                                     :hrus1_info['cols']] - delta_y
-
-        self.logger.info('Reshaping grid_x and grid_y.')
-        # reshape the coordinates grid_x and grid_y to temporary column matrix
-        grid_x_reshape = np.reshape(np.transpose(grid_x),
-                                    hrus1_info['rows'] * hrus1_info['cols'])
-        grid_y_reshape = np.reshape(np.transpose(grid_y),
-                                    hrus1_info['rows'] * hrus1_info['cols'])
-
-        return grid_x_reshape, grid_y_reshape
-
-    def create_hru_field_workbook(self, grid_x_reshape, grid_y_reshape, nodata):
-        self.logger.info('Creating HRU_FIELD.xlsx workbook.')
+        origin = [float(hrus1_info['origin'][0]),
+                  float(hrus1_info['origin'][1])]
 
-        # initialize a layer to store field ids in the next for loop
-        clu = np.zeros(len(grid_x_reshape), dtype=int)
+        self.logger.info('Building grid_x and grid_y.')
+        grid_x, grid_y = geotools.get_raster_axes(
+            origin, delta, hrus1_info['rows'], hrus1_info['cols'],
+            centroid=True)
 
-        # export HRU identified under each CLU in a separate excel file
-        hru_id = np.reshape(np.transpose(self.hrus),
-                            len(self.hrus) * len(self.hrus[0]))
+        return grid_x, grid_y
 
-        # open excel workbook and add new sheet titled HRU_Field
-        workbook = xlsxwriter.Workbook(
-            self.output_dir + '/Output/HRU_FIELD.xlsx')
-        sheet = workbook.add_worksheet('HRU_Field')
+    def label_fields(self, grid_x, grid_y):
+        """
+        Finds the field each hrus1 cell is located in. By default the
+        fields are burnt into a raster aligned to hrus1 in one pass,
+        labelling the cells whose centre is inside a field (or every
+        cell touched by a field with 'all_touched'). The
+        'point_in_polygon' labelling tests the cell centroids inside each
+        field's bounding box against the field instead (see
+        geotools.label_polygon_cells).
+
+        Parameters
+        ----------
+        grid_x: array
+            x coordinate for each hrus1 column
+        grid_y: array
+            y coordinate for each hrus1 row
 
+        Returns
+        -------
+        clu: array
+            Field id (shape index + 1) for each hrus1 cell, 0 when the
+            cell is not located in a field
+        """
         self.logger.info(
-            'Adding field shapefile data to the HRU_FIELD.xlsx workbook.')
+            'Labelling hrus1 cells by field (' +
+            self.fieldswat_field_labelling + ').')
+
+        if self.fieldswat_field_labelling != 'point_in_polygon':
+            return geotools.rasterize_polygon_labels(
+                self.fieldswat_fields_shapefile_filename,
+                self.hrus1_tif_filepath,
+                all_touched=self.fieldswat_field_labelling == 'all_touched')
 
         # open field shapefile
         field_shapefile = shapefile.Reader(
             self.fieldswat_fields_shapefile_filename)
 
-        # merge grid_x_reshape and grid_y_reshape into single list of tuples
-        grid_xy_reshape = []
-        for i in range(0, len(grid_x_reshape)):
-            grid_xy_reshape.append((grid_x_reshape[i], grid_y_reshape[i]))
+        # each field is only tested against the cells in its bounding box
+        return geotools.label_polygon_cells(
+            [field_shape.points
+             for field_shape in field_shapefile.iterShapes()],
+            grid_x, grid_y)
 
-        # iterate through the field shapefile records (i.e. fields)
-        sheet.write(0, 0, 'Field')
-        sheet.write(0, 1, 'HRUs')
-        for i in range(0, len(field_shapefile.shapes())):
-            # ultimately collect hru ids that are in the current field poly
-            in_list = np.zeros(len(grid_x_reshape), dtype=int)
+    def create_hru_field_workbook(self, clu, nodata):
+        """
+        Writes the hrus found in each field to HRU_FIELD.xlsx (or to
+        HRU_FIELD.csv/HRU_FIELD.parquet, see write_hru_field_table). The
+        hrus for every field are found at once with a grouped unique over
+        the (field, hru) pairs of the labelled cells.
+
+        Parameters
+        ----------
+        clu: array
+            Field id for each hrus1 cell (0 when the cell is not located
+            in a field), see label_fields
+        nodata: float
+            nodata value for the hrus1 raster
+
+        Returns
+        -------
+        clu: array
+            Field id for each hrus1 cell, flattened in column order
+        """
+        # unique (field, hru) pairs for the cells inside fields and the
+        # watershed, sorted by field and then hru
+        in_field = (clu > 0) & (self.hrus != nodata)
+        field_hrus = np.unique(
+            np.column_stack((clu[in_field], self.hrus[in_field])), axis=0)
+
+        if self.fieldswat_hru_field_format == 'xlsx':
+            self.write_hru_field_workbook(field_hrus)
+        else:
+            self.write_hru_field_table(field_hrus)
 
-            # construct polygon for current record
-            mpoly = Path(field_shapefile.shapes()[i].points)
+        # flatten in column order to match the other hrus1 based arrays
+        return np.reshape(np.transpose(clu), clu.size)
 
-            # matplotlib_pip returns a boolean list - True means in the poly
-            mpoly_results = geotools.matplotlib_pip(grid_xy_reshape, mpoly)
+    def write_hru_field_workbook(self, field_hrus):
+        """
+        Writes one row per field with the field id followed by its hrus
+        to HRU_FIELD.xlsx. The workbook is written in constant memory
+        mode, each row is flushed to disk as soon as the next one starts.
 
-            # find index position for coordinates identified as being in the poly
-            hrus_in_poly = np.where(np.array(mpoly_results) == True)
+        Parameters
+        ----------
+        field_hrus: array
+            Unique (field, hru) pairs sorted by field and then hru
+        """
+        self.logger.info('Creating HRU_FIELD.xlsx workbook.')
 
-            # set any index for a coordinate found in the poly to 1
-            in_list[hrus_in_poly] = 1
+        # open excel workbook and add new sheet titled HRU_Field
+        workbook = xlsxwriter.Workbook(
+            self.output_dir + '/Output/HRU_FIELD.xlsx',
+            {'constant_memory': True})
+        sheet = workbook.add_worksheet('HRU_Field')
 
-            # update clu with field id
-            clu[np.nonzero(in_list == 1)] = i + 1
+        self.logger.info(
+            'Adding field shapefile data to the HRU_FIELD.xlsx workbook.')
 
-            # get unique, sorted list of hrus found in the field
-            unique_hrus = list(set(hru_id[np.nonzero(in_list == 1)]))
-            unique_hrus.sort()
+        field_count = len(shapefile.Reader(
+            self.fieldswat_fields_shapefile_filename))
+        field_starts = np.searchsorted(
+            field_hrus[:, 0], np.arange(1, field_count + 2))
 
-            # remove the nodata value from the list of hrus
-            try:
-                unique_hrus.remove(nodata)
-            except ValueError as e:
-                self.logger.warning(str(e))
+        # iterate through the field shapefile records (i.e. fields),
+        # rows have to be written in order in constant memory mode
+        sheet.write(0, 0, 'Field')
+        sheet.write(0, 1, 'HRUs')
+        for i in range(field_count):
+            # sorted list of hrus found in the field
+            unique_hrus = field_hrus[
+                field_starts[i]:field_starts[i + 1], 1].tolist()
 
             # write to the spreadsheet
             sheet.write(i + 1, 0, i + 1)
@@ -460,175 +592,310 @@ class FieldSWATProcess(object):
         workbook.close()
         self.logger.info('Closing HRU_FIELD.xlsx workbook.')
 
-        return clu
+    def write_hru_field_table(self, field_hrus):
+        """
+        Writes the field to hru mapping in long format (one Field, HRU
+        pair per row) to HRU_FIELD.csv or HRU_FIELD.parquet. Unlike the
+        workbook this is not limited by the number of rows or columns
+        in an Excel sheet.
 
-    def update_field_info(self, hrus1_nodata, clu):
-        field_shapefile = shapefile.Reader(
-            self.fieldswat_fields_shapefile_filename)
+        Parameters
+        ----------
+        field_hrus: array
+            Unique (field, hru) pairs sorted by field and then hru
+        """
+        hru_field_filepath = self.output_dir + '/Output/HRU_FIELD.' + \
+            self.fieldswat_hru_field_format
+        self.logger.info(
+            'Creating ' + os.path.basename(hru_field_filepath) + '.')
 
-        years = np.array(self.swatoutput_years)
-        runoff = np.array(self.swatoutput_runoff)
-        sediment = np.array(self.swatoutput_sediment)
+        field_hru_table = pd.DataFrame(
+            field_hrus.astype(np.int64), columns=['Field', 'HRU'])
 
-        # check which output type was selected by the user
-        if self.fieldswat_output_type == 'runoff':
-            data = runoff
+        if self.fieldswat_hru_field_format == 'csv':
+            field_hru_table.to_csv(hru_field_filepath, index=False)
+        elif self.fieldswat_hru_field_format == 'parquet':
+            field_hru_table.to_parquet(hru_field_filepath, index=False)
         else:
-            data = sediment
-
-        # take the first year
-        year = self.fieldswat_selected_year
-
-        # find index positions in years where the first year is located
-        year_index_position = np.nonzero(years == year)
-
-        # collect data for that year
-        data_for_year = data[year_index_position]
-
-        hru_id = np.reshape(np.transpose(self.hrus), self.hrus.size)
-
-        # Create dictionary lookup for data values {hru_id: data_value}
-        # Exclude last unique hru which is the nodata value
-        output_data = {}
-        for idx, hru_num in enumerate(np.unique(hru_id)):
-            if hru_num != hrus1_nodata:
-                output_data[hru_num] = data[idx]
-            else:
-                output_data[hru_num] = np.nan
-
-        # Create flat water array with appropriate runoff or sediment values
-        water = np.zeros(self.hrus.size, dtype=float)
-        for i in range(0, len(water)):
-            water[i] = output_data[hru_id[i]]
-
-        # Reshape grids to match hrus grid
-        hru_two = np.reshape(clu, self.hrus.shape)
-        hru_three = np.reshape(water, self.hrus.shape)
-
-        # Flatten reshaped grids
-        cl = np.reshape(np.transpose(hru_two), hru_two.size)
-        wt = np.reshape(np.transpose(hru_three), hru_three.size)
-
-        # Stores calculated field outputs
-        field_output = np.zeros(len(field_shapefile.shapes()), dtype=float)
-
-        if self.fieldswat_aggregation_method == 'mean':
-
-            for i in range(0, len(field_shapefile.shapes())):
-                field_output[i] = np.nanmean((wt[np.nonzero(cl == i + 1)]))
+            raise ValueError('Unrecognized field to hru mapping format: ' +
+                             str(self.fieldswat_hru_field_format))
 
-                if np.isnan(field_output[i]):
-                    field_output[i] = 0
-
-        elif self.fieldswat_aggregation_method == 'mode':
-
-            for i in range(0, len(field_shapefile.shapes())):
-
-                resp = wt[np.nonzero(cl == i + 1)]
-                resp[np.nonzero(resp == 0)] = np.NaN
-                temp = np.ma.masked_array(resp, np.isnan(resp))
-                try:
-                    field_output[i] = stats.mode(temp).mode[0]
-                except AttributeError:
-                    field_output[i] = np.nan
-
-                if np.isnan(field_output[i]):
-                    field_output[i] = 0
+    def get_swatoutput_data(self):
+        """
+        Years, hrus, runoff and sediment from the SWAT model's
+        SWATOutput.mdb hru table. The columns are memory-mapped from the
+        cache next to the model the first time they are needed (the
+        cache is made first if the upload did not finish making it).
 
-        elif self.fieldswat_aggregation_method == 'geomean':
+        Returns
+        -------
+        swatoutput_data: dict
+            Arrays of years, hrus, runoff and sediment
+        """
+        if self.swatoutput_data is None:
+            self.swatoutput_data = swatoutput.load_hru_table_cache(
+                self.fieldswat_swat_model_dir, mmap_mode='r')
+        if self.swatoutput_data is None:
+            self.swatoutput_data = swatoutput.extract_hru_table(
+                self.fieldswat_swat_model_dir, self.logger)
 
-            for i in range(0, len(field_shapefile.shapes())):
+        return self.swatoutput_data
 
-                index = np.nonzero(cl == i + 1)
-                resp = wt[index]
-                resp[np.nonzero(resp == 0)] = np.NaN
-                temp = np.ma.masked_array(resp, np.isnan(resp))
-                field_output[i] = stats.gmean(temp)
+    def get_field_hru_pairs(self, hrus1_nodata, clu):
+        """
+        Groups the labelled hrus1 cells into (field, hru) pairs. The hru
+        of each cell is found by its position in dominant_hrus (OBJECTID
+        in hru1.shp) and identified by its HRU_ID, nodata cells are kept
+        as hru id -1 (their output is nan).
 
-                if np.isnan(field_output[i]):
-                    field_output[i] = 0
+        Parameters
+        ----------
+        hrus1_nodata: float
+            nodata value for the hrus1 raster
+        clu: array
+            Field id for each hrus1 cell, flattened in column order
 
-        elif self.fieldswat_aggregation_method == 'area_weighted_mean':
+        Returns
+        -------
+        pair_fields, pair_hru_ids, pair_counts: tuple of arrays
+            Field id, HRU_ID and number of cells of each pair
+        """
+        # position of each cell's hru in dominant_hrus (-1 for nodata)
+        hru_id = np.reshape(np.transpose(self.hrus), self.hrus.size)
+        dominant_order = np.argsort(self.dominant_hrus)
+        sorted_dominant_hrus = self.dominant_hrus[dominant_order]
+        positions = np.minimum(
+            np.searchsorted(sorted_dominant_hrus, hru_id),
+            len(sorted_dominant_hrus) - 1)
+        found = (hru_id != hrus1_nodata) & \
+            (sorted_dominant_hrus[positions] == hru_id)
+        cell_hrus = np.where(found, dominant_order[positions], -1)
+
+        # unique (field, hru) pairs and the number of cells in each
+        in_field = clu > 0
+        field_hrus, pair_counts = np.unique(
+            np.column_stack((clu[in_field], cell_hrus[in_field])),
+            axis=0, return_counts=True)
+        pair_hru_ids = np.where(
+            field_hrus[:, 1] >= 0,
+            self.dominant_hru_ids[np.maximum(field_hrus[:, 1], 0)], -1)
+
+        return field_hrus[:, 0], pair_hru_ids, pair_counts
+
+    def get_hru_outputs(self, output_type, years):
+        """
+        Output (runoff or sediment) of every hru in the SWATOutput.mdb
+        hru table for each of the years, joined by (YEAR, HRU).
 
-            for i in range(0, len(field_shapefile.shapes())):
+        Parameters
+        ----------
+        output_type: string
+            'runoff' or 'sediment'
+        years: array
+            Sorted years
 
-                resp = wt[np.nonzero(cl == i + 1)]
-                field_output[i] = np.nanmean(resp)
+        Returns
+        -------
+        hru_ids, output: tuple of arrays
+            Sorted HRU ids of the hru table and the output for each year
+            (rows) and hru id (columns), nan when missing
+        """
+        swatoutput_data = self.get_swatoutput_data()
+        hru_ids = np.unique(swatoutput_data['hrus'])
 
-                if np.isnan(field_output[i]):
-                    field_output[i] = 0
+        # rows of the hru table for the years
+        year_positions = np.minimum(
+            np.searchsorted(years, swatoutput_data['years']), len(years) - 1)
+        selected = years[year_positions] == swatoutput_data['years']
 
-        return field_shapefile, field_output, data_for_year
+        output = np.full((len(years), len(hru_ids)), np.nan)
+        output[year_positions[selected], np.searchsorted(
+            hru_ids, swatoutput_data['hrus'][selected])] = \
+            swatoutput_data[output_type][selected]
 
-    def create_new_field_shapefile(self, field_shapefile, output_data):
+        return hru_ids, output
 
-        # set up the shapefile driver
-        driver = ogr.GetDriverByName('ESRI Shapefile')
+    @staticmethod
+    def get_pair_outputs(hru_ids, output, pair_hru_ids):
+        """
+        Output of each (field, hru) pair for each year, nan for hrus
+        that are not in the hru table (see get_hru_outputs).
+        """
+        positions = np.minimum(
+            np.searchsorted(hru_ids, pair_hru_ids), len(hru_ids) - 1)
+        pair_output = output[:, positions]
+        pair_output[:, hru_ids[positions] != pair_hru_ids] = np.nan
 
-        # create the data source
-        data_source = driver.CreateDataSource(self.output_dir + '/Output')
+        return pair_output
 
-        # create the layer
-        layer = data_source.CreateLayer('Field_Response', None, ogr.wkbPolygon)
+    def update_field_info(self, hrus1_nodata, clu):
+        """
+        Summarizes the selected output (runoff or sediment) for each
+        field with the selected aggregation methods. The value of each
+        hrus1 cell is the output of its hru (HRU_ID from hru1.shp) for
+        the selected year, the same join as update_field_series.
 
-        # add fields
-        layer.CreateField(ogr.FieldDefn('Shape_Area', ogr.OFTReal))
-        layer.CreateField(
-            ogr.FieldDefn(str(self.fieldswat_output_type), ogr.OFTReal))
+        Parameters
+        ----------
+        hrus1_nodata: float
+            nodata value for the hrus1 raster
+        clu: array
+            Field id for each hrus1 cell, flattened in column order
 
-        for i in range(0, len(field_shapefile.shapes())):
+        Returns
+        -------
+        field_shapefile, field_columns, hru_ids, hru_columns: tuple
+            Field shapefile reader, Field_Response.shp attributes (values
+            for every field by attribute name), HRU_ID for each hru value
+            and HRU_Response.shp attributes (values by attribute name)
+        """
+        field_shapefile = shapefile.Reader(
+            self.fieldswat_fields_shapefile_filename)
 
-            # get the field's shape (coordinates)
-            field_shape = field_shapefile.shapes()[i]
+        pair_fields, pair_hru_ids, pair_counts = self.get_field_hru_pairs(
+            hrus1_nodata, clu)
+        hru_ids, output = self.get_hru_outputs(
+            self.fieldswat_output_type,
+            np.array([self.fieldswat_selected_year], dtype=int))
+        pair_output = self.get_pair_outputs(hru_ids, output, pair_hru_ids)
 
-            # get the field's shape area (float)
-            field_record = field_shapefile.records()[i][0]
+        # calculated field outputs by aggregation method
+        field_output = swattools.LabelStatistics(
+            pair_fields, pair_output[0], len(field_shapefile),
+            counts=pair_counts).compute(self.fieldswat_aggregation_methods)
+        field_columns = {
+            self.get_field_output_name(aggregation_method):
+                field_output[aggregation_method]
+            for aggregation_method in self.fieldswat_aggregation_methods}
 
-            # create feature
-            feature = ogr.Feature(layer.GetLayerDefn())
+        hru_columns = {str(self.fieldswat_output_type).title(): output[0]}
 
-            # set the attributes
-            feature.SetField('Shape_Area', field_record)
-            feature.SetField(str(self.fieldswat_output_type), output_data[i])
+        return field_shapefile, field_columns, hru_ids, hru_columns
 
-            # create polygon ring
-            ring = ogr.Geometry(ogr.wkbLinearRing)
-            for point in field_shape.points:
-                ring.AddPoint(point[0], point[1])
+    def update_field_series(self, hrus1_nodata, clu):
+        """
+        Batch mode version of update_field_info. Summarizes every
+        selected (year, output type) pair for each field with every
+        selected aggregation method and writes them all to
+        Field_Response.csv (one row per field, year, output type and
+        aggregation method).
 
-            # create polygon
-            poly = ogr.Geometry(ogr.wkbPolygon)
-            poly.AddGeometry(ring)
+        The cells are grouped into (field, hru) pairs once (see
+        get_field_hru_pairs), so each series is summarized from the
+        pairs and their cell counts instead of from every cell.
 
-            # set the feature geometry using the wkbpolygon
-            feature.SetGeometry(poly)
+        Parameters
+        ----------
+        hrus1_nodata: float
+            nodata value for the hrus1 raster
+        clu: array
+            Field id for each hrus1 cell, flattened in column order
 
-            # create the feature in the layer
-            layer.CreateFeature(feature)
+        Returns
+        -------
+        field_shapefile, field_columns, hru_ids, hru_columns: tuple
+            Field shapefile reader, Field_Response.shp attributes (values
+            for every field by attribute name), HRU_ID for each hru value
+            and HRU_Response.shp attributes (values by attribute name)
+        """
+        field_shapefile = shapefile.Reader(
+            self.fieldswat_fields_shapefile_filename)
+        field_count = len(field_shapefile)
+
+        years = np.sort(np.array(self.fieldswat_selected_years, dtype=int))
+        pair_fields, pair_hru_ids, pair_counts = self.get_field_hru_pairs(
+            hrus1_nodata, clu)
+
+        field_columns = {}
+        hru_columns = {}
+        field_series = []
+        for output_type in self.fieldswat_output_types:
+            hru_ids, output = self.get_hru_outputs(output_type, years)
+            pair_output = self.get_pair_outputs(hru_ids, output, pair_hru_ids)
+
+            for year_position, year in enumerate(years):
+                prefix = str(output_type)[0].upper() + str(year)
+                hru_columns[prefix] = output[year_position]
+
+                field_output = swattools.LabelStatistics(
+                    pair_fields, pair_output[year_position], field_count,
+                    counts=pair_counts).compute(
+                        self.fieldswat_aggregation_methods)
+
+                for aggregation_method in self.fieldswat_aggregation_methods:
+                    field_columns[prefix + BATCH_AGGREGATION_METHOD_CODES[
+                        aggregation_method]] = field_output[aggregation_method]
+                    field_series.append(pd.DataFrame({
+                        'Field': np.arange(1, field_count + 1),
+                        'Year': year,
+                        'Output': output_type,
+                        'Statistic': aggregation_method,
+                        'Value': field_output[aggregation_method],
+                    }))
+
+        self.logger.info('Creating Field_Response.csv.')
+        pd.concat(field_series, ignore_index=True).to_csv(
+            self.output_dir + '/Output/Field_Response.csv', index=False)
+
+        return field_shapefile, field_columns, hru_ids, hru_columns
+
+    def get_field_output_name(self, aggregation_method):
+        """
+        Name of the Field_Response.shp attribute for an aggregation
+        method. A single method keeps the output type as its name,
+        several methods get the output type and an abbreviation of the
+        method (shapefile attribute names are limited to 10 characters).
+        """
+        if len(self.fieldswat_aggregation_methods) == 1:
+            return str(self.fieldswat_output_type)
 
-            # free up resources
-            feature.Destroy()
+        return str(self.fieldswat_output_type)[:3] + '_' + \
+            AGGREGATION_METHOD_ABBREVIATIONS[aggregation_method]
 
-        # free up resources
-        data_source.Destroy()
+    def create_new_field_shapefile(self, field_shapefile, field_columns):
+        """
+        Writes Field_Response.shp with each field's shape area and
+        aggregated outputs. The field shapes and records are streamed
+        from the fields shapefile in a single pass.
 
-    def update_hru_shapefile(self, inshape, new_data):
-        # open hru1.shp
-        src = ogr.Open(inshape, 1)
+        Parameters
+        ----------
+        field_shapefile: shapefile.Reader
+            Fields shapefile
+        field_columns: dict
+            Value for every field by attribute name, see
+            update_field_info and update_field_series
+        """
+        field_names = ['Shape_Area'] + list(field_columns)
+        field_outputs = np.column_stack(list(field_columns.values()))
 
-        # get the hru1 layer
-        lyr = src.GetLayer()
+        def iter_field_features():
+            for i, field in enumerate(field_shapefile.iterShapeRecords()):
+                # the field's shape area is its first attribute
+                yield field.shape.points, \
+                    [field.record[0]] + field_outputs[i].tolist()
 
-        # create new field we wish to append (Runoff or Sediment)
-        lyr.CreateField(
-            ogr.FieldDefn(str(self.fieldswat_output_type).title(), ogr.OFTReal))
+        geotools.write_polygon_shapefile(
+            self.output_dir + '/Output', 'Field_Response', field_names,
+            iter_field_features())
 
-        feature = lyr.GetNextFeature()
+    def update_hru_shapefile(self, inshape, hru_ids, hru_columns):
+        """
+        Adds the hru outputs (runoff and/or sediment for the selected
+        years) to HRU_Response.shp in one pass, joined to the features
+        by HRU_ID.
 
-        for i in range(0, len(new_data)):
-            feature.SetField(str(self.fieldswat_output_type), new_data[i])
-            lyr.SetFeature(feature)
-            feature = lyr.GetNextFeature()
+        Parameters
+        ----------
+        inshape: string
+            Filepath to HRU_Response.shp
+        hru_ids: array
+            HRU_ID for each position in the column values
+        hru_columns: dict
+            Values (in the same order as hru_ids) by attribute name
+        """
+        geotools.join_shapefile_attributes(
+            inshape, 'HRU_ID', hru_ids, hru_columns)
 
     def copy_results_to_depot(self):
         """
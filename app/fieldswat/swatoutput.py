@@ -0,0 +1,357 @@
+"""
+Reads the hru table of a SWAT model's SWATOutput.mdb and caches the
+columns Field SWAT uses (year, hru, runoff and sediment) as .npy files
+in a folder next to the database. The cache is the only copy of the
+table a task needs: sessions and task payloads refer to it through the
+model's directory and the arrays are loaded memory-mapped. The table
+is read with mdbtools' mdb-export when it is installed and with
+UCanAccess (through a JVM) otherwise. Progress is written to a small
+json file so the web pages can follow an extraction running in a
+Celery task.
+"""
+import json
+import os
+import shutil
+import subprocess
+
+import jaydebeapi
+import numpy as np
+import pandas as pd
+
+
+# columns read from the hru table
+HRU_TABLE_COLUMNS = ['YEAR', 'MON', 'HRU', 'SURQ_GENmm', 'SYLDt_ha']
+
+# java jdbc driver for reading access databases
+UCANACCESS_JARS = [
+    os.path.join(os.sep, 'opt', 'UCanAccess', 'ucanaccess-5.0.1.jar'),
+    os.path.join(os.sep, 'opt', 'UCanAccess', 'lib', 'commons-lang3-3.8.1.jar'),
+    os.path.join(os.sep, 'opt', 'UCanAccess', 'lib', 'commons-logging-1.2.jar'),
+    os.path.join(os.sep, 'opt', 'UCanAccess', 'lib', 'hsqldb-2.5.0.jar'),
+    os.path.join(os.sep, 'opt', 'UCanAccess', 'lib', 'jackcess-3.0.1.jar')
+]
+
+# number of hru table rows parsed at a time from mdb-export
+MDB_EXPORT_CHUNK_ROWS = 100000
+
+# hru table columns kept in the cache
+HRU_TABLE_CACHE_ARRAYS = ('years', 'hrus', 'runoff', 'sediment')
+
+
+def get_tables_out_dir(swat_model_dir):
+    """ Folder holding SWATOutput.mdb (and its hru table cache). """
+    return os.path.join(swat_model_dir, 'Scenarios', 'Default', 'TablesOut')
+
+
+def get_swatoutput_mdb_filepath(swat_model_dir):
+    """ Filepath to the model's SWATOutput.mdb. """
+    return os.path.join(get_tables_out_dir(swat_model_dir), 'SWATOutput.mdb')
+
+
+def get_hru_table_cache_dir(swat_model_dir):
+    """ Folder holding the cached hru table columns. """
+    return os.path.join(get_tables_out_dir(swat_model_dir), 'SWATOutput_hru')
+
+
+def get_progress_filepath(swat_model_dir):
+    """ Filepath to the hru table extraction progress. """
+    return os.path.join(
+        get_tables_out_dir(swat_model_dir), 'SWATOutput_hru.progress.json')
+
+
+def get_mdb_fingerprint(mdb_filepath):
+    """
+    Size (bytes) and modification time (ns) of SWATOutput.mdb, stored
+    with the cache to tell when the database has changed.
+    """
+    stat = os.stat(mdb_filepath)
+
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def write_progress(swat_model_dir, status, message, rows=0):
+    """
+    Records the state of an hru table extraction.
+
+    Parameters
+    ----------
+    swat_model_dir: string
+        Path to uploaded swat model's directory
+    status: string
+        'running', 'complete' or 'error'
+    message: string
+        Description of the current step
+    rows: int
+        Number of hru table rows read so far
+    """
+    progress_filepath = get_progress_filepath(swat_model_dir)
+    with open(progress_filepath + '.tmp', 'w') as progress_file:
+        json.dump(
+            {'status': status, 'message': message, 'rows': rows},
+            progress_file)
+    # replace the previous progress in one step for readers polling it
+    os.replace(progress_filepath + '.tmp', progress_filepath)
+
+
+def read_progress(swat_model_dir):
+    """
+    Returns the state of an hru table extraction (see write_progress),
+    'complete' when the cache is up to date and 'missing' when no
+    extraction was started.
+    """
+    if load_hru_table_cache(swat_model_dir, mmap_mode='r') is not None:
+        return {'status': 'complete', 'message': 'SWATOutput.mdb read.',
+                'rows': 0}
+
+    try:
+        with open(get_progress_filepath(swat_model_dir)) as progress_file:
+            return json.load(progress_file)
+    except (IOError, ValueError):
+        return {'status': 'missing', 'message': '', 'rows': 0}
+
+
+def select_hru_table_columns(hru_table):
+    """
+    Keeps the HRU_TABLE_COLUMNS of a table read from the database,
+    matching the column names without case.
+    """
+    columns = {column.upper(): column for column in hru_table.columns}
+
+    return pd.DataFrame({
+        column: hru_table[columns[column.upper()]].values
+        for column in HRU_TABLE_COLUMNS})
+
+
+def read_hru_table_with_mdbtools(mdb_filepath, report_progress=None):
+    """
+    Streams the hru table out of SWATOutput.mdb with mdbtools'
+    mdb-export and parses it in chunks of MDB_EXPORT_CHUNK_ROWS rows.
+
+    Parameters
+    ----------
+    mdb_filepath: string
+        Filepath to SWATOutput.mdb
+    report_progress: function
+        Called with the number of rows read after each chunk
+
+    Returns
+    -------
+    hru_table: DataFrame
+        HRU_TABLE_COLUMNS for every row of the hru table
+    """
+    column_names = set(column.upper() for column in HRU_TABLE_COLUMNS)
+    export = subprocess.Popen(
+        ['mdb-export', mdb_filepath, 'hru'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+
+    try:
+        chunks = []
+        rows = 0
+        for chunk in pd.read_csv(
+                export.stdout,
+                usecols=lambda column: column.upper() in column_names,
+                chunksize=MDB_EXPORT_CHUNK_ROWS):
+            chunks.append(select_hru_table_columns(chunk))
+            rows += len(chunk)
+            if report_progress:
+                report_progress(rows)
+    finally:
+        export.stdout.close()
+        error = export.stderr.read().decode(errors='replace')
+        export.stderr.close()
+        returncode = export.wait()
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(
+            returncode, 'mdb-export', stderr=error)
+    if not chunks:
+        raise ValueError('No hru table rows found in ' + mdb_filepath)
+
+    return pd.concat(chunks, ignore_index=True)
+
+
+def read_hru_table_with_ucanaccess(mdb_filepath):
+    """
+    Reads the hru table out of SWATOutput.mdb with the UCanAccess jdbc
+    driver (starts a JVM).
+
+    Parameters
+    ----------
+    mdb_filepath: string
+        Filepath to SWATOutput.mdb
+
+    Returns
+    -------
+    hru_table: DataFrame
+        HRU_TABLE_COLUMNS for every row of the hru table
+    """
+    dbcon = jaydebeapi.connect(
+        'net.ucanaccess.jdbc.UcanaccessDriver',
+        f'jdbc:ucanaccess://{mdb_filepath};',
+        ['', ''],
+        ':'.join(UCANACCESS_JARS)
+    )
+    try:
+        cursor = dbcon.cursor()
+
+        # construct sql query and execute
+        cursor.execute(
+            'SELECT ' + ', '.join(HRU_TABLE_COLUMNS) + ' FROM hru')
+
+        # fetch query results
+        query_records = cursor.fetchall()
+    finally:
+        # close database connection
+        dbcon.close()
+
+    return pd.DataFrame.from_records(query_records, columns=HRU_TABLE_COLUMNS)
+
+
+def summarize_hru_table(hru_table):
+    """
+    Gets the year, hru, runoff and sediment for each row of an annual hru
+    table. Monthly tables are summarized with the runoff and sediment
+    means for each year and hru (sorted by year and then hru). We
+    assume the table is monthly when the first MON value has less than
+    4 digits (annual tables hold the year in MON).
+
+    Parameters
+    ----------
+    hru_table: DataFrame
+        HRU_TABLE_COLUMNS for every row of the hru table
+
+    Returns
+    -------
+    swat_mdb_data: dict
+        Arrays of years, hrus, runoff and sediment
+    """
+    if hru_table['MON'].iloc[0] < 1000:
+        hru_table = hru_table.groupby(['YEAR', 'HRU'], as_index=False)[
+            ['SURQ_GENmm', 'SYLDt_ha']].mean()
+
+    return {
+        'years': hru_table['YEAR'].values.astype(np.int64),
+        'hrus': hru_table['HRU'].values.astype(np.int64),
+        'runoff': hru_table['SURQ_GENmm'].values.astype(float),
+        'sediment': hru_table['SYLDt_ha'].values.astype(float),
+    }
+
+
+def save_hru_table_cache(swat_model_dir, swat_mdb_data, fingerprint):
+    """
+    Saves the hru table columns (see summarize_hru_table) with the
+    fingerprint of the database they were read from. The folder is
+    written under a temporary name and then renamed so the cache is
+    never partial.
+    """
+    cache_dir = get_hru_table_cache_dir(swat_model_dir)
+    temporary_dir = cache_dir + '.tmp'
+    if os.path.exists(temporary_dir):
+        shutil.rmtree(temporary_dir)
+    os.makedirs(temporary_dir)
+
+    for key in HRU_TABLE_CACHE_ARRAYS:
+        np.save(os.path.join(temporary_dir, key + '.npy'), swat_mdb_data[key])
+    np.save(os.path.join(temporary_dir, 'fingerprint.npy'), fingerprint)
+
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.replace(temporary_dir, cache_dir)
+
+
+def load_hru_table_cache(swat_model_dir, mmap_mode=None):
+    """
+    Loads the cached hru table columns (see summarize_hru_table), None
+    when there is no cache or SWATOutput.mdb changed after it was made.
+
+    Parameters
+    ----------
+    swat_model_dir: string
+        Path to uploaded swat model's directory
+    mmap_mode: string
+        Memory-map the arrays with this mode (e.g. 'r') instead of
+        reading them into memory
+
+    Returns
+    -------
+    swat_mdb_data: dict
+        Arrays of years, hrus, runoff and sediment
+    """
+    cache_dir = get_hru_table_cache_dir(swat_model_dir)
+    try:
+        fingerprint = np.load(os.path.join(cache_dir, 'fingerprint.npy'))
+        if not np.array_equal(
+                fingerprint,
+                get_mdb_fingerprint(
+                    get_swatoutput_mdb_filepath(swat_model_dir))):
+            return None
+
+        return {key: np.load(os.path.join(cache_dir, key + '.npy'),
+                             mmap_mode=mmap_mode)
+                for key in HRU_TABLE_CACHE_ARRAYS}
+    except (IOError, ValueError):
+        return None
+
+
+def extract_hru_table(swat_model_dir, logger=None):
+    """
+    Reads the hru table of SWATOutput.mdb into the cache, unless the
+    cache is already up to date. mdb-export is used when it is
+    installed, UCanAccess when it is not or when mdb-export fails.
+    Progress is recorded with write_progress.
+
+    Parameters
+    ----------
+    swat_model_dir: string
+        Path to uploaded swat model's directory
+    logger: Logger
+        Logs the reader used and mdb-export failures
+
+    Returns
+    -------
+    swat_mdb_data: dict
+        Arrays of years, hrus, runoff and sediment
+    """
+    swat_mdb_data = load_hru_table_cache(swat_model_dir, mmap_mode='r')
+    if swat_mdb_data is not None:
+        write_progress(swat_model_dir, 'complete', 'SWATOutput.mdb read.')
+        return swat_mdb_data
+
+    mdb_filepath = get_swatoutput_mdb_filepath(swat_model_dir)
+    fingerprint = get_mdb_fingerprint(mdb_filepath)
+
+    def report_progress(rows):
+        write_progress(
+            swat_model_dir, 'running',
+            'Reading SWATOutput.mdb ({0} rows read).'.format(rows), rows)
+
+    try:
+        write_progress(swat_model_dir, 'running', 'Reading SWATOutput.mdb.')
+        hru_table = None
+        if shutil.which('mdb-export'):
+            try:
+                hru_table = read_hru_table_with_mdbtools(
+                    mdb_filepath, report_progress)
+            except (OSError, ValueError, subprocess.CalledProcessError) as e:
+                if logger:
+                    logger.warning(
+                        'mdb-export failed, using UCanAccess: ' + str(e))
+        if hru_table is None:
+            hru_table = read_hru_table_with_ucanaccess(mdb_filepath)
+            report_progress(len(hru_table))
+
+        write_progress(
+            swat_model_dir, 'running', 'Calculating annual values.',
+            len(hru_table))
+        swat_mdb_data = summarize_hru_table(hru_table)
+
+        save_hru_table_cache(swat_model_dir, swat_mdb_data, fingerprint)
+    except Exception as e:
+        write_progress(swat_model_dir, 'error', str(e))
+        raise
+
+    write_progress(
+        swat_model_dir, 'complete', 'SWATOutput.mdb read.', len(hru_table))
+
+    return swat_mdb_data
@@ -3,6 +3,7 @@ from __future__ import absolute_import
 from celery import shared_task
 from celery.utils.log import get_task_logger
 from .process import FieldSWATProcess
+from . import swatoutput
 
 
 logger = get_task_logger('fieldswat')
@@ -27,10 +28,38 @@ def process_task(data):
     logger.info("Starting process for task {0}.".format(data["task_id"]))
 
     process = FieldSWATProcess(logger, data)
-    process.start()
+    try:
+        process.start()
+    finally:
+        # free the intermediate rasters whether or not the task succeeded
+        process.raster_workspace.close()
     process.copy_results_to_depot()
     process.clean_up_input_data()
     process.email_user_link_to_results()
     process.update_task_status_in_database()
 
     logger.info("Task {0} completed.".format(data["task_id"]))
+
+
+@shared_task
+def extract_swatoutput_task(swat_model_dir):
+    """
+    Reads the hru table of an uploaded SWAT model's SWATOutput.mdb into
+    the cache next to it. The views follow the extraction through
+    swatoutput.read_progress.
+
+    Parameters
+    ----------
+    swat_model_dir: string
+        Path to uploaded swat model's directory
+
+    Returns
+    -------
+    none
+    """
+
+    logger.info("Reading SWATOutput.mdb for {0}.".format(swat_model_dir))
+
+    swatoutput.extract_hru_table(swat_model_dir, logger)
+
+    logger.info("SWATOutput.mdb read for {0}.".format(swat_model_dir))
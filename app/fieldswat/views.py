@@ -1,6 +1,6 @@
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.shortcuts import render, resolve_url
 from django.template.response import TemplateResponse
 from django.utils import timezone
@@ -8,15 +8,17 @@ from django.utils import timezone
 from common.SWATModelZip import SWATModelZip
 from common.utils import fix_file_permissions
 from s3upload.models import S3Upload
+from swatluu.swattools import LabelStatistics
 from swatusers.models import UserTask
-from .tasks import process_task
+from . import swatoutput
+from .process import FIELD_LABELLING_METHODS, HRU_FIELD_FORMATS
+from .tasks import extract_swatoutput_task, process_task
 
 import glob
-import jaydebeapi
 import logging
 import io
+import numpy as np
 import os
-import pandas as pd
 import shutil
 import subprocess
 import zipfile
@@ -24,6 +26,15 @@ import zipfile
 
 logger = logging.getLogger('fieldswat')
 
+# shown when SWATOutput.mdb can not be read
+SWATOUTPUT_ERROR_MSG = 'You are either missing a .hru file or unique ' \
+                       'year in your database. Please compare your ' \
+                       'database with the example data to assess ' \
+                       'its compatibility with the Field_SWAT tool. ' \
+                       'If the issue persists then use the ' \
+                       '"Contact Us" option to report your issue to ' \
+                       'the Site Administrator.'
+
 
 # Create your views here.
 @login_required
@@ -96,43 +107,41 @@ def upload_swat_model_zip(request):
             request.session['error'] = validation_results['errors']
             request.session['error_swat_model'] = validation_results['errors']
             return render(request, 'fieldswat/index.html')
+        swat_model_dir = swat_model.get_directory()
         try:
-            # fetch data from SWATOutput.mdb
-            swatoutput_mdb_data = get_unique_years_from_mdb(
-                swat_model.get_directory())
-
-            request.session['swatoutput_years'] = swatoutput_mdb_data['years']
-            request.session['swatoutput_runoff'] = swatoutput_mdb_data['runoff']
-            request.session['swatoutput_sediment'] = swatoutput_mdb_data['sediment']
-
-            # get unique_years
-            unique_years = list(set(swatoutput_mdb_data['years']))
-            unique_years.sort()
+            # fetch data from the SWATOutput.mdb cache when it exists,
+            # otherwise read SWATOutput.mdb in the background
+            swatoutput_mdb_data = swatoutput.load_hru_table_cache(
+                swat_model_dir, mmap_mode='r')
+            if swatoutput_mdb_data is None:
+                swatoutput.write_progress(
+                    swat_model_dir, 'running', 'Waiting to read SWATOutput.mdb.')
+                extract_swatoutput_task.delay(swat_model_dir)
+                # the years of a previous model must not validate the
+                # year selection, they are added once the model is read
+                request.session.pop('swatoutput_unique_years', None)
+                unique_years = []
+            else:
+                unique_years = add_swatoutput_years_to_session(
+                    request, swatoutput_mdb_data)
         except Exception as e:
             logger.error(str(e))
             logger.error("{0}: Missing .hru file or unique year in database.".format(
                 request.session.get('unique_directory_name')))
-            error_msg = 'You are either missing a .hru file or unique ' \
-                        'year in your database. Please compare your ' \
-                        'database with the example data to assess ' \
-                        'its compatibility with the Field_SWAT tool. ' \
-                        'If the issue persists then use the ' \
-                        '"Contact Us" option to report your issue to ' \
-                        'the Site Administrator.'
-            request.session['error'] = error_msg
-            request.session['error_swat_model'] = error_msg
+            request.session['error'] = SWATOUTPUT_ERROR_MSG
+            request.session['error_swat_model'] = SWATOUTPUT_ERROR_MSG
             return render(request, 'fieldswat/index.html')
 
-        request.session['swatoutput_unique_years'] = unique_years
-
-        # add unique years to context
+        # add unique years to context, the page polls swatoutput_progress
+        # for them while SWATOutput.mdb is being read
         context = {
-            'fieldswat_unique_years': [year for year in unique_years]
+            'fieldswat_unique_years': unique_years,
+            'swatoutput_extracting': swatoutput_mdb_data is None
         }
 
         # Update relevant session variables
         request.session['fieldswat_swat_model_filename'] = swat_model.get_filename()
-        request.session['fieldswat_swat_model_dir'] = swat_model.get_directory()
+        request.session['fieldswat_swat_model_dir'] = swat_model_dir
 
         request.session['progress_message'].append(
             'Swat Model zip folder uploaded.')
@@ -144,101 +153,54 @@ def upload_swat_model_zip(request):
         return render(request, 'fieldswat/index.html')
 
 
-def calculate_annual_means_from_mdb(records):
+def add_swatoutput_years_to_session(request, swatoutput_mdb_data):
     """
-    Calculates annual sediment and runoff means for monthly data.
+    Stores the unique years read from SWATOutput.mdb in the session.
+    The hru table itself stays in its cache next to the SWAT model (see
+    swatoutput.extract_hru_table) and is loaded by the task.
 
     Parameters
     ----------
-    records: list
-        Data fetched from SWAT mdb
+    request: HttpRequest
+        Request whose session is updated
+    swatoutput_mdb_data: dict
+        Arrays of years, hrus, runoff and sediment, see
+        swatoutput.extract_hru_table
 
     Returns
     -------
-    updated_records: list
-        SWAT mdb data with annual means
+    unique_years: list
+        Sorted unique years found in SWATOutput.mdb
     """
-    # Convert records from list of tuples to Pandas DataFrame
-    df = pd.DataFrame.from_records(records)
+    unique_years = np.unique(swatoutput_mdb_data['years']).tolist()
+    request.session['swatoutput_unique_years'] = unique_years
 
-    # Calculate runoff (3) and sediment (4) means based on year (0) and hru (2)
-    return df.groupby([0, 2], as_index=False)[3, 4].mean()
+    return unique_years
 
 
-def get_unique_years_from_mdb(swat_model_dir):
+@login_required
+def swatoutput_progress(request):
     """
-    Reads SWATOutput.mdb and queries all of the runoff and sediment data.
-
-    Parameters
-    ----------
-    swat_model_dir: string
-        Path to uploaded swat model's directory
-
-    Returns
-    -------
-    swat_mdb_data: list of lists
-        List of years, runoff, and sediment data stored in their own lists
+    Reports the progress of reading the uploaded SWAT model's
+    SWATOutput.mdb. Once it has been read, its data is added to the
+    session and the unique years are returned with the progress.
     """
-    # java jdbc driver for reading access databases
-    ucanaccess_jars = [
-        os.path.join(os.sep, "opt", "UCanAccess", "ucanaccess-5.0.1.jar"),
-        os.path.join(os.sep, "opt", "UCanAccess", "lib", "commons-lang3-3.8.1.jar"),
-        os.path.join(os.sep, "opt", "UCanAccess", "lib", "commons-logging-1.2.jar" ),
-        os.path.join(os.sep, "opt", "UCanAccess", "lib", "hsqldb-2.5.0.jar"),
-        os.path.join(os.sep, "opt", "UCanAccess", "lib", "jackcess-3.0.1.jar")
-    ]
-    classpath = ":".join(ucanaccess_jars)
+    swat_model_dir = request.session.get('fieldswat_swat_model_dir')
+    if not swat_model_dir:
+        return JsonResponse({'status': 'missing', 'message': '', 'rows': 0})
 
-    # create path to SWATOutput.mdb
-    swat_mdb_filepath = os.path.join(swat_model_dir, "Scenarios", "Default", "TablesOut", "SWATOutput.mdb")
+    progress = swatoutput.read_progress(swat_model_dir)
+    if progress['status'] == 'complete':
+        progress['years'] = add_swatoutput_years_to_session(
+            request,
+            swatoutput.load_hru_table_cache(swat_model_dir, mmap_mode='r'))
+    elif progress['status'] == 'error':
+        logger.error(progress['message'])
+        logger.error("{0}: Missing .hru file or unique year in database.".format(
+            request.session.get('unique_directory_name')))
+        progress['message'] = SWATOUTPUT_ERROR_MSG
 
-    # open SWATOutput.mdb using pyodbc and MDBTools driver
-    dbcon = jaydebeapi.connect(
-        "net.ucanaccess.jdbc.UcanaccessDriver",
-        f"jdbc:ucanaccess://{swat_mdb_filepath};",
-        ["", ""],
-        classpath
-    )
-    cursor = dbcon.cursor()
-
-    # construct sql query and execute
-    sql_query = 'SELECT YEAR, MON, HRU, SURQ_GENmm, SYLDt_ha FROM hru'
-    cursor.execute(sql_query)
-
-    # fetch query results
-    query_records = cursor.fetchall()
-
-    # close database connection
-    dbcon.close()
-
-    # check if data is at annual or monthly intervals
-    # we will assume if the first MON value is less
-    # than 4 digits that we have monthly data
-    if len(str(query_records[0][1])) < 4:
-        query_records = calculate_annual_means_from_mdb(query_records)
-        return {
-            'years': query_records[0].values.tolist(),
-            'runoff': query_records[3].values.tolist(),
-            'sediment': query_records[4].values.tolist()
-        }
-    else:
-        # store query results in list objects
-        years = []
-        runoff = []
-        sediment = []
-
-        # loop through records and append to lists
-        for record in query_records:
-            years.append(record[0])
-            runoff.append(record[3])
-            sediment.append(record[4])
-
-        # convert lists to numpy arrays
-        return {
-            'years': years,
-            'runoff': runoff,
-            'sediment': sediment
-        }
+    return JsonResponse(progress)
 
 
 @login_required
@@ -251,19 +213,24 @@ def select_year(request):
     # If user is selecting a year
     if request.method == 'POST':
 
-        # Get the year
+        # Get the years (more than one runs the batch mode)
         try:
-            fieldswat_selected_year = int(request.POST.get('fieldswat_year'))
+            fieldswat_selected_years = [
+                int(year) for year in request.POST.getlist('fieldswat_year')]
         except Exception as e:
             logger.error(str(e))
-            request.session['error'] = 'Please select one of the year radio buttons.'
+            request.session['error'] = 'Please select at least one of the year check boxes.'
             return render(request, 'fieldswat/index.html')
 
-        if fieldswat_selected_year not in request.session['swatoutput_unique_years']:
-            request.session['error'] = 'Please select one of the year radio buttons.'
+        if not fieldswat_selected_years or any(
+                year not in request.session.get(
+                    'swatoutput_unique_years', [])
+                for year in fieldswat_selected_years):
+            request.session['error'] = 'Please select at least one of the year check boxes.'
             return render(request, 'fieldswat/index.html')
         else:
-            request.session['fieldswat_selected_year'] = fieldswat_selected_year
+            request.session['fieldswat_selected_years'] = fieldswat_selected_years
+            request.session['fieldswat_selected_year'] = fieldswat_selected_years[0]
             # Render the main page
             return render(request, 'fieldswat/index.html')
 
@@ -444,9 +411,9 @@ def upload_fields_shapefile_zip(request):
 @login_required
 def confirm_output_and_agg(request):
     """
-    Confirms which Output and Aggregation Method radio buttons were selected
-    by the user in Step 3. After validating the radio button value, the
-    selected values are added to their own session variables.
+    Confirms which Output and Aggregation Method boxes were selected by
+    the user in Step 3. After validating the selected values, they are
+    added to their own session variables.
     """
     # clear any previous progress or error messages
     request.session['progress_complete'] = []
@@ -458,8 +425,12 @@ def confirm_output_and_agg(request):
     if request.method == 'POST':
         try:
             # retrieve posted values
-            output_type = request.POST.get('fieldswat_output')
-            aggregation_method = request.POST.get('fieldswat_agg')
+            output_types = request.POST.getlist('fieldswat_output')
+            aggregation_methods = request.POST.getlist('fieldswat_agg')
+            hru_field_format = request.POST.get(
+                'fieldswat_hru_field_format', 'xlsx')
+            field_labelling = request.POST.get(
+                'fieldswat_field_labelling', 'cell_centre')
         except Exception as e:
             logger.error(str(e))
             error_msg = 'Unable to find selected output and aggregation ' \
@@ -470,26 +441,50 @@ def confirm_output_and_agg(request):
             return render(request, 'fieldswat/index.html')
 
         # verify the value matches what we would expect
-        if output_type != u'runoff' and output_type != u'sediment':
-            error_msg = 'Output type is not recognized. Please make sure a ' \
-                        'radio button is selected under Output.'
+        if not output_types or any(
+                output_type not in (u'runoff', u'sediment')
+                for output_type in output_types):
+            error_msg = 'Output type is not recognized. Please make sure at ' \
+                        'least one box is checked under Output.'
             request.session['error'] = error_msg
             request.session['error_agg_out'] = error_msg
             return render(request, 'fieldswat/index.html')
 
         # verify the value matches what we would expect
-        if aggregation_method != 'mean' and aggregation_method != 'mode' and \
-                aggregation_method != 'geomean' and aggregation_method != 'area_weighted_mean':
+        if not aggregation_methods or any(
+                aggregation_method not in LabelStatistics.STATISTICS
+                for aggregation_method in aggregation_methods):
             error_msg = 'Aggregation method is not recognized. Please make ' \
-                        'sure a radio button is selected under ' \
+                        'sure at least one box is checked under ' \
                         'Aggregation method.'
             request.session['error'] = error_msg
             request.session['error_agg_out'] = error_msg
             return render(request, 'fieldswat/index.html')
 
+        # verify the value matches what we would expect
+        if hru_field_format not in HRU_FIELD_FORMATS:
+            error_msg = 'HRU to field table format is not recognized. ' \
+                        'Please select one of the formats under HRU to ' \
+                        'field table.'
+            request.session['error'] = error_msg
+            request.session['error_agg_out'] = error_msg
+            return render(request, 'fieldswat/index.html')
+
+        # verify the value matches what we would expect
+        if field_labelling not in FIELD_LABELLING_METHODS:
+            error_msg = 'Field cell assignment is not recognized. Please ' \
+                        'select one of the options under Assign cells to ' \
+                        'fields by.'
+            request.session['error'] = error_msg
+            request.session['error_agg_out'] = error_msg
+            return render(request, 'fieldswat/index.html')
+
         # add selected values to session variables
-        request.session['fieldswat_output_type'] = output_type
-        request.session['fieldswat_aggregation_method'] = aggregation_method
+        request.session['fieldswat_output_types'] = output_types
+        request.session['fieldswat_output_type'] = output_types[0]
+        request.session['fieldswat_aggregation_method'] = aggregation_methods
+        request.session['fieldswat_hru_field_format'] = hru_field_format
+        request.session['fieldswat_field_labelling'] = field_labelling
 
     return render(request, 'fieldswat/index.html')
 
@@ -524,10 +519,17 @@ def request_process(request):
         'fieldswat_fields_shapefile_filepath': request.session.get('fieldswat_fields_shapefile_filepath'),
         'fieldswat_output_type': request.session['fieldswat_output_type'],
         'fieldswat_aggregation_method': request.session['fieldswat_aggregation_method'],
-        'swatoutput_years': request.session['swatoutput_years'],
-        'swatoutput_runoff': request.session['swatoutput_runoff'],
-        'swatoutput_sediment': request.session['swatoutput_sediment'],
         'fieldswat_selected_year': request.session['fieldswat_selected_year'],
+        'fieldswat_selected_years': request.session.get(
+            'fieldswat_selected_years',
+            [request.session['fieldswat_selected_year']]),
+        'fieldswat_output_types': request.session.get(
+            'fieldswat_output_types',
+            [request.session['fieldswat_output_type']]),
+        'fieldswat_hru_field_format': request.session.get(
+            'fieldswat_hru_field_format', 'xlsx'),
+        'fieldswat_field_labelling': request.session.get(
+            'fieldswat_field_labelling', 'cell_centre'),
     }
 
     if not request.session['error']:
@@ -1,15 +1,66 @@
 from django.core.mail import send_mail
 from django.utils import timezone
 from swatusers.models import UserTask
-from subprocess import check_call
 from swatluu import geotools
+from swatluu import swattools
 
 import numpy as np
 import os
 import shutil
+import zlib
+
+
+class InjectionAllocator(object):
+    """
+    Hands out the cells of each subbasin for new lulc code injection.
+    Every subbasin gets a random order of its cells and a cursor; each
+    request takes the next cells after the cursor so a cell is not
+    reused until the subbasin runs out. When fewer unused cells are
+    left than requested, the subbasin gets a new random order of all
+    of its cells (refill) and starts over.
+
+    Parameters
+    ----------
+    seed: int
+        Seed for the random orders, the same seed hands out the same
+        cells for the same requests
+    """
+
+    def __init__(self, seed):
+        self.random_state = np.random.RandomState(seed)
+        self.orders = {}
+        self.cursors = {}
+
+    def take(self, subid, cell_count, count):
+        """
+        Takes count cells from a subbasin.
+
+        Parameters
+        ----------
+        subid: int
+            Subbasin id
+
+        cell_count: int
+            Number of cells in the subbasin
+
+        count: int
+            Number of cells to take
+
+        Returns
+        -------
+        cells: array
+            Positions (0 to cell_count - 1) of the cells taken
+        """
+        order = self.orders.get(subid)
+        cursor = self.cursors.get(subid, 0)
+        if order is None or len(order) - cursor < count:
+            order = self.random_state.permutation(cell_count)
+            cursor = 0
+            self.orders[subid] = order
 
-env = os.environ.copy()
-env['PATH'] = '{0}{1}{2}'.format('/usr/local/bin', os.pathsep, env['PATH'])
+        self.cursors[subid] = cursor + count
+
+        return order[cursor:cursor + count]
 
 
 class LUUCheckerProcess(object):
@@ -72,6 +123,15 @@ class LUUCheckerProcess(object):
             self.status = [0, 'Everything checks out.']
             self.new_landuse_layer = ''
 
+        # intermediate rasters (converted landuse layers and subbasins),
+        # written to the temporary output directory when they don't fit
+        # in memory
+        self.raster_workspace = geotools.RasterWorkspace(
+            self.temp_output_directory)
+
+        # seed for the cells picked for new lulc code injection
+        self.random_seed = zlib.crc32(self.task_id.encode())
+
         self.tool_name = 'LUU Checker'
         self.logger = logger
 
@@ -126,8 +186,9 @@ class LUUCheckerProcess(object):
 
         # convert base landuse raster from .adf to .tif
         try:
-            output_filepath = self.temp_output_directory + '/' + os.path.basename(
-                self.base_landuse_raster_filepath) + '.tif'
+            output_filepath = self.raster_workspace.create_filepath_like(
+                os.path.basename(self.base_landuse_raster_filepath) + '.tif',
+                self.base_landuse_raster_filepath)
             geotools.convert_adf_to_tif(
                 self.base_landuse_raster_filepath,
                 output_filepath)
@@ -142,9 +203,8 @@ class LUUCheckerProcess(object):
 
         try:
             # read base landuse raster (.tif) into numpy array
-            base_raster_array = geotools.read_raster(
-                self.temp_output_directory + '/' +
-                self.base_landuse_raster_filename + '.tif')[0]
+            base_raster_array = geotools.read_raster(output_filepath)[0]
+            self.raster_workspace.release(output_filepath)
 
             # construct shapefile layer information
             rows = str(len(base_raster_array))
@@ -176,7 +236,8 @@ class LUUCheckerProcess(object):
             raise Exception('Unable to read the subbasin shapefile.')
 
         # path and filename for the soon to be created subbasin geotiff
-        output_tif_filepath = self.temp_output_directory + '/subbasin.tif'
+        output_tif_filepath = self.raster_workspace.create_filepath(
+            'subbasin.tif', base_raster_array.size)
 
         # create geotiff raster of the subbasin shapefile
         self.logger.info('Converting subbasin .shp to .tif.')
@@ -201,8 +262,8 @@ class LUUCheckerProcess(object):
         try:
             # read rasterized shapefile into numpy array
             rasterized_shapefile = \
-                geotools.read_raster(self.temp_output_directory + '/subbasin.tif')[
-                    0]
+                geotools.read_raster(output_tif_filepath)[0]
+            self.raster_workspace.release(output_tif_filepath)
         except Exception as e:
             self.logger.error(str(e))
             self.logger.error(
@@ -229,11 +290,20 @@ class LUUCheckerProcess(object):
             raise Exception(
                 'Unable to create emerging_lulcs text file to store new landuse information.')
 
+        self.logger.info('Partitioning the raster cells by subbasin.')
+        # index the cells of each subbasin once (subbasin ids take the
+        # place of the dominant hrus), the cells of subbasin i + 1 are
+        # at position i in the index in row-major order
+        subbasin_index = swattools.HruPixelIndex(
+            rasterized_shapefile,
+            np.arange(1, total_subbasin_count + 1),
+            0)
+
         self.logger.info('Begin looping through new landuse layers.\n\n')
 
-        # Keep track of indices already used for new code injection
-        # Key: subbasin id, Val: indices
-        injection_history = {}
+        # hands out each subbasin's cells for new code injection without
+        # reusing them, seeded per task so the composite is reproducible
+        injection_allocator = InjectionAllocator(self.random_seed)
 
         try:
             # loop through each new landuse layer selected by the user
@@ -244,48 +314,47 @@ class LUUCheckerProcess(object):
                 emerging_lulc_report.write(landuse_layer + '\n')
 
                 # convert the new landuse layer raster to array
+                landuse_layer_tif_filepath = \
+                    self.raster_workspace.create_filepath_like(
+                        os.path.basename(landuse_layer) + '.tif',
+                        landuse_layer)
                 geotools.convert_adf_to_tif(landuse_layer,
-                                            self.temp_output_directory + '/' + os.path.basename(
-                                                landuse_layer) + '.tif')
+                                            landuse_layer_tif_filepath)
                 self.logger.info(
                     'Converting new landuse geotiff into numpy array.')
-                self.logger.info(
-                    self.temp_output_directory + '/' + os.path.basename(
-                        landuse_layer) + '.tif')
+                self.logger.info(landuse_layer_tif_filepath)
                 # read new landuse raster (.tif) into numpy array
                 new_landuse_raster = geotools.read_raster(
-                    self.temp_output_directory + '/' +
-                    os.path.basename(landuse_layer) + '.tif')[0]
+                    landuse_layer_tif_filepath)[0]
+                self.raster_workspace.release(landuse_layer_tif_filepath)
+
+                # find lulc codes in the new layer that aren't in the base
+                # layer for every subbasin (injecting codes into a subbasin
+                # only changes that subbasin's cells)
+                subbasins_new_lulc_codes = self.find_unique_lulc_codes(
+                    subbasin_index,
+                    base_raster_array,
+                    new_landuse_raster)
+
                 self.logger.info('Begin looping through subbasins.')
-                # create feature layers based off the FID field & then use as mask
-                # to extract subbasin landuse information
                 for i in range(0, total_subbasin_count):
                     self.logger.info('SUBBASIN #' + str(i + 1) + ':')
 
                     # write the subbasin number to report
                     emerging_lulc_report.write('Subbasin ' + str(i + 1) + '\n')
 
-                    self.logger.info('Finding indicies in base raster array ' +
-                                     'that correspond with current subbasin.')
-                    # find indicies where the value < 255 (remove the NoData)
-                    idx = np.nonzero(rasterized_shapefile == i + 1)
-
-                    # find lulc codes in the new layer that aren't in the base layer
-                    new_lulc_codes = self.find_unique_lulc_codes(
-                        idx,
-                        base_raster_array,
-                        new_landuse_raster)
+                    new_lulc_codes = subbasins_new_lulc_codes[i]
 
                     # write the emerging lulc to report
                     emerging_lulc_report.write(str(new_lulc_codes) + '\n\n')
 
                     # inject new lulc codes into the base raster array
-                    base_raster_array, injection_history = self.inject_new_lulc_codes(
+                    base_raster_array = self.inject_new_lulc_codes(
                         i + 1,
-                        idx,
+                        subbasin_index.pixels(i),
                         new_lulc_codes,
                         base_raster_array,
-                        injection_history)
+                        injection_allocator)
 
                 self.logger.info('End looping through subbasins.')
         except Exception as e:
@@ -304,7 +373,7 @@ class LUUCheckerProcess(object):
             self.create_composite_raster(
                 base_raster_array,
                 self.base_landuse_raster_adf_filepath,
-                self.temp_output_directory + '/base_new1.tif')
+                self.output_directory + '/base_new.tif')
         except Exception as e:
             self.logger.error(str(e))
             self.logger.error(
@@ -350,18 +419,20 @@ class LUUCheckerProcess(object):
         if not os.path.exists(self.temp_output_directory):
             os.makedirs(self.temp_output_directory)
 
-    def find_unique_lulc_codes(self, idx, base_raster_array,
+    def find_unique_lulc_codes(self, subbasin_index, base_raster_array,
                                new_landuse_raster):
         """
         Finds the unique landuse/landcover values in the base landuse raster
-        array and the new landuse raster array. Then it identifies any
-        landuse/landcover values present in the new landuse raster array that
-        are not in the base landuse raster array.
+        array and the new landuse raster array for every subbasin. Then it
+        identifies any landuse/landcover values present in the new landuse
+        raster array that are not in the base landuse raster array. All of
+        the subbasins are handled in one pass using a combined
+        (subbasin, lulc code) key.
 
         Parameters
         ----------
-        idx: tuple
-            Contains row and column indicies for the subbasin
+        subbasin_index: HruPixelIndex
+            Index of the cells that belong to each subbasin
 
         base_raster_array: array
             Base landuse raster as numpy array
@@ -371,26 +442,41 @@ class LUUCheckerProcess(object):
 
         Returns
         -------
-        new_lulc_codes: array
-            Single dimensional array containing landuse/landcover values
-            completely unique to the new landuse raster array
+        new_lulc_codes: list
+            One single dimensional array per subbasin containing
+            landuse/landcover values completely unique to the new landuse
+            raster array
         """
         self.logger.info(
             'Finding the landuse/landcover values unique to the new landuse raster.')
 
-        # parse the idx to separate variables
-        row, col = idx
-        # find unique LULC in base landuse array
-        base_raster_lulc_codes = np.unique(base_raster_array[row, col])
-        # find unique LULC in new landuse array
-        new_raster_lulc_codes = np.unique(new_landuse_raster[row, col])
-        # now compare new landuse raster's lulc codes with base raster's lulc codes
-        new_lulc_codes = np.setdiff1d(new_raster_lulc_codes,
-                                      base_raster_lulc_codes)
-
-        return new_lulc_codes
-
-    def inject_new_lulc_codes(self, subid, idx, new_lulc_codes, base_raster_array, injection_history):
+        # lulc values for each subbasin's cells in both rasters
+        base_values = subbasin_index.gather(base_raster_array)
+        new_values = subbasin_index.gather(new_landuse_raster)
+
+        # number the lulc codes found in either raster and combine them
+        # with the subbasin position into a single key
+        lulc_codes, code_ids = np.unique(
+            np.concatenate((base_values, new_values)), return_inverse=True)
+        code_ids = code_ids.ravel()
+        code_count = len(lulc_codes)
+        base_keys = np.unique(
+            subbasin_index.labels * code_count + code_ids[:len(base_values)])
+        new_keys = np.unique(
+            subbasin_index.labels * code_count + code_ids[len(base_values):])
+
+        # now compare new landuse raster's lulc codes with base raster's
+        # lulc codes (keys stay sorted by subbasin and then lulc code)
+        new_lulc_keys = np.setdiff1d(new_keys, base_keys, assume_unique=True)
+        subbasin_starts = np.searchsorted(
+            new_lulc_keys // code_count, np.arange(len(subbasin_index) + 1))
+        new_lulc_codes = lulc_codes[new_lulc_keys % code_count]
+
+        return [new_lulc_codes[subbasin_starts[i]:subbasin_starts[i + 1]]
+                for i in range(len(subbasin_index))]
+
+    def inject_new_lulc_codes(self, subid, pixels, new_lulc_codes,
+                              base_raster_array, injection_allocator):
         """
         Takes the lulc codes that emerged in the new landuse raster and then
         injects instances of each code into the base landuse raster. The
@@ -402,7 +488,8 @@ class LUUCheckerProcess(object):
         subid: int
             Subbasin id
 
-            Contains row and column indicies for the subbasin
+        pixels: array
+            Flat (row-major) indicies of the subbasin's cells
 
         new_lulc_codes: array
             Single dimensional array containing landuse/landcover values
@@ -410,10 +497,9 @@ class LUUCheckerProcess(object):
 
         base_raster_array: array
             Original base landuse raster as numpy array
-            idx: tuple
 
-        injection_history: dictionary
-            Contains randomized indices used by each subbasin
+        injection_allocator: InjectionAllocator
+            Hands out the subbasin cells that have not been injected yet
 
         Returns
         -------
@@ -424,63 +510,56 @@ class LUUCheckerProcess(object):
             'Injecting emerging lulc codes into base raster array.')
         # if newLULC > 0, this implies landuses are present in the new LULC
         if np.size(new_lulc_codes, axis=0) > 0:
-            # this implies that an alternative LULC is required containing few cells with additional landuses
-            base_raster_array_temp = base_raster_array
-            row, col = idx
-            # this makes sure we don't overwrite one of our landuses in the base raster array
-            # it checks if the number of unique lulc codes in the updated base raster array
-            # matches the sum of the original base raster array plus new_lulc_codes
-            # if they don't match, that means we erased a landuse so we reshuffle and try again
-            # while len(valBase) + len(new_lulc_codes) != len(np.unique(base_raster_array[row, col])):
-            index_array = list(range(0, np.shape(idx)[1]))
-            np.random.shuffle(index_array)
-            # If key does not already exist in dictionary, add it
-            if subid not in injection_history.keys():
-                injection_history[subid] = index_array
-
             # Number of new code injections to make
             number_of_new_lulc_cells = int(round(
-                (float(self.landuse_percent) / 100.0) * np.shape(idx)[1]))
+                (float(self.landuse_percent) / 100.0) * len(pixels)))
 
-            # Make sure we have enough randomized indices to handle request
-            if len(injection_history[subid]) < number_of_new_lulc_cells:
-                # Resets randomized indices
-                injection_history[subid] = index_array
+            # take unused cells for all of the codes at once so the codes
+            # don't overwrite each other
+            injection_cells = injection_allocator.take(
+                subid,
+                len(pixels),
+                number_of_new_lulc_cells * len(new_lulc_codes))
 
-            previous_new_lulc_ending_index = 0
             for j in range(0, len(new_lulc_codes)):
-
-                newLULC_idx = injection_history[subid][
-                    previous_new_lulc_ending_index:number_of_new_lulc_cells + previous_new_lulc_ending_index]
-                previous_new_lulc_ending_index = previous_new_lulc_ending_index + \
-                    number_of_new_lulc_cells
-                base_raster_array[row[newLULC_idx], col[newLULC_idx]] = \
+                newLULC_idx = pixels[injection_cells[
+                    j * number_of_new_lulc_cells:
+                    (j + 1) * number_of_new_lulc_cells]]
+                base_raster_array[np.unravel_index(
+                    newLULC_idx, base_raster_array.shape)] = \
                     new_lulc_codes[j]
-                # Remove index from injection history to prevent its re-use
-                for injection_index in range(0, len(newLULC_idx)):
-                    injection_history[subid].pop(injection_index)
 
-        return base_raster_array, injection_history
+        return base_raster_array
 
     def create_composite_raster(self, base_raster_array,
                                 base_landuse_raster_adf_filepath,
                                 composite_raster_filepath):
+        """
+        Writes the updated base raster array (composite) to a compressed
+        geotiff with the base landuse raster's spatial information and
+        255 as the NoData value.
+
+        Parameters
+        ----------
+        base_raster_array: array
+            Base landuse raster updated with emerging lulcs
+
+        base_landuse_raster_adf_filepath: string
+            Filepath to the base landuse raster (w001001.adf)
+
+        composite_raster_filepath: string
+            Filepath for the composite geotiff
+
+        Returns
+        -------
+        None
+        """
         self.logger.info('Creating composite landuse raster.')
 
         geotools.create_raster(base_raster_array,
                                base_landuse_raster_adf_filepath,
-                               composite_raster_filepath)
-        try:
-            check_call(
-                ['gdal_translate', '-co', 'compress=lzw', '-a_nodata', '255',
-                 '-of', 'GTiff',
-                 self.temp_output_directory + '/base_new1.tif',
-                 self.output_directory + '/base_new.tif'], env=env)
-        except Exception as e:
-            self.logger.error(str(e))
-            self.logger.error(
-                'Error converting new base raster to geotiff.')
-            UserTask.objects.filter(task_id=self.task_id).update(task_status=2)
+                               composite_raster_filepath,
+                               nodata_value=255)
 
     def copy_results_to_depot(self):
         """
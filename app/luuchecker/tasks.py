@@ -27,7 +27,11 @@ def process_task(data):
     logger.info("Starting process for task {0}.".format(data["task_id"]))
 
     process = LUUCheckerProcess(logger, data)
-    process.start()
+    try:
+        process.start()
+    finally:
+        # free the intermediate rasters whether or not the task succeeded
+        process.raster_workspace.close()
     process.copy_results_to_depot()
     process.clean_up_input_data()
     process.email_user_link_to_results()
@@ -117,6 +117,17 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_HIJACK_ROOT_LOGGER = False
 
+# Number of processes a SWAT LUU task uses to prepare its landuse layers
+# (1 prepares them one at a time in the task's process)
+SWATLUU_LAYER_WORKERS = int(os.environ.get('SWATLUU_LAYER_WORKERS', 1))
+
+# Merged hrus shared by the SWAT LUU, Field SWAT and Uncertainty tasks
+# (see swattools.MergeCache), trimmed to MERGE_CACHE_MAX_BYTES
+MERGE_CACHE_DIR = os.environ.get(
+    'MERGE_CACHE_DIR', os.path.join(PROJECT_DIR, 'user_data', 'merge_cache'))
+MERGE_CACHE_MAX_BYTES = int(
+    os.environ.get('MERGE_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+
 
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
@@ -135,6 +135,8 @@ urlpatterns = [
     url(r'^fieldswat$', fieldswat_views.index, name='fieldswat'),
     url(r'^fieldswat/upload_swat_model_zip$', fieldswat_views.upload_swat_model_zip,
         name='fieldswat/upload_swat_model_zip'),
+    url(r'^fieldswat/swatoutput_progress$', fieldswat_views.swatoutput_progress,
+        name='fieldswat/swatoutput_progress'),
     url(r'^fieldswat/select_year$', fieldswat_views.select_year,
         name='fieldswat/select_year'),
     url(r'^fieldswat/upload_fields_shapefile_zip$', fieldswat_views.upload_fields_shapefile_zip,
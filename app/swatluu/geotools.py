@@ -1,18 +1,74 @@
+from matplotlib.path import Path
 from osgeo import gdal, ogr
-from subprocess import check_call
 
 import os
+import struct
+import uuid
 import numpy as np
 import shapefile
 
-env = os.environ.copy()
-env['PATH'] = '{0}{1}{2}'.format('/usr/local/bin', os.pathsep, env['PATH'])
+# approximate number of cells read per call when sampling a raster band
+SAMPLE_WINDOW_CELLS = 2 ** 22
+
+# default geotiff creation options for converted and created rasters
+GTIFF_COMPRESS = 'LZW'
+GTIFF_TILED = False
+GTIFF_PREDICTOR = None
+GDAL_NUM_THREADS = os.environ.get('GDAL_NUM_THREADS', 'ALL_CPUS')
+
+# bytes of intermediate rasters a task may keep in memory (/vsimem/)
+# before new ones are written to disk
+RASTER_WORKSPACE_MEMORY_LIMIT = int(os.environ.get(
+    'RASTER_WORKSPACE_MEMORY_LIMIT', 1024 ** 3))
+
+
+def get_raster_axes(origin, cell_size, rows, cols, centroid=False):
+    """
+    Generates the x coordinate of each raster column and the y
+    coordinate of each raster row. Together the two vectors describe
+    every cell in the raster without building a coordinate per cell;
+    use np.meshgrid(x_axis, y_axis, sparse=True) or broadcasting when
+    a grid is needed.
+
+    Parameters
+    ----------
+    origin: list
+        x, y coordinates for the upper left corner of the raster
+    cell_size: float
+        Raster cell size
+    rows: int
+        Number of rows in the raster
+    cols: int
+        Number of columns in the raster
+    centroid: boolean
+        If True the coordinates are located at the centroid of each
+        cell, otherwise at the upper left corner of each cell
+
+    Returns
+    -------
+    x_axis, y_axis: tuple of arrays
+        x coordinate for each column and y coordinate for each row
+    """
+    offset = cell_size / 2 if centroid else 0
+    xmin = origin[0] + offset
+    ymax = origin[1] - offset
+
+    # starting with the xmin, add the cell size to the previous x
+    # coord for each column in the raster (remove any extra columns)
+    x_axis = np.arange(xmin, xmin + (cols * cell_size), cell_size)[:cols]
+
+    # starting with the ymax, subtract the cell size from the
+    # previous y coord for each row in the raster
+    y_axis = np.subtract.accumulate(
+        np.concatenate(([ymax], np.full(max(rows - 1, 0), cell_size))))
+
+    return x_axis, y_axis
 
 
 def get_raster_coords(raster_filepath):
     """
     Opens a raster file, extracts the x,y coordinates at the
-    centroid of each cell, and returns the coordinates.
+    upper left corner of each cell, and returns the coordinates.
 
     Parameters
     ----------
@@ -22,6 +78,9 @@ def get_raster_coords(raster_filepath):
     Returns
     -------
     raster_data: dictionary containing raster data
+        'axes' holds the x coordinate of each column and the y coordinate
+        of each row, 'coords' holds the same coordinates as a sparse
+        (broadcastable) grid
     """
     # open raster with gdal
     rst = gdal.Open(raster_filepath)
@@ -33,42 +92,17 @@ def get_raster_coords(raster_filepath):
     # get geotransform properties
     gt = rst.GetGeoTransform()
 
-    # get raster origins
-    xmin = gt[0]
-    ymax = gt[3]
-
     # get raster cell size
     cell_size = gt[1]
 
-    # create empty lists that will hold the x, y coordinates
-    x_coords = [[None]] * rows
-    y_coords = [[None]] * rows
-
-    # starting with the xmin, generate the first row of x coords by
-    # adding the cell size to the previous x coord. repeat this for
-    # the number of columns in the raster. after the first row is
-    # completed, shift to the next row and repeat the process until
-    # all the rows have been completed.
-    for i in range(0, rows):
-        x_coords[i] = np.arange(xmin, xmin + (cols * cell_size), cell_size)
-
-    # Remove any extra columns
-    while len(x_coords[0]) > cols:
-        x_coords = np.delete(x_coords, [len(x_coords[0]) - 1], axis=1)
-
-    # starting with the ymin, generate the first row of y coords by
-    # adding the cell size to the previous Y coord. do this for the
-    # number of columns in the raster. after the first row is completed,
-    # shift to the next row and repeat the process until all the rows
-    # have been completed.
-    for i in range(0, rows):
-        y_coords[i] = [ymax] * cols
-        ymax -= cell_size
+    x_axis, y_axis = get_raster_axes(
+        (gt[0], gt[3]), cell_size, rows, cols)
 
     raster_data = {
         'array': rst.ReadAsArray(),
         'cell_size': cell_size,
-        'coords': (x_coords, y_coords),
+        'axes': (x_axis, y_axis),
+        'coords': tuple(np.meshgrid(x_axis, y_axis, sparse=True)),
         'nodata': rst.GetRasterBand(1).GetNoDataValue(),
     }
 
@@ -80,6 +114,11 @@ def create_raster_array(hrus1_filepath, landuse_filepath):
     Use the hrus1 coordinates to extract landuse values from the landuse
     raster and then create landuse numpy array with same extent as hrus1.
 
+    The offset of every hrus1 row and column in the landuse grid is
+    worked out once from the two geotransforms and the landuse values
+    are read in windows (see read_band_at_offsets) instead of one
+    cell at a time.
+
     Parameters
     ----------
     hrus1_filepath: string
@@ -95,6 +134,8 @@ def create_raster_array(hrus1_filepath, landuse_filepath):
     """
     # get gdal info from hrus1 raster
     hrus1_data = get_raster_coords(hrus1_filepath)
+    hrus1_nodata = hrus1_data['nodata']
+    cell_size = hrus1_data['cell_size']
 
     # open landuse raster
     lulc = gdal.Open(landuse_filepath)
@@ -108,24 +149,116 @@ def create_raster_array(hrus1_filepath, landuse_filepath):
     # get x and y origins for the landuse layer
     x_origin, y_origin = lulc_gt[0], lulc_gt[3]
 
-    # initialize landuse array
-    landuse_array = np.empty(
-        (len(hrus1_data['coords'][0]), len(hrus1_data['coords'][0][0])))
-
-    # use landuse x, y origins to find landuse values at hrus1 coordinates
-    for i in range(0, len(hrus1_data['coords'][0])):
-        for j in range(0, len(hrus1_data['coords'][0][0])):
-            x = hrus1_data['coords'][0][i][j]
-            y = hrus1_data['coords'][1][i][j]
-            x_offset = int((x - x_origin) / hrus1_data['cell_size'])
-            y_offset = abs(int((y - y_origin) / hrus1_data['cell_size']))
-            if hrus1_data['array'][i][j] != hrus1_data['nodata']:
-                landuse_array[i][j] = \
-                    lulc_band.ReadAsArray(x_offset, y_offset, 1, 1)[0, 0]
+    # x coordinate of each hrus1 column and y coordinate of each hrus1 row
+    x_coords, y_coords = hrus1_data['axes']
+
+    # use landuse x, y origins to find the landuse column and row
+    # at each hrus1 column and row
+    x_offsets = ((x_coords - x_origin) / cell_size).astype(int)
+    y_offsets = np.abs(((y_coords - y_origin) / cell_size).astype(int))
+
+    # cells outside of the watershed are set to nodata
+    outside_watershed = hrus1_data['array'] == hrus1_nodata
+
+    landuse_array = read_band_at_offsets(
+        lulc_band, x_offsets, y_offsets, outside_watershed)
+    landuse_array[outside_watershed] = hrus1_nodata
+
+    return landuse_array, (cell_size, hrus1_nodata)
+
+
+def read_band_at_offsets(band, x_offsets, y_offsets, skip_mask=None,
+                         window_cells=SAMPLE_WINDOW_CELLS):
+    """
+    Reads the values of a raster band at every (row, column) pair
+    formed by y_offsets and x_offsets. The band is read in horizontal
+    windows aligned to the band's natural block size (each window holds
+    roughly window_cells cells). When the offsets are consecutive, as
+    they are for grids with the same resolution and integer-aligned
+    origins, each window is copied over with array slicing; otherwise
+    the values are gathered from the window with fancy indexing.
+
+    Parameters
+    ----------
+    band: gdal.Band
+        Raster band the values are read from
+    x_offsets: array
+        Band column for each column of the output array
+    y_offsets: array
+        Band row for each row of the output array
+    skip_mask: array
+        Boolean array with the output array's shape, True marks the
+        cells that do not need a value (e.g. outside the watershed).
+        These cells are left as 0 and are allowed to fall outside
+        of the band's extent.
+    window_cells: int
+        Approximate number of cells read from the band per call
+
+    Returns
+    -------
+    values: array
+        Float array of shape (len(y_offsets), len(x_offsets))
+    """
+    x_offsets = np.asarray(x_offsets)
+    y_offsets = np.asarray(y_offsets)
+    values = np.zeros((len(y_offsets), len(x_offsets)))
+
+    # rows and columns that fall outside of the band's extent
+    x_outside = (x_offsets < 0) | (x_offsets >= band.XSize)
+    y_outside = (y_offsets < 0) | (y_offsets >= band.YSize)
+    if x_outside.any() or y_outside.any():
+        outside_extent = x_outside[np.newaxis, :] | y_outside[:, np.newaxis]
+        if skip_mask is not None:
+            outside_extent &= ~skip_mask
+        if outside_extent.any():
+            raise ValueError(
+                'Raster cells fall outside of the extent of the band.')
+
+    x_valid = np.nonzero(~x_outside)[0]
+    y_valid = np.nonzero(~y_outside)[0]
+    if len(x_valid) == 0 or len(y_valid) == 0:
+        return values
+
+    # bounding window (in band columns) covering the requested columns
+    x_min = x_offsets[x_valid].min()
+    x_max = x_offsets[x_valid].max() + 1
+    window_x = x_offsets[x_valid] - x_min
+
+    # consecutive columns can be sliced instead of gathered
+    x_consecutive = len(x_valid) == len(x_offsets) and \
+        np.array_equal(window_x, np.arange(len(x_offsets)))
+
+    # number of band rows read per call, a multiple of the block height
+    block_rows = band.GetBlockSize()[1]
+    window_rows = max(window_cells // (x_max - x_min), 1)
+    window_rows = max(window_rows // block_rows, 1) * block_rows
+
+    y_min = y_offsets[y_valid].min()
+    y_max = y_offsets[y_valid].max() + 1
+
+    # first window ends on a block boundary
+    window_start = y_min
+    window_end = min((y_min // block_rows) * block_rows + window_rows, y_max)
+    while window_start < y_max:
+        # output rows that are located in this window
+        in_window = y_valid[(y_offsets[y_valid] >= window_start) &
+                            (y_offsets[y_valid] < window_end)]
+
+        if len(in_window) > 0:
+            window = band.ReadAsArray(
+                int(x_min), int(window_start),
+                int(x_max - x_min), int(window_end - window_start))
+            window = window[y_offsets[in_window] - window_start]
+
+            if x_consecutive:
+                values[in_window] = window
             else:
-                landuse_array[i][j] = hrus1_data['nodata']
+                values[np.ix_(in_window, x_valid)] = window[:, window_x]
+
+        window_start = window_end
+        window_end = min(window_end + window_rows, y_max)
 
-    return landuse_array, (hrus1_data['cell_size'], hrus1_data['nodata'])
+    return values
 
 
 def read_raster(raster_filepath):
@@ -219,7 +352,135 @@ def get_shapefile_extent(shapefile_filepath):
     return extent
 
 
-def create_raster(array_data, original_hrus_filepath, new_hrus_filepath):
+def get_polygon_wkb(points):
+    """
+    Packs a list of (x, y) points into a single ring polygon in well-
+    known binary (little endian), which OGR reads without adding the
+    points one at a time.
+
+    Parameters
+    ----------
+    points: list
+        (x, y) points of the polygon's ring
+
+    Returns
+    -------
+    wkb: bytes
+        well-known binary polygon
+    """
+    coordinates = np.asarray(points, dtype='<f8').reshape(-1, 2)
+    if not len(coordinates):
+        # polygon without any rings
+        return struct.pack('<BII', 1, ogr.wkbPolygon, 0)
+
+    return struct.pack('<BIII', 1, ogr.wkbPolygon, 1, len(coordinates)) + \
+        coordinates.tobytes()
+
+
+def write_polygon_shapefile(output_dir, layer_name, field_names, features):
+    """
+    Writes polygons and their (real) attributes to a new shapefile.
+    The features are streamed into the layer inside a single
+    transaction, each geometry is created from well-known binary.
+
+    Parameters
+    ----------
+    output_dir: string
+        Folder the shapefile is created in
+    layer_name: string
+        Name of the shapefile (without the extension)
+    field_names: list
+        Names of the attributes
+    features: iterable
+        (points, attribute values) for each polygon, the values are in
+        the same order as field_names
+    """
+    # set up the shapefile driver and create the data source
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    data_source = driver.CreateDataSource(output_dir)
+
+    # create the layer and add the attributes
+    layer = data_source.CreateLayer(layer_name, None, ogr.wkbPolygon)
+    for field_name in field_names:
+        layer.CreateField(ogr.FieldDefn(str(field_name), ogr.OFTReal))
+    layer_defn = layer.GetLayerDefn()
+
+    layer.StartTransaction()
+    for points, values in features:
+        feature = ogr.Feature(layer_defn)
+        for field_index, value in enumerate(values):
+            # values are given to GDAL unchanged (e.g. text becomes 0),
+            # missing values are written as null
+            if value is None:
+                feature.SetFieldNull(field_index)
+            else:
+                feature.SetField(field_index, value)
+        feature.SetGeometryDirectly(
+            ogr.CreateGeometryFromWkb(get_polygon_wkb(points)))
+        layer.CreateFeature(feature)
+    layer.CommitTransaction()
+
+    # closing the data source flushes it to disk
+    data_source = None
+
+
+def join_shapefile_attributes(shapefile_filepath, key_field, keys, columns):
+    """
+    Adds (real) attributes to an existing shapefile, matching each
+    feature to its values by a key attribute (e.g. HRU_ID) instead of
+    by feature order. Every column is written in the same pass over
+    the features inside a single transaction. Features whose key is
+    not found are left without a value.
+
+    Parameters
+    ----------
+    shapefile_filepath: string
+        Filepath to the shapefile, it is updated in place
+    key_field: string
+        Name of the attribute holding each feature's key
+    keys: array
+        Key for each position in the column values
+    columns: dict
+        Values (in the same order as keys) by new attribute name
+    """
+    data_source = ogr.Open(shapefile_filepath, 1)
+    if data_source is None:
+        raise RuntimeError('Unable to open ' + shapefile_filepath)
+    layer = data_source.GetLayer()
+
+    # create the new attributes and look up their positions once
+    for field_name in columns:
+        layer.CreateField(ogr.FieldDefn(str(field_name), ogr.OFTReal))
+    layer_defn = layer.GetLayerDefn()
+    key_index = layer_defn.GetFieldIndex(key_field)
+    if key_index < 0:
+        raise ValueError(
+            'Unable to find ' + key_field + ' in ' + shapefile_filepath)
+    field_indexes = [layer_defn.GetFieldIndex(str(field_name))
+                     for field_name in columns]
+
+    # position of each key's values
+    positions = dict(zip(np.asarray(keys).tolist(), range(len(keys))))
+    values = np.column_stack(
+        [np.asarray(column, dtype=float) for column in columns.values()])
+
+    layer.StartTransaction()
+    layer.ResetReading()
+    for feature in layer:
+        position = positions.get(feature.GetField(key_index))
+        if position is None:
+            continue
+        for field_index, value in zip(field_indexes, values[position]):
+            feature.SetField(field_index, float(value))
+        layer.SetFeature(feature)
+    layer.CommitTransaction()
+
+    # closing the data source flushes it to disk
+    data_source = None
+
+
+def create_raster(array_data, original_hrus_filepath, new_hrus_filepath,
+                  nodata_value=None, **geotiff_options):
     """
     Takes the numpy array hrus, array of non-dominant hrus have
     been merged with nearby dominant hrus, and creates a new
@@ -235,6 +496,11 @@ def create_raster(array_data, original_hrus_filepath, new_hrus_filepath):
         Filepath to the uploaded hrus1 (w001001.adf) raster
     new_hrus_filepath: string
         Filepath for the new hrus raster this method creates
+    nodata_value: float
+        NoData value assigned to the new raster, None leaves it unset
+    geotiff_options: keyword arguments
+        compress, tiled, predictor and num_threads passed on to
+        get_geotiff_options
 
     Returns
     -------
@@ -263,48 +529,172 @@ def create_raster(array_data, original_hrus_filepath, new_hrus_filepath):
         rows,
         1,
         datatype,
-        options=['COMPRESS=LZW'])
+        options=get_geotiff_options(**geotiff_options))
     # update geotransform and projection to match the original hrus raster
     new_hrus.SetGeoTransform(geotransform)
     new_hrus.SetProjection(proj)
+    if nodata_value is not None:
+        new_hrus.GetRasterBand(1).SetNoDataValue(nodata_value)
     # write the updated hrus array to the newly created geotiff file
     new_hrus.GetRasterBand(1).WriteArray(array_data)
     # flush raster data cache - recovers memory used in this process
     new_hrus.FlushCache()
 
 
-def convert_adf_to_tif(raster_filepath, output_filepath):
+def get_geotiff_options(compress=GTIFF_COMPRESS, tiled=GTIFF_TILED,
+                        predictor=GTIFF_PREDICTOR,
+                        num_threads=GDAL_NUM_THREADS):
+    """
+    Builds the GDAL creation options for a geotiff.
+
+    Parameters
+    ----------
+    compress: string
+        Compression method (e.g. LZW, DEFLATE or NONE)
+    tiled: bool
+        Write the raster in tiles instead of strips
+    predictor: int
+        Predictor for LZW/DEFLATE compression (2 for integer and
+        3 for floating point rasters), None leaves it out
+    num_threads: string
+        Number of threads used to compress the raster (e.g. ALL_CPUS),
+        None leaves it out
+
+    Returns
+    -------
+    options: list
+        GDAL creation options
+    """
+    options = ['COMPRESS=' + compress]
+    if tiled:
+        options.append('TILED=YES')
+    if predictor:
+        options.append('PREDICTOR=' + str(predictor))
+    if num_threads:
+        options.append('NUM_THREADS=' + str(num_threads))
+
+    return options
+
+
+def get_source_fingerprint(source_filepath, exclude_filepath=None):
+    """
+    Size (bytes) and latest modification time of a raster source. For a
+    folder (e.g. an Esri grid) the sizes of its files are added up and
+    the latest modification time among them is used.
+
+    Parameters
+    ----------
+    source_filepath: string
+        Filepath to the raster file or folder
+    exclude_filepath: string
+        File in the folder to leave out (e.g. a geotiff converted into
+        the grid's own folder)
+
+    Returns
+    -------
+    size, mtime: tuple of strings
+        Size and modification time of the source
+    """
+    if os.path.isdir(source_filepath):
+        filepaths = [os.path.join(source_filepath, filename)
+                     for filename in sorted(os.listdir(source_filepath))]
+        stats = [os.stat(filepath) for filepath in filepaths
+                 if os.path.isfile(filepath) and not (
+                     exclude_filepath and
+                     os.path.abspath(filepath) ==
+                     os.path.abspath(exclude_filepath))]
+    else:
+        stats = [os.stat(source_filepath)]
+
+    size = sum(stat.st_size for stat in stats)
+    mtime = max([stat.st_mtime_ns for stat in stats] or [0])
+
+    return str(size), str(mtime)
+
+
+def translate_raster(source_filepath, output_filepath, nodata_value=None,
+                     **geotiff_options):
+    """
+    Converts a raster readable by GDAL (e.g. an Esri grid folder) into
+    a geotiff using GDAL's Translate in this process. The size and
+    modification time of the source are stored in the geotiff's
+    metadata, when a geotiff converted from the same unchanged source
+    already exists the conversion is skipped.
+
+    Parameters
+    ----------
+    source_filepath: string
+        Filepath to the raster file or folder
+    output_filepath: string
+        Filepath for the geotiff
+    nodata_value: float
+        NoData value assigned to the geotiff, None keeps the source's
+    geotiff_options: keyword arguments
+        compress, tiled, predictor and num_threads passed on to
+        get_geotiff_options
+
+    Returns
+    -------
+    converted: bool
+        False if an up-to-date geotiff already existed
+    """
+    source_size, source_mtime = get_source_fingerprint(
+        source_filepath, output_filepath)
+
+    if os.path.isfile(output_filepath) and \
+            os.path.getsize(output_filepath) > 0:
+        existing = gdal.Open(output_filepath)
+        if existing is not None and \
+                existing.GetMetadataItem('SOURCE_SIZE') == source_size and \
+                existing.GetMetadataItem('SOURCE_MTIME') == source_mtime:
+            return False
+        existing = None
+
+    converted = gdal.Translate(
+        output_filepath,
+        source_filepath,
+        format='GTiff',
+        noData=nodata_value,
+        creationOptions=get_geotiff_options(**geotiff_options),
+        metadataOptions=['SOURCE_SIZE=' + source_size,
+                         'SOURCE_MTIME=' + source_mtime])
+    if converted is None:
+        raise RuntimeError(
+            'Unable to convert ' + source_filepath + ' to ' + output_filepath)
+    # closing the dataset flushes it to disk
+    converted = None
+
+    return True
+
+
+def convert_adf_to_tif(raster_filepath, output_filepath, **geotiff_options):
     """
     Convert a Esri grid raster (.adf) to geotiff (.tif) raster using
-    GDAL's 'gdal_translate' utility program.
+    GDAL's Translate (see translate_raster). The conversion is skipped
+    when the geotiff is up-to-date.
 
     Parameters
     ----------
     raster_filepath: string
-        Filepath to the Esri grid raster (.adf)
+        Filepath to the Esri grid raster folder (containing w001001.adf)
 
     output_filepath: string
         Folderpath where the tif file should be written
+    geotiff_options: keyword arguments
+        compress, tiled, predictor and num_threads passed on to
+        get_geotiff_options
     Returns
     -------
     None
     """
-    adf_raster = raster_filepath + '/w001001.adf'
-
-    adf_gdal = gdal.Open(raster_filepath)
-    adf_band = adf_gdal.GetRasterBand(1)
-    adf_nodata = adf_band.GetNoDataValue()
-
-    # convert base raster into tif file
-    check_call([
-        'gdal_translate', '-co', 'compress=lzw', '-a_nodata', str(adf_nodata),
-        '-of', 'GTiff', adf_raster, output_filepath], env=env)
+    translate_raster(raster_filepath, output_filepath, **geotiff_options)
 
 
 def rasterize_shapefile(layer_info, shp_filepath, new_tif_filepath):
     """
     Takes a shapefile and converts it to a geotiff raster using
-    GDAL's gdal_rasterize utility program.
+    GDAL's Rasterize in this process (the geotiff can be written
+    to /vsimem/).
 
     Parameters
     ----------
@@ -325,17 +715,171 @@ def rasterize_shapefile(layer_info, shp_filepath, new_tif_filepath):
     cols = layer_info['extent'][0]
     rows = layer_info['extent'][1]
 
-    # use gdal_rasterize to convert shapefile into geotiff
-    check_call([
-        'gdal_rasterize',  # GDAL utility program
-        '-of', 'Gtiff',  # format
-        '-a', layer_info['attribute_name'],  # attribute name
-        '-ts', cols, rows,  # width height
-        '-ot', 'Byte',  # type
-        '-co', 'COMPRESS=LZW',  # compression
-        '-l', layer_info['layername'],  # layername
-        shp_filepath, new_tif_filepath],
-    env=env)  # shapefile, new raster
+    # rasterize the attribute's values into a byte geotiff
+    rasterized = gdal.Rasterize(
+        new_tif_filepath,
+        shp_filepath,
+        format='GTiff',
+        attribute=layer_info['attribute_name'],
+        width=int(cols),
+        height=int(rows),
+        outputType=gdal.GDT_Byte,
+        creationOptions=get_geotiff_options(),
+        layers=[layer_info['layername']])
+    if rasterized is None:
+        raise RuntimeError('Unable to rasterize ' + shp_filepath)
+    # closing the dataset flushes it to disk
+    rasterized = None
+
+
+def rasterize_polygon_labels(shapefile_filepath, like_raster_filepath,
+                             all_touched=False):
+    """
+    Burns the polygons of a shapefile into a label raster aligned to
+    another raster (e.g. hrus1) in one pass. Each cell gets the FID +
+    1 of the polygon it belongs to (polygons later in the shapefile
+    win where they overlap) and 0 outside of the polygons.
+
+    Parameters
+    ----------
+    shapefile_filepath: string
+        Filepath to the polygon shapefile
+    like_raster_filepath: string
+        Filepath to the raster whose extent, resolution and projection
+        the labels are aligned to
+    all_touched: bool
+        False labels the cells whose centre is inside a polygon, True
+        labels every cell touched by a polygon
+
+    Returns
+    -------
+    labels: array
+        Polygon label for each raster cell
+    """
+    like_raster = gdal.Open(like_raster_filepath)
+
+    labels = gdal.GetDriverByName('MEM').Create(
+        '', like_raster.RasterXSize, like_raster.RasterYSize, 1,
+        gdal.GDT_Int32)
+    labels.SetGeoTransform(like_raster.GetGeoTransform())
+    labels.SetProjection(like_raster.GetProjection())
+
+    layer_name = os.path.splitext(os.path.basename(shapefile_filepath))[0]
+    rasterized = gdal.Rasterize(
+        labels,
+        shapefile_filepath,
+        SQLStatement='SELECT FID + 1 AS label FROM "' + layer_name + '"',
+        attribute='label',
+        allTouched=all_touched)
+    if rasterized != 1:
+        raise RuntimeError('Unable to rasterize ' + shapefile_filepath)
+
+    return labels.GetRasterBand(1).ReadAsArray()
+
+
+def get_raster_nbytes(raster_filepath):
+    """
+    Uncompressed size (bytes) of a raster's first band.
+    """
+    raster = gdal.Open(raster_filepath)
+    band = raster.GetRasterBand(1)
+
+    return raster.RasterXSize * raster.RasterYSize * \
+        gdal.GetDataTypeSize(band.DataType) // 8
+
+
+class RasterWorkspace(object):
+    """
+    Place for a task's intermediate rasters (e.g. converted landuse
+    layers) that are only read back by the task itself. Rasters are
+    kept in GDAL's in-memory filesystem (/vsimem/) until the memory
+    limit is reached, after that they are written to the disk folder.
+    Close the workspace when the task ends to free everything it holds.
+
+    Parameters
+    ----------
+    disk_dir: string
+        Folder for the rasters that do not fit in memory, created
+        when it is first needed
+    memory_limit: int
+        Total bytes (uncompressed) of rasters kept in memory
+    """
+
+    def __init__(self, disk_dir, memory_limit=RASTER_WORKSPACE_MEMORY_LIMIT):
+        self.disk_dir = disk_dir
+        self.memory_limit = memory_limit
+        self.memory_dir = '/vsimem/' + uuid.uuid4().hex
+        self.memory_used = 0
+        self.filepaths = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def create_filepath(self, filename, nbytes=0):
+        """
+        Returns the filepath for a new intermediate raster, in memory
+        when it fits under the memory limit and on disk otherwise.
+
+        Parameters
+        ----------
+        filename: string
+            Name of the raster file (e.g. hrus1.tif)
+        nbytes: int
+            Expected uncompressed size of the raster
+
+        Returns
+        -------
+        filepath: string
+            Filepath to write the raster to
+        """
+        if self.memory_used + nbytes <= self.memory_limit:
+            filepath = self.memory_dir + '/' + filename
+            self.memory_used += nbytes
+        else:
+            if not os.path.exists(self.disk_dir):
+                os.makedirs(self.disk_dir)
+            filepath = os.path.join(self.disk_dir, filename)
+            nbytes = 0
+        self.filepaths[filepath] = nbytes
+
+        return filepath
+
+    def create_filepath_like(self, filename, raster_filepath):
+        """
+        Same as create_filepath for a raster the size of an existing
+        raster (e.g. the source of a conversion).
+        """
+        return self.create_filepath(
+            filename, get_raster_nbytes(raster_filepath))
+
+    def release(self, filepath):
+        """
+        Deletes an intermediate raster that is no longer needed.
+        """
+        nbytes = self.filepaths.pop(filepath, 0)
+        delete_raster(filepath)
+        self.memory_used -= nbytes
+
+    def close(self):
+        """
+        Deletes every intermediate raster.
+        """
+        for filepath in list(self.filepaths):
+            self.release(filepath)
+
+
+def delete_raster(filepath):
+    """
+    Deletes a raster file from /vsimem/ or from disk, if it exists.
+    """
+    if filepath.startswith('/vsimem/'):
+        if gdal.VSIStatL(filepath) is not None:
+            gdal.Unlink(filepath)
+    elif os.path.isfile(filepath):
+        os.remove(filepath)
 
 
 def matplotlib_pip(points, polygon):
@@ -357,3 +901,179 @@ def matplotlib_pip(points, polygon):
     boolean list the same size as the points list
     """
     return polygon.contains_points(points)
+
+
+class PolygonBoundsIndex(object):
+    """
+    Spatial index over the bounding boxes of a set of polygons (e.g.
+    the fields in a user's shapefile). The bounding boxes are bucketed
+    into a uniform grid so the polygons near a location can be found
+    without checking every polygon, and each polygon's bounding box can
+    be clipped to the window of raster cells it covers.
+
+    Parameters
+    ----------
+    polygons: list
+        Each polygon is a list (or array) of (x, y) points
+    bucket_size: float
+        Width and height of the grid buckets, by default chosen so
+        there is about one polygon per bucket
+
+    Attributes
+    ----------
+    bounds: array
+        xmin, ymin, xmax, ymax for each polygon
+    """
+
+    def __init__(self, polygons, bucket_size=None):
+        self.bounds = np.array(
+            [np.concatenate((np.min(points, axis=0), np.max(points, axis=0)))
+             for points in (np.asarray(polygon, dtype=float)
+                            for polygon in polygons)]).reshape(-1, 4)
+
+        if len(self.bounds):
+            self.origin = self.bounds[:, :2].min(axis=0)
+            extent = self.bounds[:, 2:].max(axis=0) - self.origin
+        else:
+            self.origin = np.zeros(2)
+            extent = np.zeros(2)
+        if bucket_size is None:
+            bucket_size = np.sqrt(
+                max(extent[0] * extent[1], 1.0) / max(len(self.bounds), 1))
+        self.bucket_size = float(bucket_size) or 1.0
+        self.bucket_counts = (extent // self.bucket_size).astype(int) + 1
+
+        # every (bucket, polygon) pair where the polygon's bounding box
+        # overlaps the bucket, grouped by bucket
+        first = self.get_buckets(self.bounds[:, :2])
+        last = self.get_buckets(self.bounds[:, 2:])
+        widths = last[:, 0] - first[:, 0] + 1
+        heights = last[:, 1] - first[:, 1] + 1
+        sizes = widths * heights
+        polygon_ids = np.repeat(np.arange(len(self.bounds)), sizes)
+        offsets = np.arange(sizes.sum()) - np.repeat(
+            np.cumsum(sizes) - sizes, sizes)
+        bucket_x = first[polygon_ids, 0] + offsets % widths[polygon_ids]
+        bucket_y = first[polygon_ids, 1] + offsets // widths[polygon_ids]
+        buckets = bucket_y * self.bucket_counts[0] + bucket_x
+
+        order = np.argsort(buckets, kind='stable')
+        self.polygon_ids = polygon_ids[order]
+        self.starts = np.concatenate(([0], np.cumsum(np.bincount(
+            buckets, minlength=self.bucket_counts.prod()))))
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def get_buckets(self, points):
+        """
+        Column and row of the grid bucket each point falls in (clipped
+        to the grid).
+        """
+        buckets = ((np.asarray(points, dtype=float) - self.origin) //
+                   self.bucket_size).astype(int)
+        return np.clip(buckets, 0, self.bucket_counts - 1)
+
+    def query(self, bbox):
+        """
+        Finds the polygons whose bounding box intersects a bounding box.
+
+        Parameters
+        ----------
+        bbox: list
+            xmin, ymin, xmax, ymax of the area to search
+
+        Returns
+        -------
+        polygon_ids: array
+            Sorted positions of the polygons in the index
+        """
+        first, last = self.get_buckets([bbox[:2], bbox[2:]])
+        candidates = [
+            self.polygon_ids[self.starts[bucket]:self.starts[bucket + 1]]
+            for row in range(first[1], last[1] + 1)
+            for bucket in range(row * self.bucket_counts[0] + first[0],
+                                row * self.bucket_counts[0] + last[0] + 1)]
+        candidates = np.unique(np.concatenate(
+            candidates or [np.array([], dtype=int)]))
+
+        # drop candidates that share a bucket but don't intersect
+        bounds = self.bounds[candidates]
+        intersects = (bounds[:, 0] <= bbox[2]) & (bounds[:, 2] >= bbox[0]) & \
+            (bounds[:, 1] <= bbox[3]) & (bounds[:, 3] >= bbox[1])
+
+        return candidates[intersects]
+
+    def get_raster_windows(self, x_axis, y_axis):
+        """
+        Clips each polygon's bounding box to the window of raster cells
+        whose coordinates are inside of it.
+
+        Parameters
+        ----------
+        x_axis: array
+            x coordinate of each raster column (ascending)
+        y_axis: array
+            y coordinate of each raster row (descending)
+
+        Returns
+        -------
+        windows: array
+            row start, row end, column start and column end (exclusive)
+            for each polygon
+        """
+        # y coordinates decrease with each row, flip them for searching
+        y_axis_ascending = -np.asarray(y_axis)
+
+        return np.column_stack((
+            np.searchsorted(y_axis_ascending, -self.bounds[:, 3], 'left'),
+            np.searchsorted(y_axis_ascending, -self.bounds[:, 1], 'right'),
+            np.searchsorted(x_axis, self.bounds[:, 0], 'left'),
+            np.searchsorted(x_axis, self.bounds[:, 2], 'right')))
+
+
+def label_polygon_cells(polygons, x_axis, y_axis, polygon_index=None):
+    """
+    Labels the raster cells located in each polygon with the polygon's
+    position + 1 (later polygons win where they overlap) using point in
+    polygon tests. Each polygon is only tested against the cells inside
+    of its bounding box window.
+
+    Parameters
+    ----------
+    polygons: list
+        Each polygon is a list (or array) of (x, y) points
+    x_axis: array
+        x coordinate of each raster column (ascending)
+    y_axis: array
+        y coordinate of each raster row (descending)
+    polygon_index: PolygonBoundsIndex
+        Index over the polygons, built when not provided
+
+    Returns
+    -------
+    labels: array
+        Polygon label for each raster cell (0 outside of the polygons)
+    """
+    if polygon_index is None:
+        polygon_index = PolygonBoundsIndex(polygons)
+
+    labels = np.zeros((len(y_axis), len(x_axis)), dtype=int)
+    windows = polygon_index.get_raster_windows(x_axis, y_axis)
+    for i, (polygon, window) in enumerate(zip(polygons, windows)):
+        row_start, row_end, col_start, col_end = window
+        if row_start >= row_end or col_start >= col_end:
+            continue
+
+        # cell coordinates inside the bounding box
+        window_x, window_y = np.meshgrid(
+            x_axis[col_start:col_end], y_axis[row_start:row_end])
+        window_xy = np.column_stack((window_x.ravel(), window_y.ravel()))
+
+        # matplotlib_pip returns a boolean list - True means in the poly
+        in_poly = matplotlib_pip(window_xy, Path(polygon)).reshape(
+            window_x.shape)
+
+        labels[row_start:row_end, col_start:col_end][in_poly] = i + 1
+
+    return labels
@@ -1,9 +1,11 @@
 import csv
-import math
 import numpy as np
 import os
 import shutil
 import sys
+import tempfile
+
+from billiard.pool import Pool
 
 from django.conf import settings
 from django.core.mail import send_mail
@@ -17,6 +19,71 @@ from swatusers.models import UserTask
 sys.path.insert(0, os.path.join(settings.PROJECT_DIR, "swatluu"))
 
 
+def prepare_landuse_layer(layer_path, converted_layer_path, hrus1_path,
+                          hru_index, hru_landuse_codes, hru_attributes,
+                          receivers):
+    """
+    Converts a landuse layer to a .tif, samples it at the hrus1 cells
+    and finds the cells that have to move to another hru. This is the
+    part of the fractional area calculation that does not depend on
+    the random draws, so layers can be prepared in parallel.
+
+    Parameters
+    ----------
+    layer_path: string
+        Path to the uploaded landuse layer (.adf grid)
+    converted_layer_path: string
+        Path the converted .tif is written to (deleted after sampling)
+    hrus1_path: string
+        Path to the hrus1 grid folder
+    hru_index: HruPixelIndex
+        Index of the cells that belong to each dominant hru
+    hru_landuse_codes: array
+        landuse code of each hru (ordered by hru index)
+    hru_attributes: array
+        attributes a receiver must share with the donor
+    receivers: HruReceiverLookup
+        Lookup of receiver hrus
+
+    Returns
+    -------
+    transfers: tuple of arrays
+        transfers returned by swattools.find_landuse_transfers
+    """
+    geotools.convert_adf_to_tif(layer_path, converted_layer_path)
+
+    landuse_layer_raster, layer_info = geotools.create_raster_array(
+        hrus1_path, converted_layer_path)
+    # the converted layer is not needed once it has been sampled
+    geotools.delete_raster(converted_layer_path)
+
+    return swattools.find_landuse_transfers(
+        hru_index,
+        hru_index.gather(landuse_layer_raster),
+        hru_landuse_codes,
+        hru_attributes,
+        receivers,
+        layer_info[1])
+
+
+def prepare_landuse_layer_from_shared_inputs(shared_dir, layer_path,
+                                             converted_layer_path, hrus1_path):
+    """
+    Runs prepare_landuse_layer in a worker process with the hru index,
+    the hru landuse codes and attributes and the receivers memory-mapped
+    from shared_dir (see SWATLUUProcess.save_shared_layer_inputs).
+    """
+    return prepare_landuse_layer(
+        layer_path, converted_layer_path, hrus1_path,
+        swattools.HruPixelIndex.load(os.path.join(shared_dir, 'hru_index')),
+        np.load(os.path.join(shared_dir, 'hru_landuse_codes.npy'),
+                mmap_mode='r'),
+        np.load(os.path.join(shared_dir, 'hru_attributes.npy'),
+                mmap_mode='r'),
+        swattools.HruReceiverLookup.load(
+            os.path.join(shared_dir, 'receivers')))
+
+
 class SWATLUUProcess(object):
     def __init__(self, logger, data=""):
         """
@@ -62,12 +129,17 @@ class SWATLUUProcess(object):
         self.hrus = []
         self.dominant_hrus = []
         self.hru_info = ()
-        self.inside_watershed_indexes = []
-        self.hru_indexes = []
+        self.hru_index = None
         self.old_hru_areas = []
         self.hru_files_data = []
         self.unique_subbasin_ids = []
         self.tool_name = 'SWAT LUU'
+        self.layer_workers = settings.SWATLUU_LAYER_WORKERS
+
+        # intermediate rasters (converted hrus1 and landuse layers)
+        self.raster_workspace = geotools.RasterWorkspace(
+            os.path.join(self.process_root_dir, 'RasterWorkspace'))
+        self.hrus1_tif_filepath = ''
 
         self.logger = logger
 
@@ -123,9 +195,11 @@ class SWATLUUProcess(object):
 
         # convert hrus1 grid to tif
         try:
+            self.hrus1_tif_filepath = \
+                self.raster_workspace.create_filepath_like(
+                    'hrus1.tif', self.output_dir + '/Raster/hrus1')
             geotools.convert_adf_to_tif(
-                self.output_dir + '/Raster/hrus1',
-                self.output_dir + '/Raster/hrus1/hrus1.tif')
+                self.output_dir + '/Raster/hrus1', self.hrus1_tif_filepath)
         except Exception as e:
             self.logger.error(str(e))
             self.logger.error('Unable to convert raster from .adf to .tif.')
@@ -244,18 +318,6 @@ class SWATLUUProcess(object):
             layer_name = self.landuse_layers_names[layer_index]
             landuse_layers_data.append([month, day, year, layer_name])
 
-            # convert landuse files to tiff files
-            layer_path = self.landuse_dir + '/' + layer_name
-            converted_layer_path = self.output_dir + '/Raster/' + layer_name + '.tif'
-            try:
-                geotools.convert_adf_to_tif(layer_path, converted_layer_path)
-            except Exception as e:
-                self.logger.error(str(e))
-                self.logger.error(
-                    'Unable to convert raster from .adf to .tif.')
-                UserTask.objects.filter(task_id=self.task_id).update(
-                    task_status=2)
-
             # write the date and file into lup.dat
             self.logger.info(
                 'Adding landuse layer, ' + layer_name + ', to lup.dat.')
@@ -337,8 +399,7 @@ class SWATLUUProcess(object):
         """
         self.logger.info('Reading hrus1.tif into numpy array.')
         try:
-            hrus, hru_info = geotools.read_raster(
-                self.output_dir + '/Raster/hrus1/hrus1.tif')
+            hrus, hru_info = geotools.read_raster(self.hrus1_tif_filepath)
         except Exception as e:
             self.logger.error(str(e))
             self.logger.error('Unable to read hrus1.tif.')
@@ -381,8 +442,14 @@ class SWATLUUProcess(object):
             # for example, dominant hru 5838 (OBJECTID) may become hru 10 (HRU_ID)
             new_hrus = sorted_hru[:, hru1_field_positions['hru_id']]
 
-            # merge non-dominant hrus into nearby dominant hrus
-            hrus = swattools.merge(hrus, dominant_hrus, hru_info[1])
+            # merge non-dominant hrus into nearby dominant hrus, reusing
+            # the merge cached by an earlier task on the same model
+            hrus, hru_index = swattools.merge_with_cache(
+                swattools.MergeCache(
+                    settings.MERGE_CACHE_DIR, settings.MERGE_CACHE_MAX_BYTES),
+                hrus, dominant_hrus, new_hrus, hru_info[1],
+                os.path.join(self.swat_dir, 'Watershed', 'Shapes', 'hru1.dbf'),
+                self.logger)
         except Exception as e:
             self.logger.error(str(e))
             self.logger.error(
@@ -403,6 +470,7 @@ class SWATLUUProcess(object):
         self.hrus = hrus
         self.dominant_hrus = dominant_hrus
         self.hru_info = hru_info
+        self.hru_index = hru_index
 
     def create_fractional_values(self):
         """
@@ -428,14 +496,9 @@ class SWATLUUProcess(object):
 
         Returns
         -------
-        inside_watershed_indexes: array
-            Array of the index positions for cells in the hrus1 raster that
-            are inside the watershed
-
-        hru_indexes: array or arrays
-            Each row in the array represents a hru and each hru has
-            an array of the index positions where it is located in the
-            hru1 raster
+        hru_index: HruPixelIndex
+            Index of the cells in the hrus1 raster that belong to each
+            dominant hru
 
         old_hru_areas: list
             Each element represents the fractional area for a hru
@@ -443,53 +506,20 @@ class SWATLUUProcess(object):
         self.logger.info(
             'Calculating fractional areas for each hru inside the watershed.')
         pixel_size = self.hru_info[0]
-        # isolate the pixels with hru values from the nodata pixels
-        inside_watershed_indexes = np.nonzero(self.hrus != self.hru_info[1])
-        inside_watershed_hrus = self.hrus[inside_watershed_indexes]
 
-        # create a text file called hru_area.txt using append mode
+        # cells inside the watershed indexed by the dominant hru they
+        # belong to (see merge_thresholds) - position k in the index is
+        # the hru at position k in the dominant hrus array
+        hru_index = self.hru_index
+
+        # create a text file called hru_area.txt
         hru_areas_file = open(self.output_dir + '/hru_areas.txt', 'w')
         # write header for file
         hru_areas_file.write('HRU_ID, HRU_AREA')
 
-        # put dominant hrus in set type
-        dominant_hrus_set = set(self.dominant_hrus)
-
-        # dictionary where each key is a dominant hru and
-        # the value is a list containing the indexes where
-        # the dominant hru appears in the watershed -
-        # found in variable inside_watershed_hrus
-
-        # initialize dictionary
-        dominant_hrus_inside_watershed_indexes = {}
-        for hru in dominant_hrus_set:
-            dominant_hrus_inside_watershed_indexes[hru] = []
-
-        # loop through hrus inside the watershed and append indexes (values)
-        # for the dominant hrus (keys)
-        for hru_index, hru_val in enumerate(inside_watershed_hrus):
-            if hru_val in dominant_hrus_set:
-                dominant_hrus_inside_watershed_indexes[hru_val].append(
-                    hru_index)
-
-        old_hru_areas = np.zeros(len(self.dominant_hrus))
-
-        # loop through dominant hrus and calculate fractional area
-        hru_indexes = []
-        for dominant_hru_index, dominant_hru_value in enumerate(
-                self.dominant_hrus):
-            # i don't understand why the next two lines are necessary....
-            hru_index = np.array(
-                dominant_hrus_inside_watershed_indexes[dominant_hru_value])
-            hru_indexes.append(hru_index)
-
-            # number of instances of the hru
-            hru_count = len(
-                dominant_hrus_inside_watershed_indexes[dominant_hru_value])
-            # convert area from square meter to acres and multiply by count
-            hru_area = (pixel_size ** 2 * 10 ** -6) * hru_count
-            # store area in array
-            old_hru_areas[dominant_hru_index] = hru_area
+        # convert area from square meter to square kilometer and
+        # multiply by the number of instances of each hru
+        old_hru_areas = hru_index.areas(pixel_size)
 
         self.logger.info('Writing fractional areas to hru_areas.txt.')
         # write fractional areas to the open file
@@ -502,8 +532,7 @@ class SWATLUUProcess(object):
         # close the text file
         hru_areas_file.close()
 
-        self.inside_watershed_indexes = inside_watershed_indexes
-        self.hru_indexes = hru_indexes
+        self.hru_index = hru_index
         self.old_hru_areas = list(old_hru_areas)
 
     def extract_hru_files_data(self):
@@ -517,10 +546,11 @@ class SWATLUUProcess(object):
         to find the numerical code for each landuse abbreviation extracted 
         from the hru files. Unique soil, slope, and subbasin codes are found
         and placed into individual arrays. Ultimately these arrays are merged
-        into a single array that is the same size as the dominant hrus array.
-        Each row in the array represents a hru and each column an attribute
-        for the hru. There are six columns (hru id, hru index range (starts
-        at 0), subbasin id, landuse code, soil code, and slope range code)
+        into a single structured array that is the same size as the dominant
+        hrus array. Each row in the array represents a hru and each field an
+        attribute for the hru. There are six fields (dominant_hru, hru_index
+        (starts at 0), subbasin, landuse_code, soil_code, and slope_code),
+        see swattools.HRU_ATTRIBUTE_DTYPE
 
         Parameters
         ----------
@@ -536,8 +566,8 @@ class SWATLUUProcess(object):
         Returns
         -------
         hru_files_data: array
-            Each row represents a hru and each column a attribute associated
-            with the hru - see description for more information on the columns
+            Each row represents a hru and each field a attribute associated
+            with the hru - see description for more information on the fields
 
         unique_subbasin_ids: array
             Array of the watershed's unique subbasin ids
@@ -550,9 +580,6 @@ class SWATLUUProcess(object):
             # separate out the different attribute lists
             hru_ids_from_hru_files = hru_files_read[0]
             subbasin_ids_from_hru_files = hru_files_read[1]
-            landuse_abbrevs_from_hru_files = hru_files_read[2]
-            soil_codes_from_hru_files = hru_files_read[3]
-            slope_ranges_from_hru_files = hru_files_read[4]
         except Exception as e:
             self.logger.error(str(e))
             self.logger.error('Unable to read the hru files in TxtInOut.')
@@ -571,41 +598,14 @@ class SWATLUUProcess(object):
 
         self.logger.info(
             'Collecting subbasin ids, landuse codes, soil codes, slope ranges, and subbasin ids.')
-        # get each hru's landuse code
-        landuse_codes = np.zeros(len(landuse_abbrevs_from_hru_files), int)
-        for code_index in range(0, len(self.lookup_info) - 1):
-            landuse_codes[np.nonzero(np.array(landuse_abbrevs_from_hru_files) ==
-                                     self.lookup_info[code_index + 1][1])] = \
-                self.lookup_info[code_index + 1][0]
-
-        # get each hru's soil code
-        unique_soil_codes = list(set(soil_codes_from_hru_files))
-        soil_codes = np.zeros(len(soil_codes_from_hru_files), int)
-        for i in range(0, len(unique_soil_codes)):
-            soil_codes[np.nonzero(
-                np.array(soil_codes_from_hru_files) == unique_soil_codes[
-                    i])] = i
-
-        # get each hru's slope range
-        unique_slope_ranges = list(set(slope_ranges_from_hru_files))
-        slope_ranges = np.zeros(len(slope_ranges_from_hru_files), int)
-        for i in range(0, len(unique_slope_ranges)):
-            slope_ranges[np.nonzero(
-                np.array(slope_ranges_from_hru_files) == unique_slope_ranges[
-                    i])] = i
-
         # get unique subbasin ids
-        unique_subbasin_ids = list(set(subbasin_ids_from_hru_files))
+        unique_subbasin_ids = np.unique(subbasin_ids_from_hru_files).tolist()
 
         self.logger.info('Packing hru information into a single array.')
-        # put all this hru info into a single array
-        hru_files_data = np.transpose([
-            self.dominant_hrus,
-            range(0, len(hru_ids_from_hru_files)),
-            subbasin_ids_from_hru_files,
-            landuse_codes,
-            soil_codes,
-            slope_ranges])
+        # landuse abbreviations are looked up once per unique abbreviation
+        # and the soil and slope codes come from np.unique
+        hru_files_data = swattools.create_hru_attribute_table(
+            self.dominant_hrus, hru_files_read, self.lookup_info)
 
         self.hru_files_data = hru_files_data
         self.unique_subbasin_ids = unique_subbasin_ids
@@ -626,14 +626,9 @@ class SWATLUUProcess(object):
             List where each row is a landuse layer and the four columns
             are the (1) month, (2) day, (3) year, and (4) layer name
 
-        inside_watershed_indexes: array
-            Array of the index positions for cells in the hrus1 raster that
-            are inside the watershed
-
-        hru_indexes: array or arrays
-            Each row in the array represents a hru and each hru has
-            an array of the index positions where it is located in the
-            hru1 raster
+        hru_index: HruPixelIndex
+            Index of the cells in the hrus1 raster that belong to each
+            dominant hru
 
         old_hru_areas: list
             Each element represents the fractional area for a hru
@@ -658,109 +653,50 @@ class SWATLUUProcess(object):
         np.random.seed(0)
         pixel_size = self.hru_info[0]
         self.logger.info('Calculating the new fractional hru areas.')
+
+        # receivers are keyed by subbasin, soil and landuse code
+        hru_attributes = np.column_stack((
+            self.hru_files_data['subbasin'], self.hru_files_data['soil_code']))
+        receivers = swattools.HruReceiverLookup(np.column_stack(
+            (hru_attributes, self.hru_files_data['landuse_code'])))
+        hru_subbasin_ids = swattools.encode_categories(
+            self.hru_files_data['subbasin'])
+
         self.logger.info('Begin looping through landuse layers.\n\n')
+        # layers are converted, sampled and searched for cells with a new
+        # landuse in order (or in parallel), the random receiver picks are
+        # made here in layer order so the output does not depend on the
+        # number of workers
+        layers_transfers = self.prepare_landuse_layers(
+            hru_attributes, receivers)
         # loop through each selected landuse layer
         for landuse_layer_index, landuse_layer in enumerate(
                 self.landuse_layers_data):
             self.logger.info('LANDUSE LAYER: ' + landuse_layer[3])
-            # read current landuse layer's raster file
-            self.logger.info('Reading landuse layer into numpy array.')
             try:
-                landuse_layer_raster, layer_info = geotools.create_raster_array(
-                    self.output_dir + '/Raster/hrus1',
-                    self.output_dir + '/Raster/' + landuse_layer[3] + '.tif')
-                # get the nodata value
-                landuse_layer_nodata = layer_info[1]
+                transfers = next(layers_transfers)
             except Exception as e:
                 self.logger.error(str(e))
                 self.logger.error('Unable to read landuse layer.')
                 UserTask.objects.filter(task_id=self.task_id).update(
                     task_status=2)
-
-            # get indexes for the parts of the current landuse layer inside the watershed
-            landuse_layer_values_inside_watershed = landuse_layer_raster[
-                self.inside_watershed_indexes]
-
-            # loop through our hru indexes and get the landuse values at those indexes
-            landuse_layer_values_in_relation_to_hrus = []
-            for hru_index in self.hru_indexes:
-                landuse_layer_values_in_relation_to_hrus.append(
-                    landuse_layer_values_inside_watershed[hru_index])
-
-            # updating areas based on this landuse layer
-            new_hru_areas = list(self.old_hru_areas)
-            self.logger.info('Begin looping through each hru.')
-            # loop through each hru
-            for hru in self.hru_files_data:
-                # find and sort unique landuse codes
-                unique_landuse_codes = list(
-                    set(landuse_layer_values_in_relation_to_hrus[hru[1]]))
-                unique_landuse_codes.sort()
-
-                donor_hru_info = hru[2:6]
-                # loop through each unique landuse code
-                for landuse_code in unique_landuse_codes:
-                    if (landuse_code != donor_hru_info[1]) & \
-                            (landuse_code != landuse_layer_nodata):
-                        # get a count of the instances of the
-                        # current landuse code in the current hru
-                        landuse_code_count = len((np.nonzero(
-                            landuse_layer_values_in_relation_to_hrus[
-                                hru[1]] == landuse_code)[0]))
-
-                        # identify potential receiver hrus
-                        potential_receiver_hrus_one = self.hru_files_data[
-                            np.where(
-                                self.hru_files_data[:, 3] == landuse_code)]
-
-                        potential_receiver_hrus_two = \
-                            potential_receiver_hrus_one[np.where(
-                                potential_receiver_hrus_one[:, 4] == donor_hru_info[
-                                    2])]
-
-                        potential_receiver_hrus_one = \
-                            potential_receiver_hrus_two[np.where(
-                                potential_receiver_hrus_two[:, 2] == donor_hru_info[
-                                    0])]
-
-                        if len(potential_receiver_hrus_one) != 0:
-                            receiver_hru = math.ceil(np.random.rand() * (
-                                len(potential_receiver_hrus_one)))
-                            new_hru_areas[
-                                potential_receiver_hrus_one[receiver_hru - 1][
-                                    1]] = new_hru_areas[
-                                potential_receiver_hrus_one[
-                                    receiver_hru - 1][1]] + (
-                                landuse_code_count * (
-                                    pixel_size ** 2 * 10 ** -6))
-
-                            if new_hru_areas[hru[1]] > (landuse_code_count * (
-                                    pixel_size ** 2 * 10 ** -6)):
-                                new_hru_areas[hru[1]] = new_hru_areas[
-                                    hru[1]] - (
-                                    landuse_code_count * (
-                                        pixel_size ** 2 * 10 ** -6))
-                            else:
-                                new_hru_areas[hru[1]] = 0
-                        else:
-                            # do something
-                            pass
-
-            # initiate a variable to store hru fractional area
-            fractional_hru_areas = np.zeros(len(new_hru_areas))
-            hru_areas = np.array(new_hru_areas)
-
-            self.logger.info(
-                'Loop through each subbasin and update fractional areas.')
-            for subbasin_id in self.unique_subbasin_ids:
-                # create array where each row is a hru and the column is the subbasin id
-                hru_subbasins = np.array(self.hru_files_data[:, -4])
-                # find indexes in hru subbasins array where the value matches the current subbasin id
-                hru_subbasins_matching_subbasin_id = np.nonzero(
-                    hru_subbasins == subbasin_id)
-                fractional_hru_areas[hru_subbasins_matching_subbasin_id] = \
-                    hru_areas[hru_subbasins_matching_subbasin_id] / sum(
-                    hru_areas[hru_subbasins_matching_subbasin_id])
+                raise
+
+            # move cells with a new landuse into hrus in the same
+            # subbasin with the same soil and the new landuse
+            self.logger.info('Reallocating cells with a new landuse.')
+            new_hru_cell_counts = swattools.apply_landuse_transfers(
+                self.hru_index.counts,
+                transfers,
+                receivers,
+                np.random.rand(len(transfers[0])))
+            hru_areas = (pixel_size ** 2 * 10 ** -6) * new_hru_cell_counts
+
+            self.logger.info('Update fractional areas for each subbasin.')
+            # divide each hru's area by the total area of its subbasin
+            subbasin_areas = np.bincount(
+                hru_subbasin_ids, weights=hru_areas)
+            fractional_hru_areas = hru_areas / subbasin_areas[hru_subbasin_ids]
 
             self.logger.info('Writing new fractional areas to file.\n')
             # write the new fractional areas to the file specific to this landuse layer
@@ -770,14 +706,114 @@ class SWATLUUProcess(object):
             fractional_hru_areas_file.write('HRU_ID, HRU_AREA')
             for hru in self.hru_files_data:
                 fractional_hru_areas_file.write('\n')
-                fractional_hru_areas_file.write(str(hru[1] + 1))
+                fractional_hru_areas_file.write(str(hru['hru_index'] + 1))
                 fractional_hru_areas_file.write(',  ')
-                fractional_hru_areas_file.write(
-                    str(float('{0:.6f}'.format(fractional_hru_areas[hru[1]]))))
+                fractional_hru_areas_file.write(str(float('{0:.6f}'.format(
+                    fractional_hru_areas[hru['hru_index']]))))
             fractional_hru_areas_file.close()
 
         self.logger.info('Finished calculating new fractional areas.\n\n')
 
+    def prepare_landuse_layers(self, hru_attributes, receivers):
+        """
+        Prepares each landuse layer with prepare_landuse_layer and yields
+        the transfers in layer order. With more than one layer worker
+        (SWATLUU_LAYER_WORKERS setting) the layers are prepared in a
+        billiard process pool and the hru index, landuse codes,
+        attributes and receivers are shared with the workers through
+        memory-mapped .npy files (see save_shared_layer_inputs).
+
+        Parameters
+        ----------
+        hru_attributes: array
+            attributes a receiver must share with the donor
+        receivers: HruReceiverLookup
+            Lookup of receiver hrus
+
+        Returns
+        -------
+        transfers: generator
+            transfers for each landuse layer
+        """
+        hrus1_path = self.output_dir + '/Raster/hrus1'
+        hru_landuse_codes = self.hru_files_data['landuse_code']
+        layer_paths = []
+        for landuse_layer in self.landuse_layers_data:
+            layer_path = self.landuse_dir + '/' + landuse_layer[3]
+            layer_paths.append((
+                layer_path,
+                self.raster_workspace.create_filepath_like(
+                    landuse_layer[3] + '.tif', layer_path)))
+
+        workers = min(self.layer_workers, len(layer_paths))
+        if workers <= 1:
+            for layer_path, converted_layer_path in layer_paths:
+                transfers = prepare_landuse_layer(
+                    layer_path, converted_layer_path, hrus1_path,
+                    self.hru_index, hru_landuse_codes, hru_attributes,
+                    receivers)
+                self.raster_workspace.release(converted_layer_path)
+                yield transfers
+            return
+
+        self.logger.info(
+            'Preparing landuse layers with ' + str(workers) + ' workers.')
+        shared_dir = tempfile.mkdtemp(dir=self.process_root_dir)
+        try:
+            self.save_shared_layer_inputs(
+                shared_dir, self.hru_index, hru_landuse_codes,
+                hru_attributes, receivers)
+            # billiard's pool (the one Celery uses) can be started from a
+            # daemonic prefork worker, unlike multiprocessing's pools
+            pool = Pool(processes=workers)
+            try:
+                results = [
+                    pool.apply_async(
+                        prepare_landuse_layer_from_shared_inputs,
+                        (shared_dir, layer_path, converted_layer_path,
+                         hrus1_path))
+                    for layer_path, converted_layer_path in layer_paths]
+                for result, (_, converted_layer_path) in zip(
+                        results, layer_paths):
+                    transfers = result.get()
+                    self.raster_workspace.release(converted_layer_path)
+                    yield transfers
+            finally:
+                pool.terminate()
+                pool.join()
+        finally:
+            shutil.rmtree(shared_dir, ignore_errors=True)
+
+    @staticmethod
+    def save_shared_layer_inputs(shared_dir, hru_index, hru_landuse_codes,
+                                 hru_attributes, receivers):
+        """
+        Saves the inputs every landuse layer needs as .npy files in
+        shared_dir, so the layer workers memory-map them instead of each
+        receiving a pickled copy.
+
+        Parameters
+        ----------
+        shared_dir: string
+            Path to the directory the inputs are saved in
+        hru_index: HruPixelIndex
+            Index of the cells that belong to each dominant hru
+        hru_landuse_codes: array
+            landuse code of each hru (ordered by hru index)
+        hru_attributes: array
+            attributes a receiver must share with the donor
+        receivers: HruReceiverLookup
+            Lookup of receiver hrus
+        """
+        for name, saved in (('hru_index', hru_index),
+                            ('receivers', receivers)):
+            os.makedirs(os.path.join(shared_dir, name))
+            saved.save(os.path.join(shared_dir, name))
+        np.save(os.path.join(shared_dir, 'hru_landuse_codes.npy'),
+                np.ascontiguousarray(hru_landuse_codes))
+        np.save(os.path.join(shared_dir, 'hru_attributes.npy'),
+                np.ascontiguousarray(hru_attributes))
+
     def copy_results_to_depot(self):
         """
         Copies output from process over to web directory for user's consumption.
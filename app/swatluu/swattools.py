@@ -1,12 +1,16 @@
 import os
-import glob
+import hashlib
+import shutil
+import tempfile
 
 from osgeo import gdal
 from scipy import ndimage
-from numpy.core.fromnumeric import nonzero
+import numpy as np
 
+from common.txtinout import TxtInOutIndex
 
-def merge(hrus, dominant_hrus, nodata_value):
+
+def merge(hrus, dominant_hrus, nodata_value, in_place=True):
     """
     Non-dominant HRUs are merged into neighboring dominant HRUs
     using a Euclidean allocation method. 
@@ -19,64 +23,918 @@ def merge(hrus, dominant_hrus, nodata_value):
         dominant hrus obtained from hru1.shp post-threshold
     nodata_value: float
         nodata_value for hru1.tif (carried over from original raster)
+    in_place: boolean
+        if True (default) the merged values are written back into hrus,
+        otherwise hrus is left untouched and a merged copy is returned
 
     Returns
     -------
     hrus: array
         hru raster with non-dominant hrus merged into dominant hrus
     """
+    if not in_place:
+        hrus = hrus.copy()
+
     # inside_watershed will have values for which merging step is carried
-    inside_watershed_indexes = nonzero(hrus != nodata_value)
-    outside_watershed_indexes = nonzero(hrus == nodata_value)
-
-    # copy hru values
-    hrus_test = hrus.copy()
-    # change the default nodata value to 1
-    hrus_test[outside_watershed_indexes] = 1
-    # set type increases following loop's performance
-    dominant_hrus_set = set(dominant_hrus)
-
-    # set dominant hrus to 0 and non-dominant to 1
-    for i in range(0, len(inside_watershed_indexes[0])):
-        if hrus_test[inside_watershed_indexes[0][i]][
-            inside_watershed_indexes[1][i]] in dominant_hrus_set:
-            hrus_test[inside_watershed_indexes[0][i]][
-                inside_watershed_indexes[1][i]] = 0
-        else:
-            hrus_test[inside_watershed_indexes[0][i]][
-                inside_watershed_indexes[1][i]] = 1
+    outside_watershed = hrus == nodata_value
+
+    # dominant hrus are set to False and non-dominant hrus (along with
+    # the cells outside of the watershed) to True
+    non_dominant = ~np.isin(hrus, dominant_hrus)
+    non_dominant |= outside_watershed
 
     # perform eclidean allocation, returns the indexes
     # of the nearest dominant hru
-    indexes = ndimage.distance_transform_edt(hrus_test, return_indices=True)[1]
-    # rows and columns of the indexes
-    rows = indexes[0]
-    cols = indexes[1]
+    rows, cols = ndimage.distance_transform_edt(
+        non_dominant, return_distances=False, return_indices=True)
+
+    # only non-dominant hrus inside the watershed need to be updated -
+    # dominant hrus are their own nearest dominant hru and the cells
+    # outside of the watershed are reset to nodata below
+    non_dominant &= ~outside_watershed
+    merge_indexes = np.nonzero(non_dominant)
 
     # use indexes to update non-dominant hrus with nearest dominant hru
-    for i in range(0, len(rows)):
-        for j in range(0, len(rows[0])):
-            hrus[i][j] = hrus[rows[i][j]][cols[i][j]]
+    hrus[merge_indexes] = hrus[rows[merge_indexes], cols[merge_indexes]]
 
     # reset nodata now that merging is complete
-    hrus[outside_watershed_indexes] = nodata_value
+    hrus[outside_watershed] = nodata_value
 
     return hrus
 
 
+class HruPixelIndex(object):
+    """
+    Index of the raster cells belonging to each dominant hru. The flat
+    (row-major) raster offsets of every cell inside the watershed are
+    stored in a single array sorted by hru, with each hru's cells
+    located between its start and stop offsets (CSR layout). An hru's
+    cells can therefore be fetched as a zero-copy slice.
+
+    Parameters
+    ----------
+    hrus: array
+        hru raster with non-dominant hrus merged into dominant hrus
+    dominant_hrus: array
+        dominant hrus (sorted by HRU_ID), position k in this array is
+        hru index k in the index
+    nodata_value: float
+        nodata value for the hru raster
+
+    Attributes
+    ----------
+    offsets: array
+        flat raster offsets sorted by hru (ascending within each hru)
+    labels: array
+        hru index for each entry in offsets
+    counts: array
+        number of cells in each hru
+    starts: array
+        position in offsets where each hru begins, hru k's cells are
+        located at offsets[starts[k]:starts[k + 1]]
+    shape: tuple
+        shape of the hru raster
+    """
+
+    def __init__(self, hrus, dominant_hrus, nodata_value):
+        dominant_hrus = np.asarray(dominant_hrus)
+        hru_count = len(dominant_hrus)
+
+        # flat offsets and values for cells inside the watershed
+        inside_watershed_offsets = np.flatnonzero(hrus != nodata_value)
+        inside_watershed_hrus = hrus.ravel()[inside_watershed_offsets]
+
+        # look up the position of each cell's hru in dominant_hrus
+        sorter = np.argsort(dominant_hrus, kind='stable')
+        positions = np.searchsorted(
+            dominant_hrus, inside_watershed_hrus, sorter=sorter)
+        labels = sorter[np.minimum(positions, hru_count - 1)]
+
+        # cells with a non-dominant hru are left out of the index
+        is_dominant = dominant_hrus[labels] == inside_watershed_hrus
+        labels = labels[is_dominant]
+        offsets = inside_watershed_offsets[is_dominant]
+
+        # group the offsets by hru (stable sort keeps raster order)
+        order = np.argsort(labels, kind='stable')
+        self.offsets = offsets[order]
+        self.labels = labels[order]
+        self.counts = np.bincount(labels, minlength=hru_count)
+        self.starts = np.concatenate(([0], np.cumsum(self.counts)))
+        self.shape = hrus.shape
+
+    def __len__(self):
+        return len(self.counts)
+
+    def pixels(self, hru_index):
+        """
+        Returns the flat raster offsets for the hru at position
+        hru_index in the dominant hrus.
+        """
+        return self.offsets[self.starts[hru_index]:self.starts[hru_index + 1]]
+
+    def gather(self, array):
+        """
+        Collects the values of an array (with the same shape as the hru
+        raster) at every indexed cell. The values are grouped by hru,
+        so the values for hru k are located at
+        values[starts[k]:starts[k + 1]] (see split).
+
+        Parameters
+        ----------
+        array: array
+            raster array aligned with the hru raster
+
+        Returns
+        -------
+        values: array
+            array values ordered by hru
+        """
+        return np.asarray(array).ravel()[self.offsets]
+
+    def split(self, values):
+        """
+        Splits values returned by gather into one view per hru.
+        """
+        return [values[self.starts[k]:self.starts[k + 1]]
+                for k in range(len(self.counts))]
+
+    def areas(self, pixel_size):
+        """
+        Area (km^2) of each hru calculated from its cell count.
+        """
+        return (pixel_size ** 2 * 10 ** -6) * self.counts
+
+    def save(self, directory):
+        """
+        Saves the index arrays as .npy files in directory.
+        """
+        np.save(os.path.join(directory, 'offsets.npy'), self.offsets)
+        np.save(os.path.join(directory, 'labels.npy'), self.labels)
+        np.save(os.path.join(directory, 'counts.npy'), self.counts)
+        np.save(os.path.join(directory, 'shape.npy'), np.array(self.shape))
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """
+        Loads an index saved with save. By default the offsets and
+        labels are memory-mapped so several processes can share them
+        without copying.
+
+        Parameters
+        ----------
+        directory: string
+            Path to the directory the index was saved in
+        mmap_mode: string
+            Memory-map mode passed on to np.load (None reads the
+            arrays into memory)
+
+        Returns
+        -------
+        hru_index: HruPixelIndex
+            The saved index
+        """
+        hru_index = cls.__new__(cls)
+        hru_index.offsets = np.load(
+            os.path.join(directory, 'offsets.npy'), mmap_mode=mmap_mode)
+        hru_index.labels = np.load(
+            os.path.join(directory, 'labels.npy'), mmap_mode=mmap_mode)
+        hru_index.counts = np.load(os.path.join(directory, 'counts.npy'))
+        hru_index.starts = np.concatenate(
+            ([0], np.cumsum(hru_index.counts)))
+        hru_index.shape = tuple(
+            np.load(os.path.join(directory, 'shape.npy')).tolist())
+
+        return hru_index
+
+
+class MergeCache(object):
+    """
+    Disk cache of merged hrus shared by SWAT LUU, Field SWAT and
+    Uncertainty. Merging the non-dominant hrus (see merge) only depends
+    on the hrus1 raster and hru1.shp, so each entry is keyed by a hash
+    of the hrus1 array and hru1.dbf and holds the merged hrus, the
+    dominant hrus (OBJECTID), their HRU_IDs and the HruPixelIndex as
+    .npy files that are memory-mapped when loaded. The least recently
+    used entries are deleted once the entries take up more than
+    max_bytes.
+
+    Parameters
+    ----------
+    cache_dir: string
+        Path to the directory holding the cache entries
+    max_bytes: int
+        Total size the entries are trimmed to after an entry is saved
+    """
+
+    ARRAYS = ('hrus', 'dominant_hrus', 'dominant_hru_ids')
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def get_key(self, hrus, nodata_value, hru1_dbf_filepath):
+        """
+        Hash of the hrus1 array (values, shape and nodata value) and the
+        contents of hru1.dbf.
+
+        Parameters
+        ----------
+        hrus: array
+            original hru1 raster pre-threshold
+        nodata_value: float
+            nodata value for the hru raster
+        hru1_dbf_filepath: string
+            Filepath to hru1.dbf
+
+        Returns
+        -------
+        key: string
+            Hex digest naming the cache entry
+        """
+        hrus = np.ascontiguousarray(hrus)
+        digest = hashlib.sha256()
+        digest.update(repr((hrus.shape, hrus.dtype.str, nodata_value)).encode())
+        digest.update(hrus.data)
+        with open(hru1_dbf_filepath, 'rb') as dbf_file:
+            for chunk in iter(lambda: dbf_file.read(1 << 20), b''):
+                digest.update(chunk)
+
+        return digest.hexdigest()
+
+    def get_entry_dir(self, key):
+        """ Path to the directory holding the entry for key. """
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key):
+        """
+        Loads the entry for key and marks it as recently used. The
+        merged hrus are memory-mapped copy-on-write, so changes to them
+        stay in the task's memory.
+
+        Returns
+        -------
+        merged: tuple
+            hrus, dominant_hrus, dominant_hru_ids and hru_index, None
+            when there is no entry for key
+        """
+        entry_dir = self.get_entry_dir(key)
+        try:
+            arrays = [
+                np.load(os.path.join(entry_dir, name + '.npy'),
+                        mmap_mode='c' if name == 'hrus' else None)
+                for name in self.ARRAYS]
+            hru_index = HruPixelIndex.load(
+                os.path.join(entry_dir, 'hru_index'))
+            os.utime(entry_dir)
+        except (IOError, OSError, ValueError):
+            return None
+
+        return tuple(arrays) + (hru_index,)
+
+    def save(self, key, hrus, dominant_hrus, dominant_hru_ids, hru_index):
+        """
+        Saves an entry for key and then trims the cache to max_bytes.
+        The entry is written under a temporary name and renamed so it
+        is never partial; when another task saved the same entry first
+        the copy is discarded.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temporary_dir = tempfile.mkdtemp(prefix=key + '.', dir=self.cache_dir)
+        try:
+            for name, array in zip(
+                    self.ARRAYS, (hrus, dominant_hrus, dominant_hru_ids)):
+                np.save(os.path.join(temporary_dir, name + '.npy'), array)
+            os.makedirs(os.path.join(temporary_dir, 'hru_index'))
+            hru_index.save(os.path.join(temporary_dir, 'hru_index'))
+            os.replace(temporary_dir, self.get_entry_dir(key))
+        except OSError:
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+            if not os.path.isdir(self.get_entry_dir(key)):
+                raise
+
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """
+        Deletes the least recently used entries (by the modification
+        time of their directory) until the entries take up no more than
+        max_bytes. The entry for keep is never deleted.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            # temporary directories of entries being saved are skipped
+            if '.' in name or not os.path.isdir(entry_dir):
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(root, filename))
+                for root, _, filenames in os.walk(entry_dir)
+                for filename in filenames)
+            entries.append((os.stat(entry_dir).st_mtime, name, size))
+
+        total_bytes = sum(size for _, _, size in entries)
+        for _, name, size in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(self.get_entry_dir(name), ignore_errors=True)
+            total_bytes -= size
+
+
+def merge_with_cache(merge_cache, hrus, dominant_hrus, dominant_hru_ids,
+                     nodata_value, hru1_dbf_filepath, logger=None):
+    """
+    Merges non-dominant hrus into dominant hrus (see merge) and indexes
+    the cells of each dominant hru, reusing the result from the merge
+    cache when the same hrus1 raster and hru1.shp were merged before.
+
+    Parameters
+    ----------
+    merge_cache: MergeCache
+        Cache of merged hrus
+    hrus: array
+        original hru1 raster pre-threshold
+    dominant_hrus: array
+        dominant hrus (OBJECTID) sorted by HRU_ID
+    dominant_hru_ids: array
+        HRU_ID for each dominant hru
+    nodata_value: float
+        nodata value for the hru raster
+    hru1_dbf_filepath: string
+        Filepath to hru1.dbf
+    logger: Logger
+        Logs cache hits and failures to save to the cache
+
+    Returns
+    -------
+    hrus, hru_index: tuple
+        hru raster with non-dominant hrus merged into dominant hrus and
+        the HruPixelIndex of the merged raster
+    """
+    key = merge_cache.get_key(hrus, nodata_value, hru1_dbf_filepath)
+    merged = merge_cache.load(key)
+    if merged is not None:
+        if logger:
+            logger.info('Loaded merged hrus from the merge cache.')
+        return merged[0], merged[3]
+
+    hrus = merge(hrus, dominant_hrus, nodata_value)
+    hru_index = HruPixelIndex(hrus, dominant_hrus, nodata_value)
+    try:
+        merge_cache.save(key, hrus, dominant_hrus, dominant_hru_ids, hru_index)
+    except OSError as e:
+        if logger:
+            logger.warning(
+                'Unable to save merged hrus to the merge cache: ' + str(e))
+
+    return hrus, hru_index
+
+
+class HruReceiverLookup(object):
+    """
+    Lookup of the hrus that can receive area from another hru. Hrus
+    are grouped by a key made of one or more of their attributes
+    (e.g. subbasin, landuse and soil) and the hrus sharing a key are
+    stored together sorted by hru index.
+
+    Parameters
+    ----------
+    hru_keys: array
+        Each row is an hru (ordered by hru index) and each column an
+        attribute that makes up the key
+
+    Attributes
+    ----------
+    keys: array
+        unique keys (one row per group)
+    members: array
+        hru indexes grouped by key (ascending within each group)
+    counts: array
+        number of hrus in each group
+    starts: array
+        position in members where each group begins
+    """
+
+    def __init__(self, hru_keys):
+        hru_keys = np.asarray(hru_keys)
+        self.keys, groups = np.unique(
+            hru_keys, axis=0, return_inverse=True)
+        groups = groups.ravel()
+
+        self.members = np.argsort(groups, kind='stable')
+        self.counts = np.bincount(groups, minlength=len(self.keys))
+        self.starts = np.concatenate(([0], np.cumsum(self.counts)))[:-1]
+
+    def find(self, query_keys):
+        """
+        Finds the group of receiver hrus for each query key.
+
+        Parameters
+        ----------
+        query_keys: array
+            Each row is a key with the same columns as hru_keys
+
+        Returns
+        -------
+        starts, counts: tuple of arrays
+            position of each query's receivers in members and the
+            number of receivers (0 when no hru has the key)
+        """
+        query_keys = np.asarray(query_keys)
+        # number the query keys and hru keys together so that matching
+        # keys share the same id
+        all_keys = np.concatenate((self.keys, query_keys))
+        ids = np.unique(all_keys, axis=0, return_inverse=True)[1].ravel()
+
+        group_for_id = np.full(len(all_keys), -1)
+        group_for_id[ids[:len(self.keys)]] = np.arange(len(self.keys))
+        groups = group_for_id[ids[len(self.keys):]]
+
+        found = groups >= 0
+        starts = np.zeros(len(query_keys), dtype=int)
+        counts = np.zeros(len(query_keys), dtype=int)
+        starts[found] = self.starts[groups[found]]
+        counts[found] = self.counts[groups[found]]
+
+        return starts, counts
+
+    def save(self, directory):
+        """
+        Saves the lookup arrays as .npy files in directory.
+        """
+        for name in ('keys', 'members', 'counts', 'starts'):
+            np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """
+        Loads a lookup saved with save. By default the arrays are
+        memory-mapped so several processes can share them without
+        copying.
+
+        Parameters
+        ----------
+        directory: string
+            Path to the directory the lookup was saved in
+        mmap_mode: string
+            Memory-map mode passed on to np.load (None reads the
+            arrays into memory)
+
+        Returns
+        -------
+        receivers: HruReceiverLookup
+            The saved lookup
+        """
+        receivers = cls.__new__(cls)
+        for name in ('keys', 'members', 'counts', 'starts'):
+            setattr(receivers, name, np.load(
+                os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode))
+
+        return receivers
+
+
+def find_landuse_transfers(hru_index, landuse_values, hru_landuse_codes,
+                           hru_attributes, receivers, nodata_value):
+    """
+    Finds the cells whose landuse no longer matches their hru's landuse
+    and the hrus that could receive them. There is one transfer for
+    every hru (in hru index order) and every landuse code found in its
+    cells (in ascending order) that differs from the hru's landuse and
+    has at least one receiver: an hru sharing the donor's attributes
+    and the new landuse code.
+
+    Parameters
+    ----------
+    hru_index: HruPixelIndex
+        Index of the cells that belong to each dominant hru
+    landuse_values: array
+        landuse value at each indexed cell (see HruPixelIndex.gather)
+    hru_landuse_codes: array
+        landuse code of each hru (ordered by hru index)
+    hru_attributes: array
+        Each row is an hru (ordered by hru index) and each column an
+        attribute a receiver must share with the donor
+    receivers: HruReceiverLookup
+        Lookup keyed by the hru_attributes columns followed by the
+        landuse code
+    nodata_value: float
+        nodata value for the landuse values
+
+    Returns
+    -------
+    transfers: tuple of arrays
+        donor hru, number of cells moved, and the position and number
+        of the receivers in receivers.members for each transfer
+    """
+    # count the cells for each (hru, landuse code) pair in one pass,
+    # unique returns the pairs sorted by hru and then landuse code
+    codes, code_ids = np.unique(landuse_values, return_inverse=True)
+    pairs, pair_counts = np.unique(
+        hru_index.labels * len(codes) + code_ids.ravel(),
+        return_counts=True)
+    donors = pairs // len(codes)
+    new_codes = codes[pairs % len(codes)]
+
+    # cells already matching their hru's landuse or nodata stay put
+    moves = (new_codes != hru_landuse_codes[donors]) & \
+        (new_codes != nodata_value)
+    donors = donors[moves]
+    new_codes = new_codes[moves]
+    pair_counts = pair_counts[moves]
+
+    starts, counts = receivers.find(
+        np.column_stack((hru_attributes[donors], new_codes)))
+    has_receivers = counts > 0
+
+    return (donors[has_receivers], pair_counts[has_receivers],
+            starts[has_receivers], counts[has_receivers])
+
+
+def apply_landuse_transfers(hru_cell_counts, transfers, receivers, draws):
+    """
+    Moves the cells for each transfer from the donor hru into a
+    receiver picked with the matching draw. The receiver gains the
+    cells and the donor loses them (without dropping below zero).
+
+    Parameters
+    ----------
+    hru_cell_counts: array
+        number of cells in each hru before the transfers
+    transfers: tuple of arrays
+        transfers returned by find_landuse_transfers
+    receivers: HruReceiverLookup
+        Lookup the transfers were found with
+    draws: array
+        random number in [0, 1) for each transfer
+
+    Returns
+    -------
+    cell_counts: array
+        number of cells in each hru after the transfers
+    """
+    donors, pair_counts, starts, counts = transfers
+    hru_count = len(hru_cell_counts)
+
+    # pick the receivers: ceil(rand * n) is 1-based and wraps around
+    # to the last receiver when rand is exactly 0
+    picks = np.ceil(draws * counts).astype(int) - 1
+    picks = np.mod(picks, counts)
+    receiver_hrus = receivers.members[starts + picks]
+
+    # donors are visited in hru order, so a donor has received cells
+    # from lower hrus before it gives its own cells away and receives
+    # cells from higher hrus afterwards
+    early = receiver_hrus > donors
+    received_early = np.bincount(
+        receiver_hrus[early], weights=pair_counts[early],
+        minlength=hru_count)
+    received_late = np.bincount(
+        receiver_hrus[~early], weights=pair_counts[~early],
+        minlength=hru_count)
+    donated = np.bincount(donors, weights=pair_counts, minlength=hru_count)
+
+    return np.maximum(
+        hru_cell_counts + received_early - donated, 0) + received_late
+
+
+def reallocate_landuse_cells(hru_index, landuse_values, hru_landuse_codes,
+                             hru_attributes, receivers, nodata_value):
+    """
+    Moves cells whose landuse no longer matches their hru's landuse
+    into an hru with the new landuse (see find_landuse_transfers and
+    apply_landuse_transfers).
+
+    One number is drawn from np.random for each transfer, in the order
+    the transfers are made, so results are reproducible by seeding
+    np.random.
+
+    Parameters
+    ----------
+    hru_index: HruPixelIndex
+        Index of the cells that belong to each dominant hru
+    landuse_values: array
+        landuse value at each indexed cell (see HruPixelIndex.gather)
+    hru_landuse_codes: array
+        landuse code of each hru (ordered by hru index)
+    hru_attributes: array
+        Each row is an hru (ordered by hru index) and each column an
+        attribute a receiver must share with the donor
+    receivers: HruReceiverLookup
+        Lookup keyed by the hru_attributes columns followed by the
+        landuse code
+    nodata_value: float
+        nodata value for the landuse values
+
+    Returns
+    -------
+    cell_counts: array
+        number of cells in each hru after the transfers
+    """
+    transfers = find_landuse_transfers(
+        hru_index, landuse_values, hru_landuse_codes, hru_attributes,
+        receivers, nodata_value)
+    draws = np.random.rand(len(transfers[0]))
+
+    return apply_landuse_transfers(
+        hru_index.counts, transfers, receivers, draws)
+
+
+class RealizationEngine(object):
+    """
+    Redistributes hru areas within each subbasin for the landuse error
+    realizations of the Uncertainty tool. The hrus are grouped by
+    subbasin once and each realization of a landuse code is calculated
+    for every hru at once with bincount sums over the subbasins.
+
+    For a realization with error e (%), hrus with the landuse code get
+    e% more (or less) of their fractional area and the other hrus in
+    the subbasin make up the difference in proportion to their
+    fractional areas, so each subbasin's total is unchanged.
+
+    Parameters
+    ----------
+    hru_subbasins: array
+        Subbasin id for each hru
+    hru_landuse_codes: array
+        Landuse code for each hru
+    hru_areas: array
+        Area for each hru
+
+    Attributes
+    ----------
+    subbasin_positions: array
+        Position of each hru's subbasin in the sorted unique subbasins
+    fractional_areas: array
+        Each hru's area as a fraction of its subbasin's area
+    """
+
+    def __init__(self, hru_subbasins, hru_landuse_codes, hru_areas):
+        hru_areas = np.asarray(hru_areas, dtype=float)
+        self.hru_landuse_codes = np.asarray(hru_landuse_codes)
+
+        subbasins, self.subbasin_positions = np.unique(
+            hru_subbasins, return_inverse=True)
+        self.subbasin_positions = self.subbasin_positions.ravel()
+        self.subbasin_count = len(subbasins)
+
+        subbasin_areas = self.subbasin_sums(hru_areas)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.fractional_areas = \
+                hru_areas / subbasin_areas[self.subbasin_positions]
+
+    def subbasin_sums(self, values, hrus=None):
+        """
+        Sums values (one row per realization or a single row) by
+        subbasin, optionally only for the hrus selected by the boolean
+        mask hrus.
+        """
+        values = np.asarray(values)
+        positions = self.subbasin_positions
+        if hrus is not None:
+            values = values[..., hrus]
+            positions = positions[hrus]
+        if values.ndim == 1:
+            return np.bincount(
+                positions, values, minlength=self.subbasin_count)
+
+        # offset the subbasin positions of each row to sum every row with
+        # a single bincount
+        row_offsets = np.arange(len(values))[:, np.newaxis] * \
+            self.subbasin_count
+        sums = np.bincount(
+            (positions + row_offsets).ravel(), values.ravel(),
+            minlength=len(values) * self.subbasin_count)
+
+        return sums.reshape(len(values), self.subbasin_count)
+
+    def realize(self, landuse_code, errors):
+        """
+        Calculates the fractional area of every hru for each error.
+
+        Parameters
+        ----------
+        landuse_code: int
+            Landuse code the error applies to
+        errors: array
+            Error (%) for each realization
+
+        Returns
+        -------
+        realized_areas: array
+            Fractional areas with one row per realization and one
+            column per hru
+        """
+        errors = np.asarray(errors, dtype=float) / 100.0
+        fractional_areas = self.fractional_areas
+        with_landuse = self.hru_landuse_codes == landuse_code
+        without_landuse = ~with_landuse
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # cumulative fractional area of the hrus with the landuse in
+            # each hru's subbasin and each hru's share of it
+            landuse_areas = self.subbasin_sums(
+                fractional_areas, with_landuse)[self.subbasin_positions]
+            landuse_percentages = fractional_areas / landuse_areas
+
+            # increase/decrease the area of affected hrus
+            realized_areas = fractional_areas + \
+                errors[:, np.newaxis] * landuse_areas * landuse_percentages
+
+            # area the unaffected hrus in each subbasin make up
+            area_differences = \
+                self.subbasin_sums(fractional_areas, with_landuse) - \
+                self.subbasin_sums(realized_areas, with_landuse)
+            other_percentages = fractional_areas / self.subbasin_sums(
+                fractional_areas, without_landuse)[self.subbasin_positions]
+
+            realized_areas[:, without_landuse] = (
+                fractional_areas +
+                area_differences[:, self.subbasin_positions] *
+                other_percentages)[:, without_landuse]
+
+        return realized_areas
+
+
+class LabelStatistics(object):
+    """
+    Summarizes cell values by label (e.g. the field each hrus1 cell is
+    located in). The (label, value) pairs are grouped once and each
+    statistic is calculated for every label at once with bincount sums
+    or a grouped unique count. Labels without any (valid) values get 0.
+
+    Parameters
+    ----------
+    labels: array
+        Label (1 to label_count) for each cell, other labels are skipped
+    values: array
+        Value for each cell, nan for missing values
+    label_count: int
+        Number of labels
+    weights: array
+        Weight (e.g. area) for each cell used by the area weighted mean,
+        every cell has the same weight when not provided
+    counts: array
+        Number of cells each value stands for, e.g. when the values are
+        for (label, hru) pairs instead of cells (1 when not provided)
+
+    Attributes
+    ----------
+    labels: array
+        zero based label for each cell that has a label
+    values: array
+        value for each cell that has a label
+    """
+
+    STATISTICS = ('mean', 'mode', 'geomean', 'area_weighted_mean')
+
+    def __init__(self, labels, values, label_count, weights=None,
+                 counts=None):
+        labels = np.asarray(labels).ravel()
+        labelled = (labels > 0) & (labels <= label_count)
+
+        self.label_count = label_count
+        self.labels = labels[labelled] - 1
+        self.values = np.asarray(values, dtype=float).ravel()[labelled]
+        if weights is None:
+            self.weights = None
+        else:
+            self.weights = np.asarray(weights, dtype=float).ravel()[labelled]
+        if counts is None:
+            self.counts = None
+        else:
+            self.counts = np.asarray(counts, dtype=float).ravel()[labelled]
+
+    def group_sums(self, values, weights=None):
+        """
+        Sums values and weights (cell counts by default) for each label,
+        skipping missing (nan) values.
+        """
+        if self.counts is not None:
+            values = values * self.counts
+            weights = self.counts if weights is None else \
+                weights * self.counts
+
+        valid = ~np.isnan(values)
+        labels = self.labels[valid]
+        if weights is None:
+            totals = np.bincount(labels, minlength=self.label_count)
+        else:
+            totals = np.bincount(
+                labels, weights[valid], minlength=self.label_count)
+
+        sums = np.bincount(labels, values[valid], minlength=self.label_count)
+
+        return sums, totals
+
+    def divide(self, sums, totals):
+        """ Divides sums by totals, 0 for labels without a total. """
+        result = np.zeros(self.label_count, dtype=float)
+        np.divide(sums, totals, out=result, where=totals > 0)
+
+        return result
+
+    def mean(self):
+        """ Mean of the values for each label. """
+        return self.divide(*self.group_sums(self.values))
+
+    def area_weighted_mean(self):
+        """ Mean of the values for each label weighted by cell weight. """
+        if self.weights is None:
+            return self.mean()
+
+        return self.divide(*self.group_sums(
+            self.values * self.weights, self.weights))
+
+    def geomean(self):
+        """
+        Geometric mean of the positive values for each label, from the
+        sum of their logs.
+        """
+        logs = np.full(len(self.values), np.nan)
+        positive = self.values > 0
+        logs[positive] = np.log(self.values[positive])
+
+        geomean = np.exp(self.divide(*self.group_sums(logs)))
+        geomean[np.bincount(self.labels[positive],
+                            minlength=self.label_count) == 0] = 0
+
+        return geomean
+
+    def mode(self):
+        """
+        Most common non-zero value for each label (the smallest value
+        when tied). Zero and missing values are counted together as one
+        value, the mode is 0 when it is the most common.
+        """
+        mode = np.zeros(self.label_count, dtype=float)
+        if not len(self.values):
+            return mode
+
+        values = np.where(self.values == 0, np.nan, self.values)
+
+        # runs of equal values after sorting by label and then value
+        # (nan sorts last)
+        order = np.lexsort((values, self.labels))
+        labels = self.labels[order]
+        values = values[order]
+        missing = np.isnan(values)
+        run_starts = np.flatnonzero(np.concatenate((
+            [True],
+            (labels[1:] != labels[:-1]) | (values[1:] != values[:-1]) &
+            ~(missing[1:] & missing[:-1]))))
+        if self.counts is None:
+            run_lengths = np.diff(np.append(run_starts, len(values)))
+        else:
+            run_lengths = np.add.reduceat(self.counts[order], run_starts)
+
+        # longest run for each label, the first one when tied
+        run_labels = labels[run_starts]
+        runs = np.lexsort(
+            (np.arange(len(run_starts)), -run_lengths, run_labels))
+        first_runs = runs[np.searchsorted(
+            run_labels[runs], np.unique(run_labels))]
+
+        mode[run_labels[first_runs]] = np.nan_to_num(
+            values[run_starts[first_runs]])
+
+        return mode
+
+    def compute(self, statistics):
+        """
+        Calculates several statistics from the same grouping.
+
+        Parameters
+        ----------
+        statistics: list
+            Names of the statistics (see STATISTICS)
+
+        Returns
+        -------
+        results: dict
+            Array with the statistic for each label by statistic name
+        """
+        results = {}
+        for statistic in statistics:
+            if statistic not in self.STATISTICS:
+                raise ValueError(
+                    'Unrecognized statistic: ' + str(statistic))
+            results[statistic] = getattr(self, statistic)()
+
+        return results
+
+
 def read_hru_files(txt_in_out_dir):
     """
-    Opens the .hru files (excluding output.hru and outputb.hru) and
-    finds the index position for our attributes of interest:
+    Collects the following attributes of each .hru file in TxtInOut
+    (named with the hru's number, so excluding output.hru and
+    outputb.hru) from the TxtInOutIndex of the directory:
         hru ids
         subbasin ids
         landuse codes
         soil codes
         slope ranges
-    Once the indexes are found we can use them to find the actual
-    values for each attribute and store them in their respective lists.
-    One large list wraps around our individual lists for each
-    attribute and returned.
 
     Parameters
     ----------
@@ -89,70 +947,102 @@ def read_hru_files(txt_in_out_dir):
         One large list containing a list of each attribute. Each 
         attribute list contains a value for each hru file.
     """
+    txt_in_out_index = TxtInOutIndex.load(txt_in_out_dir)
 
-    # loop through all hru files in TxtInOut directory -
-    # do NOT include output.hru and outputb.hru in the list
-    hru_filepaths = []
-    for hru_file in glob.glob(txt_in_out_dir + '/*.hru'):
-        if (hru_file != txt_in_out_dir + '/output.hru') and \
-                (hru_file != txt_in_out_dir + '/outputb.hru'):
-            hru_filepaths.append(hru_file)
-    # sort filepaths
-    hru_filepaths.sort()
-
-    hru_ids = []
-    subbasin_ids = []
-    soil_codes = []
-    slope_ranges = []
-    landuse_abbrevs = []
-    # loop through hru files
-    for hru_filepath in hru_filepaths:
-        # open the hru file, read the first line and close the file
-        hru_file = open(hru_filepath, 'r', errors="surrogateescape")
-        first_line = hru_file.readline()
-        hru_file.close()
-
-        # collect the indexes in the first line where our
-        # attributes of interest appear
-        hru_index = first_line.index('HRU:')
-        subbasin_index = first_line.index('Subbasin:')
-        last_hru_index = first_line.rindex('HRU:')
-        landuse_index = first_line.index('Luse:')
-        soil_index = first_line.index('Soil:')
-        slope_index = first_line.index('Slope')
-
-        # while testing we noticed that while most .hru files used
-        # '/'s for the date, some used '-'s - this will catch that case
-        try:
-            slash_index = first_line.index('/')
-        except ValueError:
-            slash_index = first_line.index('-')
-
-        # use the indexes to find the values
-        hru_id = int(float(first_line[hru_index + 4: subbasin_index - 1]))
-        subbasin_id = int(
-            float(first_line[subbasin_index + 9: last_hru_index - 1]))
-        landuse_abbrev = first_line[landuse_index + 5: soil_index - 1]
-        soil_code = first_line[soil_index + 6: slope_index - 1]
-        slope_range = first_line[slope_index + 6: slash_index - 2]
-
-        # append values from each hru to one list per attribute
-        hru_ids.append(hru_id)
-        subbasin_ids.append(subbasin_id)
-        landuse_abbrevs.append(landuse_abbrev)
-        soil_codes.append(soil_code)
-        slope_ranges.append(slope_range)
-
-    # pack all the lists into one large list
-    hru_files_attribute_values = [
-        hru_ids,
-        subbasin_ids,
-        landuse_abbrevs,
-        soil_codes,
-        slope_ranges
+    return [
+        txt_in_out_index.hru_ids.tolist(),
+        txt_in_out_index.subbasin_ids.tolist(),
+        txt_in_out_index.landuse_abbrevs.tolist(),
+        txt_in_out_index.soil_codes.tolist(),
+        txt_in_out_index.slope_ranges.tolist()
     ]
 
-    return hru_files_attribute_values
+
+# one row per hru: its dominant hru (OBJECTID), position in the dominant
+# hrus (starts at 0), subbasin id and landuse, soil and slope codes
+HRU_ATTRIBUTE_DTYPE = np.dtype([
+    ('dominant_hru', np.int64),
+    ('hru_index', np.int64),
+    ('subbasin', np.int64),
+    ('landuse_code', np.int64),
+    ('soil_code', np.int64),
+    ('slope_code', np.int64),
+])
+
+
+def encode_categories(values):
+    """
+    Codes each value with the position of the value in the sorted
+    unique values (e.g. soil names to 0, 1, 2, ...).
+    """
+    return np.unique(values, return_inverse=True)[1].ravel()
+
+
+def encode_landuse_codes(landuse_abbrevs, lookup_info):
+    """
+    Finds the lookup code of each landuse abbreviation. Each unique
+    abbreviation is looked up once and the codes are spread back to the
+    hrus.
+
+    Parameters
+    ----------
+    landuse_abbrevs: list
+        Landuse abbreviation of each hru
+    lookup_info: list
+        Lookup header followed by a [code, abbreviation] row per landuse
+
+    Returns
+    -------
+    landuse_codes: array
+        Lookup code of each hru's landuse (0 when it is not in the
+        lookup)
+    """
+    unique_abbrevs, abbrev_positions = np.unique(
+        np.asarray(landuse_abbrevs, dtype=str), return_inverse=True)
+
+    # the last row wins when an abbreviation is listed more than once
+    landuse_codes_by_abbrev = {
+        abbrev: int(code) for code, abbrev in lookup_info[1:]}
+    unique_landuse_codes = np.array(
+        [landuse_codes_by_abbrev.get(abbrev, 0) for abbrev in unique_abbrevs],
+        dtype=np.int64)
+
+    return unique_landuse_codes[abbrev_positions.ravel()]
+
+
+def create_hru_attribute_table(dominant_hrus, hru_files_read, lookup_info):
+    """
+    Packs the attributes of each hru into a structured array (see
+    HRU_ATTRIBUTE_DTYPE). Landuse abbreviations are coded with the
+    lookup, soils and slope ranges with encode_categories.
+
+    Parameters
+    ----------
+    dominant_hrus: array
+        Array of the sorted dominant hrus
+    hru_files_read: list of lists
+        Attributes of the hru files, see read_hru_files
+    lookup_info: list
+        Lookup header followed by a [code, abbreviation] row per landuse
+
+    Returns
+    -------
+    hru_attributes: array
+        Structured array with a row per hru
+    """
+    hru_ids, subbasin_ids, landuse_abbrevs, soil_codes, slope_ranges = \
+        hru_files_read
+
+    hru_attributes = np.zeros(len(hru_ids), dtype=HRU_ATTRIBUTE_DTYPE)
+    hru_attributes['dominant_hru'] = dominant_hrus
+    hru_attributes['hru_index'] = np.arange(len(hru_ids))
+    hru_attributes['subbasin'] = subbasin_ids
+    hru_attributes['landuse_code'] = encode_landuse_codes(
+        landuse_abbrevs, lookup_info)
+    hru_attributes['soil_code'] = encode_categories(soil_codes)
+    hru_attributes['slope_code'] = encode_categories(slope_ranges)
+
+    return hru_attributes
 
 
 def statistics_grid_file_is_missing(grid_folder):
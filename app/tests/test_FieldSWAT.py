@@ -0,0 +1,151 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from osgeo import ogr
+import numpy as np
+import pandas as pd
+import shapefile
+
+from fieldswat.process import FieldSWATProcess
+
+
+class TestFieldSWATProcess(unittest.TestCase):
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workspace)
+        os.makedirs(os.path.join(self.workspace, 'Output'))
+
+        # two fields, only their number is used by the aggregation
+        fields_filepath = os.path.join(self.workspace, 'fields.shp')
+        fields = shapefile.Writer(fields_filepath, shapeType=shapefile.POLYGON)
+        fields.field('Shape_Area', 'N')
+        for x in (0, 10):
+            fields.poly([[[x, 0], [x, 5], [x + 5, 5], [x + 5, 0], [x, 0]]])
+            fields.record(25)
+        fields.close()
+
+        self.process = FieldSWATProcess(logging.getLogger(__name__))
+        self.process.output_dir = self.workspace
+        self.process.fieldswat_fields_shapefile_filename = fields_filepath
+        self.process.fieldswat_aggregation_methods = ['mean', 'mode']
+
+        # hrus1 cells (OBJECTID), OBJECTID 7 has HRU_ID 9 which is not in
+        # the hru table
+        self.process.hrus = np.array([
+            [10, 10, 20, 7],
+            [30, -1, 20, 20],
+        ])
+        self.process.dominant_hrus = np.array([7, 10, 20, 30])
+        self.process.dominant_hru_ids = np.array([9, 1, 2, 3])
+        self.clu = np.reshape(np.transpose(np.array([
+            [1, 1, 2, 2],
+            [1, 1, 2, 0],
+        ])), 8)
+
+        self.process.swatoutput_data = {
+            'years': np.array([2001, 2001, 2001, 2002, 2002, 2002]),
+            'hrus': np.array([1, 2, 3, 3, 2, 1]),
+            'runoff': np.array([1., 2., 3., 30., 20., 10.]),
+            'sediment': np.array([.1, .2, .3, .03, .02, .01]),
+        }
+
+    def test_batch_joins_outputs_by_year_and_hru_id(self):
+        """
+        Test that each cell gets the output of its HRU_ID for the year,
+        that hrus missing from the hru table get nan and that the
+        attributes are named by output type, year and method.
+        """
+        self.process.fieldswat_selected_years = ['2002', '2001']
+        self.process.fieldswat_output_types = ['runoff', 'sediment']
+
+        _, field_columns, hru_ids, hru_columns = \
+            self.process.update_field_series(-1, self.clu)
+
+        np.testing.assert_array_equal(hru_ids, [1, 2, 3])
+        np.testing.assert_array_equal(hru_columns['R2002'], [10, 20, 30])
+        self.assertEqual(
+            sorted(field_columns),
+            sorted(prefix + code for prefix in ('R2001', 'R2002', 'S2001',
+                                                'S2002')
+                   for code in ('MEAN', 'MODE')))
+        # field 1 has hru 1 twice, hru 3 once and a nodata cell, field 2
+        # has hru 2 twice and hru 9 (not in the hru table) once
+        np.testing.assert_allclose(field_columns['R2001MEAN'], [5 / 3, 2])
+        np.testing.assert_allclose(field_columns['R2002MODE'], [10, 20])
+        np.testing.assert_allclose(
+            field_columns['S2002MEAN'], [.05 / 3, .02])
+
+        field_series = pd.read_csv(
+            os.path.join(self.workspace, 'Output', 'Field_Response.csv'))
+        self.assertEqual(len(field_series), 2 * 2 * 2 * 2)
+
+    def test_single_year_matches_batch(self):
+        """
+        Test that a single year and output type gives the same field
+        values as the same year in a batch.
+        """
+        self.process.fieldswat_output_type = 'runoff'
+        self.process.fieldswat_selected_year = '2001'
+        self.process.fieldswat_selected_years = ['2001', '2002']
+        self.process.fieldswat_output_types = ['runoff']
+
+        _, field_columns, hru_ids, hru_columns = \
+            self.process.update_field_info(-1, self.clu)
+        _, series_columns, _, series_hru_columns = \
+            self.process.update_field_series(-1, self.clu)
+
+        np.testing.assert_array_equal(hru_ids, [1, 2, 3])
+        np.testing.assert_array_equal(
+            hru_columns['Runoff'], series_hru_columns['R2001'])
+        np.testing.assert_allclose(
+            field_columns['run_mean'], series_columns['R2001MEAN'])
+        np.testing.assert_allclose(
+            field_columns['run_mode'], series_columns['R2001MODE'])
+
+    def write_fields_shapefile(self, field_type, first_attributes):
+        """
+        Writes a fields shapefile whose first attribute has field_type
+        and returns its reader.
+        """
+        fields_filepath = os.path.join(self.workspace, 'user_fields.shp')
+        fields = shapefile.Writer(fields_filepath, shapeType=shapefile.POLYGON)
+        fields.field('FIELD_ID', field_type)
+        for x, first_attribute in zip((0, 10), first_attributes):
+            fields.poly([[[x, 0], [x, 5], [x + 5, 5], [x + 5, 0], [x, 0]]])
+            fields.record(first_attribute)
+        fields.close()
+
+        return shapefile.Reader(fields_filepath)
+
+    def read_field_response(self, field_name):
+        """ Values of an attribute of Field_Response.shp. """
+        layer = ogr.Open(os.path.join(
+            self.workspace, 'Output', 'Field_Response.shp')).GetLayer()
+        return [feature.GetField(field_name) for feature in layer]
+
+    def test_field_shapefile_with_text_first_attribute(self):
+        """
+        Test that a text first attribute is written as 0 to Shape_Area
+        instead of failing the task.
+        """
+        self.process.create_new_field_shapefile(
+            self.write_fields_shapefile('C', ['A-12', 'B-7']),
+            {'runoff': np.array([1.5, 2.5])})
+
+        self.assertEqual(self.read_field_response('Shape_Area'), [0, 0])
+        self.assertEqual(self.read_field_response('runoff'), [1.5, 2.5])
+
+    def test_field_shapefile_with_null_first_attribute(self):
+        """
+        Test that a null first attribute is written as null to
+        Shape_Area.
+        """
+        self.process.create_new_field_shapefile(
+            self.write_fields_shapefile('N', [None, 25]),
+            {'runoff': np.array([1.5, 2.5])})
+
+        self.assertEqual(self.read_field_response('Shape_Area'), [None, 25])
+        self.assertEqual(self.read_field_response('runoff'), [1.5, 2.5])
@@ -0,0 +1,234 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from osgeo import gdal, ogr
+import numpy as np
+
+from swatluu import geotools
+
+
+def create_mem_band(array):
+    """ Creates an in-memory single band raster holding array. """
+    rows, cols = array.shape
+    dataset = gdal.GetDriverByName('MEM').Create(
+        '', cols, rows, 1, gdal.GDT_Int32)
+    dataset.GetRasterBand(1).WriteArray(array)
+    return dataset
+
+
+class TestGeoTools(unittest.TestCase):
+    def setUp(self):
+        self.array = np.arange(60 * 80, dtype=np.int32).reshape(60, 80)
+        self.dataset = create_mem_band(self.array)
+        self.band = self.dataset.GetRasterBand(1)
+
+    def test_read_band_at_consecutive_offsets(self):
+        """
+        Test that consecutive offsets return the matching window.
+        """
+        x_offsets = np.arange(5, 45)
+        y_offsets = np.arange(10, 40)
+
+        values = geotools.read_band_at_offsets(
+            self.band, x_offsets, y_offsets, window_cells=100)
+
+        np.testing.assert_array_equal(
+            values, self.array[10:40, 5:45])
+
+    def test_read_band_at_gathered_offsets(self):
+        """
+        Test that non-consecutive (repeated or skipped) offsets return
+        the value of the band at every row and column pair.
+        """
+        x_offsets = np.array([0, 0, 1, 3, 4, 4, 79])
+        y_offsets = np.array([2, 3, 3, 5, 59])
+
+        values = geotools.read_band_at_offsets(
+            self.band, x_offsets, y_offsets, window_cells=100)
+
+        np.testing.assert_array_equal(
+            values, self.array[np.ix_(y_offsets, x_offsets)])
+
+    def test_read_band_outside_extent(self):
+        """
+        Test that offsets outside of the band's extent raise an error
+        unless the cells are skipped.
+        """
+        x_offsets = np.array([-1, 0, 1])
+        y_offsets = np.array([0, 1])
+
+        with self.assertRaises(ValueError):
+            geotools.read_band_at_offsets(self.band, x_offsets, y_offsets)
+
+        skip_mask = np.array([[True, False, False], [True, False, False]])
+        values = geotools.read_band_at_offsets(
+            self.band, x_offsets, y_offsets, skip_mask)
+
+        np.testing.assert_array_equal(
+            values[:, 1:], self.array[0:2, 0:2])
+
+    def test_translate_raster_skips_up_to_date_geotiff(self):
+        """
+        Test that a geotiff is only converted again when its source
+        changes.
+        """
+        workspace = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workspace)
+        source_filepath = os.path.join(workspace, 'source.tif')
+        output_filepath = os.path.join(workspace, 'output.tif')
+        gdal.GetDriverByName('GTiff').CreateCopy(
+            source_filepath, self.dataset)
+
+        self.assertTrue(
+            geotools.translate_raster(source_filepath, output_filepath))
+        self.assertFalse(
+            geotools.translate_raster(source_filepath, output_filepath))
+        np.testing.assert_array_equal(
+            geotools.read_raster(output_filepath)[0], self.array)
+
+        source_mtime = os.stat(source_filepath).st_mtime_ns + 10 ** 9
+        os.utime(source_filepath, ns=(source_mtime, source_mtime))
+
+        self.assertTrue(
+            geotools.translate_raster(source_filepath, output_filepath))
+
+    def test_raster_workspace_falls_back_to_disk(self):
+        """
+        Test that rasters are kept in memory up to the memory limit,
+        written to disk after it and deleted when the workspace closes.
+        """
+        disk_dir = os.path.join(tempfile.mkdtemp(), 'workspace')
+        self.addCleanup(shutil.rmtree, os.path.dirname(disk_dir))
+
+        with geotools.RasterWorkspace(disk_dir, memory_limit=100) as workspace:
+            in_memory = workspace.create_filepath('memory.tif', 60)
+            on_disk = workspace.create_filepath('disk.tif', 60)
+            for filepath in (in_memory, on_disk):
+                gdal.GetDriverByName('GTiff').CreateCopy(
+                    filepath, self.dataset)
+
+            self.assertTrue(in_memory.startswith('/vsimem/'))
+            self.assertEqual(os.path.dirname(on_disk), disk_dir)
+            np.testing.assert_array_equal(
+                geotools.read_raster(in_memory)[0], self.array)
+
+        self.assertIsNone(gdal.VSIStatL(in_memory))
+        self.assertFalse(os.path.exists(on_disk))
+
+    def test_rasterize_polygon_labels(self):
+        """
+        Test that polygons are labelled with their FID + 1 on a grid
+        aligned to the like raster, by cell centre or by any touch.
+        """
+        workspace = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workspace)
+        like_filepath = os.path.join(workspace, 'like.tif')
+        like = gdal.GetDriverByName('GTiff').Create(
+            like_filepath, 4, 3, 1, gdal.GDT_Int32)
+        # 10 m cells with the upper left corner at (0, 30)
+        like.SetGeoTransform((0, 10, 0, 30, 0, -10))
+        like = None
+
+        fields_filepath = os.path.join(workspace, 'fields.shp')
+        fields = ogr.GetDriverByName('ESRI Shapefile').CreateDataSource(
+            fields_filepath)
+        layer = fields.CreateLayer('fields', geom_type=ogr.wkbPolygon)
+        for wkt in ('POLYGON ((1 29, 19 29, 19 11, 1 11, 1 29))',
+                    'POLYGON ((26 6, 34 6, 34 4, 26 4, 26 6))'):
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetGeometry(ogr.CreateGeometryFromWkt(wkt))
+            layer.CreateFeature(feature)
+        fields = None
+
+        labels = geotools.rasterize_polygon_labels(
+            fields_filepath, like_filepath)
+        np.testing.assert_array_equal(labels, [
+            [1, 1, 0, 0],
+            [1, 1, 0, 0],
+            [0, 0, 0, 0],
+        ])
+
+        labels = geotools.rasterize_polygon_labels(
+            fields_filepath, like_filepath, all_touched=True)
+        np.testing.assert_array_equal(labels[2], [0, 0, 2, 2])
+
+    def test_label_polygon_cells_in_bounding_box_windows(self):
+        """
+        Test that the index finds polygons by bounding box and that cells
+        are labelled by testing their centre against each polygon.
+        """
+        polygons = [
+            [(1, 29), (19, 29), (19, 11), (1, 11), (1, 29)],
+            [(21, 29), (39, 29), (21, 1), (21, 29)],
+        ]
+        polygon_index = geotools.PolygonBoundsIndex(polygons)
+
+        np.testing.assert_array_equal(
+            polygon_index.query([15, 15, 25, 25]), [0, 1])
+        np.testing.assert_array_equal(polygon_index.query([2, 2, 8, 8]), [])
+
+        # cell centres of 10 m cells with the upper left corner at (0, 30)
+        x_axis = np.array([5, 15, 25, 35])
+        y_axis = np.array([25, 15, 5])
+        labels = geotools.label_polygon_cells(
+            polygons, x_axis, y_axis, polygon_index)
+
+        np.testing.assert_array_equal(labels, [
+            [1, 1, 2, 2],
+            [1, 1, 2, 0],
+            [0, 0, 0, 0],
+        ])
+
+    def test_write_polygon_shapefile(self):
+        """
+        Test that polygons and their attributes are written in order.
+        """
+        workspace = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workspace)
+        polygons = [
+            [(0, 0), (0, 5), (5, 5), (5, 0), (0, 0)],
+            [(10, 10), (10, 12), (13, 12), (10, 10)],
+        ]
+
+        geotools.write_polygon_shapefile(
+            workspace, 'fields', ['Shape_Area', 'runoff'],
+            zip(polygons, [[25, 1.5], [3, 2.5]]))
+
+        layer = ogr.Open(os.path.join(workspace, 'fields.shp')).GetLayer()
+        self.assertEqual(layer.GetFeatureCount(), 2)
+        for feature, polygon, area in zip(layer, polygons, [25, 3]):
+            self.assertEqual(feature.GetField('Shape_Area'), area)
+            self.assertAlmostEqual(feature.GetGeometryRef().GetArea(), area)
+            self.assertEqual(
+                feature.GetGeometryRef().GetGeometryRef(0).GetPoints(),
+                [(float(x), float(y)) for x, y in polygon])
+
+    def test_join_shapefile_attributes_by_key(self):
+        """
+        Test that new attributes are matched to features by key and not
+        by feature order.
+        """
+        workspace = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workspace)
+        hrus_filepath = os.path.join(workspace, 'hru1.shp')
+        hrus = ogr.GetDriverByName('ESRI Shapefile').CreateDataSource(
+            hrus_filepath)
+        layer = hrus.CreateLayer('hru1', geom_type=ogr.wkbPolygon)
+        layer.CreateField(ogr.FieldDefn('HRU_ID', ogr.OFTInteger))
+        for hru_id in (3, 1, 7, 2):
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetField('HRU_ID', hru_id)
+            layer.CreateFeature(feature)
+        hrus = None
+
+        geotools.join_shapefile_attributes(
+            hrus_filepath, 'HRU_ID', np.array([1, 2, 3]),
+            {'Runoff': [0.1, 0.2, 0.3], 'Sediment': [1, 2, 3]})
+
+        layer = ogr.Open(hrus_filepath).GetLayer()
+        values = [(feature.GetField('Runoff'), feature.GetField('Sediment'))
+                  for feature in layer]
+        self.assertEqual(
+            values, [(0.3, 3), (0.1, 1), (None, None), (0.2, 2)])
@@ -0,0 +1,47 @@
+import unittest
+
+import numpy as np
+
+from luuchecker.process import InjectionAllocator
+
+
+class TestInjectionAllocator(unittest.TestCase):
+    def test_take_does_not_reuse_cells(self):
+        """
+        Test that cells are not handed out twice until the subbasin
+        runs out of unused cells.
+        """
+        allocator = InjectionAllocator(0)
+
+        cells = np.concatenate([
+            allocator.take(1, 10, 3),
+            allocator.take(1, 10, 3),
+            allocator.take(1, 10, 4)])
+
+        np.testing.assert_array_equal(np.sort(cells), np.arange(10))
+
+    def test_take_refills_when_subbasin_runs_out(self):
+        """
+        Test that a subbasin gets a new order of all of its cells when
+        fewer unused cells are left than requested.
+        """
+        allocator = InjectionAllocator(0)
+        allocator.take(1, 10, 8)
+
+        cells = allocator.take(1, 10, 5)
+
+        self.assertEqual(len(np.unique(cells)), 5)
+        self.assertEqual(allocator.cursors[1], 5)
+
+    def test_take_is_reproducible_from_seed(self):
+        """
+        Test that the same seed hands out the same cells and subbasins
+        are kept apart.
+        """
+        first = InjectionAllocator(42)
+        second = InjectionAllocator(42)
+
+        for subid, cell_count, count in [(1, 50, 5), (2, 20, 7), (1, 50, 5)]:
+            np.testing.assert_array_equal(
+                first.take(subid, cell_count, count),
+                second.take(subid, cell_count, count))
@@ -0,0 +1,96 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from uncertainty.post_processing_script import process_realizations
+
+
+# stands in for SWAT: copies file1.dat into each output file and fails
+# for realizations containing FAIL
+STUB_SWAT = """#!/bin/sh
+if grep -q FAIL file1.dat; then exit 3; fi
+for output in output.std output.rch output.sub output.hru; do
+    cat file1.dat > $output
+done
+echo run >> runs.txt
+"""
+
+
+class TestProcessRealizations(unittest.TestCase):
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workspace)
+
+        self.txtinout_dir = os.path.join(self.workspace, 'TxtInOut')
+        os.makedirs(self.txtinout_dir)
+        for filename, content in (('000010001.hru', 'hru'),
+                                  ('output.std', 'previous run')):
+            with open(os.path.join(self.txtinout_dir, filename), 'w') as f:
+                f.write(content)
+        self.swatexe_filepath = os.path.join(self.txtinout_dir, 'swat')
+        with open(self.swatexe_filepath, 'w') as swatexe_file:
+            swatexe_file.write(STUB_SWAT)
+        os.chmod(self.swatexe_filepath, stat.S_IRWXU)
+
+        self.output_dir = os.path.join(self.workspace, 'Output')
+        os.makedirs(self.output_dir)
+        self.realization_files = []
+        for name in ('file10_1_-5_perc', 'file10_2_5_perc'):
+            self.realization_files.append(
+                self.write_output_file(name + '.dat', name))
+        self.write_output_file('lup.dat', 'lup')
+
+    def write_output_file(self, filename, content):
+        filepath = os.path.join(self.output_dir, filename)
+        with open(filepath, 'w') as output_file:
+            output_file.write(content)
+        return filepath
+
+    def run_realizations(self, **kwargs):
+        return process_realizations.run_swatexe_with_realizations(
+            self.output_dir,
+            process_realizations.get_realization_filepaths(self.output_dir),
+            self.swatexe_filepath, self.txtinout_dir, workers=2, **kwargs)
+
+    def test_realizations_run_in_sandboxes(self):
+        """
+        Test that every realization gets a folder with its outputs and
+        that the original TxtInOut is left untouched.
+        """
+        failures = self.run_realizations()
+
+        self.assertEqual(failures, {})
+        for realization_file in self.realization_files:
+            output_directory = os.path.splitext(realization_file)[0]
+            for filename in process_realizations.OUTPUT_FILENAMES:
+                with open(os.path.join(output_directory, filename)) as f:
+                    self.assertEqual(
+                        f.read(), os.path.basename(output_directory))
+        with open(os.path.join(self.txtinout_dir, 'output.std')) as f:
+            self.assertEqual(f.read(), 'previous run')
+        self.assertFalse(
+            os.path.exists(os.path.join(self.txtinout_dir, 'runs.txt')))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.output_dir, 'sandboxes')))
+
+    def test_resume_runs_only_missing_realizations(self):
+        """
+        Test that failed realizations get no folder and are the only
+        ones run again on resume.
+        """
+        failing_file = self.write_output_file('file20_1_-5_perc.dat', 'FAIL')
+
+        failures = self.run_realizations()
+
+        self.assertEqual(list(failures), [failing_file])
+        self.assertFalse(os.path.exists(os.path.splitext(failing_file)[0]))
+
+        self.write_output_file('file20_1_-5_perc.dat', 'fixed')
+        done_directory = os.path.splitext(self.realization_files[0])[0]
+        done_mtime = os.stat(done_directory).st_mtime_ns
+
+        self.assertEqual(self.run_realizations(), {})
+        self.assertTrue(os.path.isdir(os.path.splitext(failing_file)[0]))
+        self.assertEqual(os.stat(done_directory).st_mtime_ns, done_mtime)
@@ -0,0 +1,102 @@
+import filecmp
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from osgeo import gdal
+import numpy as np
+
+from swatluu import geotools
+from swatluu import swattools
+from swatluu.process import SWATLUUProcess
+
+
+NODATA = -9999
+
+
+def create_tif(filepath, array):
+    """ Writes array to a geotiff with 30 m cells. """
+    rows, cols = array.shape
+    dataset = gdal.GetDriverByName('GTiff').Create(
+        filepath, cols, rows, 1, gdal.GDT_Int32)
+    dataset.SetGeoTransform((0, 30, 0, rows * 30, 0, -30))
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(NODATA)
+    band.WriteArray(array)
+    dataset = None
+
+
+class TestSWATLUUProcess(unittest.TestCase):
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workspace)
+
+        rng = np.random.RandomState(0)
+        self.dominant_hrus = np.arange(1, 41) * 3
+        self.hrus = rng.choice(self.dominant_hrus, (50, 60)).astype(np.int32)
+        self.hrus[rng.rand(50, 60) < .1] = NODATA
+
+        codes = np.array([11, 41, 82, 83])
+        self.hru_files_data = np.zeros(
+            len(self.dominant_hrus), dtype=swattools.HRU_ATTRIBUTE_DTYPE)
+        self.hru_files_data['dominant_hru'] = self.dominant_hrus
+        self.hru_files_data['hru_index'] = np.arange(len(self.dominant_hrus))
+        self.hru_files_data['subbasin'] = rng.randint(1, 4, 40)
+        self.hru_files_data['landuse_code'] = rng.choice(codes, 40)
+        self.hru_files_data['soil_code'] = rng.randint(0, 3, 40)
+
+        self.landuse_dir = os.path.join(self.workspace, 'Landuse')
+        os.makedirs(self.landuse_dir)
+        self.layer_names = ['landuse1', 'landuse2', 'landuse3']
+        for layer_name in self.layer_names:
+            layer = rng.choice(codes, self.hrus.shape).astype(np.int32)
+            layer[self.hrus == NODATA] = NODATA
+            create_tif(os.path.join(self.landuse_dir, layer_name), layer)
+
+    def calculate_new_fractional_areas(self, layer_workers):
+        """
+        Runs calculate_new_fractional_areas with layer_workers and
+        returns the Output folder.
+        """
+        process_root_dir = tempfile.mkdtemp(dir=self.workspace)
+        output_dir = os.path.join(process_root_dir, 'output')
+        os.makedirs(os.path.join(output_dir, 'Raster'))
+        os.makedirs(os.path.join(output_dir, 'Output'))
+        create_tif(os.path.join(output_dir, 'Raster', 'hrus1'), self.hrus)
+
+        process = SWATLUUProcess(logging.getLogger(__name__))
+        process.process_root_dir = process_root_dir
+        process.output_dir = output_dir
+        process.landuse_dir = self.landuse_dir
+        process.landuse_layers_data = [
+            [1, 1, 2000, layer_name] for layer_name in self.layer_names]
+        process.raster_workspace = geotools.RasterWorkspace(
+            os.path.join(process_root_dir, 'RasterWorkspace'))
+        process.hru_info = (30, NODATA)
+        process.hru_index = swattools.HruPixelIndex(
+            self.hrus, self.dominant_hrus, NODATA)
+        process.hru_files_data = self.hru_files_data
+        process.layer_workers = layer_workers
+
+        process.calculate_new_fractional_areas()
+
+        return os.path.join(output_dir, 'Output')
+
+    def test_layer_workers_match_serial_output(self):
+        """
+        Test that preparing the landuse layers in a pool of workers
+        writes the same fractional areas as preparing them one at a
+        time.
+        """
+        serial_dir = self.calculate_new_fractional_areas(1)
+        parallel_dir = self.calculate_new_fractional_areas(2)
+
+        filenames = sorted(os.listdir(serial_dir))
+        self.assertEqual(filenames, ['file1.dat', 'file2.dat', 'file3.dat'])
+        self.assertEqual(sorted(os.listdir(parallel_dir)), filenames)
+        for filename in filenames:
+            self.assertTrue(filecmp.cmp(
+                os.path.join(serial_dir, filename),
+                os.path.join(parallel_dir, filename), shallow=False))
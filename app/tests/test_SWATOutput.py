@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from fieldswat import swatoutput
+
+
+class TestSWATOutput(unittest.TestCase):
+    def setUp(self):
+        self.swat_model_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.swat_model_dir)
+        os.makedirs(swatoutput.get_tables_out_dir(self.swat_model_dir))
+        with open(swatoutput.get_swatoutput_mdb_filepath(
+                self.swat_model_dir), 'w') as mdb_file:
+            mdb_file.write('mdb')
+
+    def test_summarize_monthly_hru_table(self):
+        """
+        Test that monthly tables are summarized with the mean for each
+        year and hru and annual tables are kept in order.
+        """
+        monthly = pd.DataFrame([
+            (2001, 1, 2, 1.0, 0.5),
+            (2001, 2, 2, 3.0, 1.5),
+            (2001, 1, 1, 4.0, 2.0),
+            (2000, 1, 1, 6.0, 3.0),
+        ], columns=swatoutput.HRU_TABLE_COLUMNS)
+
+        summary = swatoutput.summarize_hru_table(monthly)
+
+        np.testing.assert_array_equal(summary['years'], [2000, 2001, 2001])
+        np.testing.assert_array_equal(summary['hrus'], [1, 1, 2])
+        np.testing.assert_allclose(summary['runoff'], [6.0, 4.0, 2.0])
+        np.testing.assert_allclose(summary['sediment'], [3.0, 2.0, 1.0])
+
+        annual = monthly.assign(MON=monthly['YEAR'])
+        summary = swatoutput.summarize_hru_table(annual)
+
+        np.testing.assert_array_equal(summary['hrus'], [2, 2, 1, 1])
+        np.testing.assert_allclose(summary['runoff'], [1.0, 3.0, 4.0, 6.0])
+
+    def test_hru_table_cache_is_read_until_database_changes(self):
+        """
+        Test that an up to date cache is used instead of reading the
+        database and that it is ignored once the database changes.
+        """
+        hru_table = pd.DataFrame(
+            [(2000, 2000, 1, 1.0, 2.0)], columns=swatoutput.HRU_TABLE_COLUMNS)
+        # read the table with UCanAccess (replaced by the table above)
+        for patcher in (
+                mock.patch.object(swatoutput.shutil, 'which',
+                                  return_value=None),
+                mock.patch.object(swatoutput, 'read_hru_table_with_ucanaccess',
+                                  return_value=hru_table)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.assertIsNone(swatoutput.load_hru_table_cache(self.swat_model_dir))
+        swatoutput.extract_hru_table(self.swat_model_dir)
+
+        cache = swatoutput.load_hru_table_cache(self.swat_model_dir)
+        np.testing.assert_array_equal(cache['years'], [2000])
+        self.assertEqual(
+            swatoutput.read_progress(self.swat_model_dir)['status'],
+            'complete')
+
+        mdb_filepath = swatoutput.get_swatoutput_mdb_filepath(
+            self.swat_model_dir)
+        mdb_mtime = os.stat(mdb_filepath).st_mtime_ns + 10 ** 9
+        os.utime(mdb_filepath, ns=(mdb_mtime, mdb_mtime))
+
+        self.assertIsNone(swatoutput.load_hru_table_cache(self.swat_model_dir))
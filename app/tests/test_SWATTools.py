@@ -0,0 +1,253 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from swatluu import swattools
+
+
+class TestSWATTools(unittest.TestCase):
+    def setUp(self):
+        self.nodata = -9999
+        self.hrus = np.array([
+            [1, 1, 1, 2, 2],
+            [1, 5, 1, 2, 2],
+            [1, 1, 1, 2, 2],
+            [-9999, 3, 3, 2, 6],
+        ], dtype=np.int32)
+        self.dominant_hrus = np.array([1, 2, 3])
+
+    def test_merge_allocates_non_dominant_hrus_to_nearest_dominant_hru(self):
+        """
+        Test that non-dominant hrus take the value of the nearest
+        dominant hru and nodata cells are left untouched.
+        """
+        merged = swattools.merge(
+            self.hrus.copy(), self.dominant_hrus, self.nodata)
+
+        expected = np.array([
+            [1, 1, 1, 2, 2],
+            [1, 1, 1, 2, 2],
+            [1, 1, 1, 2, 2],
+            [-9999, 3, 3, 2, 2],
+        ], dtype=np.int32)
+
+        np.testing.assert_array_equal(merged, expected)
+
+    def test_merge_in_place(self):
+        """
+        Test that the hrus array is only updated when in_place is True.
+        """
+        hrus = self.hrus.copy()
+        merged = swattools.merge(
+            hrus, self.dominant_hrus, self.nodata, in_place=False)
+
+        np.testing.assert_array_equal(hrus, self.hrus)
+        self.assertIsNot(merged, hrus)
+
+        merged = swattools.merge(hrus, self.dominant_hrus, self.nodata)
+
+        self.assertIs(merged, hrus)
+
+    def test_hru_pixel_index_groups_cells_by_dominant_hru(self):
+        """
+        Test that the index holds the flat raster offsets of each
+        dominant hru's cells (in raster order) and skips nodata and
+        non-dominant cells.
+        """
+        dominant_hrus = np.array([2, 1, 3])
+        hru_index = swattools.HruPixelIndex(
+            self.hrus, dominant_hrus, self.nodata)
+
+        self.assertEqual(len(hru_index), 3)
+        np.testing.assert_array_equal(hru_index.counts, [7, 8, 2])
+        np.testing.assert_array_equal(
+            hru_index.pixels(0), [3, 4, 8, 9, 13, 14, 18])
+        np.testing.assert_array_equal(hru_index.pixels(2), [16, 17])
+
+        values = hru_index.split(hru_index.gather(self.hrus))
+        for position, hru in enumerate(dominant_hrus):
+            np.testing.assert_array_equal(
+                values[position], np.full(hru_index.counts[position], hru))
+
+    def test_hru_pixel_index_areas(self):
+        """
+        Test that hru areas are calculated from the cell counts.
+        """
+        hru_index = swattools.HruPixelIndex(
+            self.hrus, self.dominant_hrus, self.nodata)
+
+        np.testing.assert_allclose(
+            hru_index.areas(30.0), np.array([8, 7, 2]) * 0.0009)
+
+    def test_hru_pixel_index_save_and_load(self):
+        """
+        Test that a saved index is loaded back with the same arrays.
+        """
+        hru_index = swattools.HruPixelIndex(
+            self.hrus, self.dominant_hrus, self.nodata)
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir)
+
+        hru_index.save(index_dir)
+        loaded = swattools.HruPixelIndex.load(index_dir)
+
+        self.assertEqual(loaded.shape, hru_index.shape)
+        for attribute in ('offsets', 'labels', 'counts', 'starts'):
+            np.testing.assert_array_equal(
+                getattr(loaded, attribute), getattr(hru_index, attribute))
+
+    def test_reallocate_landuse_cells(self):
+        """
+        Test that cells with a new landuse move to an hru in the same
+        subbasin and soil with that landuse, and stay put when there
+        is no such hru.
+        """
+        hrus = np.array([[1, 1, 2, 2], [1, 1, 2, 2], [3, 3, 4, 4]])
+        dominant_hrus = np.array([1, 2, 3, 4])
+        hru_index = swattools.HruPixelIndex(hrus, dominant_hrus, self.nodata)
+        # hrus 1-3 share subbasin and soil, hru 4 is in another subbasin
+        hru_landuse_codes = np.array([10, 20, 30, 20])
+        hru_attributes = np.array([[1, 0], [1, 0], [1, 0], [2, 0]])
+        receivers = swattools.HruReceiverLookup(
+            np.column_stack((hru_attributes, hru_landuse_codes)))
+        landuse = np.array([
+            [10, 20, 20, 20],
+            [10, 30, 20, 20],
+            [30, 30, 10, 20],
+        ])
+
+        cell_counts = swattools.reallocate_landuse_cells(
+            hru_index, hru_index.gather(landuse), hru_landuse_codes,
+            hru_attributes, receivers, self.nodata)
+
+        # hru 1 gives one cell to hru 2 and one to hru 3, the cell
+        # in hru 4 has no receiver with landuse 10 in subbasin 2
+        np.testing.assert_array_equal(cell_counts, [2, 5, 3, 2])
+
+    def test_label_statistics(self):
+        """
+        Test that every statistic is calculated for each label from one
+        grouping and that labels without values get 0.
+        """
+        labels = np.array([1, 1, 1, 1, 2, 2, 2, 0, 4])
+        values = np.array([1, 4, 4, 0, 2, np.nan, 8, 5, 3], dtype=float)
+        weights = np.array([1, 1, 2, 4, 1, 1, 3, 1, 1], dtype=float)
+
+        results = swattools.LabelStatistics(
+            labels, values, 3, weights).compute(
+                swattools.LabelStatistics.STATISTICS)
+
+        np.testing.assert_allclose(results['mean'], [2.25, 5, 0])
+        np.testing.assert_allclose(results['mode'], [4, 2, 0])
+        np.testing.assert_allclose(results['geomean'], [16 ** (1 / 3.), 4, 0])
+        np.testing.assert_allclose(
+            results['area_weighted_mean'], [1.625, 6.5, 0])
+
+    def test_label_statistics_from_counted_values(self):
+        """
+        Test that values standing for several cells (e.g. field and hru
+        pairs) give the same statistics as the cells themselves.
+        """
+        labels = np.array([1, 1, 1, 1, 2, 2, 2, 2])
+        values = np.array([1, 4, 4, 4, 2, 8, 8, 2], dtype=float)
+
+        cells = swattools.LabelStatistics(labels, values, 2).compute(
+            swattools.LabelStatistics.STATISTICS)
+        pairs = swattools.LabelStatistics(
+            [1, 1, 2, 2], [1, 4, 2, 8], 2, counts=[1, 3, 2, 2]).compute(
+                swattools.LabelStatistics.STATISTICS)
+
+        for statistic in swattools.LabelStatistics.STATISTICS:
+            np.testing.assert_allclose(pairs[statistic], cells[statistic])
+
+    def test_merge_cache_reuses_merge_and_evicts_least_recently_used(self):
+        """
+        Test that a cached merge is returned for the same hrus and
+        hru1.dbf and that the least recently used entry is deleted once
+        the cache is over its size limit.
+        """
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        dbf_filepath = os.path.join(cache_dir, 'hru1.dbf')
+        with open(dbf_filepath, 'wb') as dbf_file:
+            dbf_file.write(b'hru1')
+        merge_cache = swattools.MergeCache(
+            os.path.join(cache_dir, 'entries'), max_bytes=10 ** 9)
+        dominant_hru_ids = np.array([1, 2, 3])
+
+        merged, hru_index = swattools.merge_with_cache(
+            merge_cache, self.hrus.copy(), self.dominant_hrus,
+            dominant_hru_ids, self.nodata, dbf_filepath)
+        key = merge_cache.get_key(self.hrus, self.nodata, dbf_filepath)
+        cached = merge_cache.load(key)
+
+        np.testing.assert_array_equal(cached[0], merged)
+        np.testing.assert_array_equal(cached[1], self.dominant_hrus)
+        np.testing.assert_array_equal(cached[2], dominant_hru_ids)
+        np.testing.assert_array_equal(cached[3].offsets, hru_index.offsets)
+
+        # a second model (another hru1.dbf) over the size limit
+        with open(dbf_filepath, 'wb') as dbf_file:
+            dbf_file.write(b'hru1 changed')
+        merge_cache.max_bytes = 1
+        swattools.merge_with_cache(
+            merge_cache, self.hrus.copy(), self.dominant_hrus,
+            dominant_hru_ids, self.nodata, dbf_filepath)
+
+        self.assertIsNone(merge_cache.load(key))
+        self.assertEqual(len(os.listdir(merge_cache.cache_dir)), 1)
+
+    def test_realization_engine_redistributes_subbasin_areas(self):
+        """
+        Test that hrus with the landuse gain the error share of their
+        area, the other hrus in the subbasin make up the difference and
+        subbasins without the landuse are unchanged.
+        """
+        hru_subbasins = np.array([1, 1, 1, 2, 2])
+        hru_landuse_codes = np.array([10, 20, 20, 20, 30])
+        hru_areas = np.array([2, 1, 1, 3, 1], dtype=float)
+        engine = swattools.RealizationEngine(
+            hru_subbasins, hru_landuse_codes, hru_areas)
+
+        realized_areas = engine.realize(10, [-10, 0, 10])
+
+        np.testing.assert_allclose(realized_areas, [
+            [0.45, 0.275, 0.275, 0.75, 0.25],
+            [0.5, 0.25, 0.25, 0.75, 0.25],
+            [0.55, 0.225, 0.225, 0.75, 0.25],
+        ])
+
+    def test_hru_attribute_table_encodes_categories(self):
+        """
+        Test that landuse abbreviations get their lookup code (0 when
+        missing) and that soils and slopes are coded by unique value.
+        """
+        lookup_info = [['Value', 'Type'], ['11', 'WATR'], ['82', 'AGRR'],
+                       ['41', 'FRSD'], ['83', 'AGRR']]
+        hru_files_read = [
+            [1, 2, 3, 4],
+            [1, 1, 2, 2],
+            ['AGRR', 'FRSD', 'URLD', 'AGRR'],
+            ['TWO W', 'HENRY', 'TWO W', 'ADA'],
+            ['0-2', '2-9999', '0-2', '0-2'],
+        ]
+
+        hru_attributes = swattools.create_hru_attribute_table(
+            self.dominant_hrus[[0, 1, 2, 2]], hru_files_read, lookup_info)
+
+        self.assertEqual(
+            hru_attributes.dtype, swattools.HRU_ATTRIBUTE_DTYPE)
+        np.testing.assert_array_equal(
+            hru_attributes['dominant_hru'], [1, 2, 3, 3])
+        np.testing.assert_array_equal(
+            hru_attributes['hru_index'], [0, 1, 2, 3])
+        np.testing.assert_array_equal(hru_attributes['subbasin'], [1, 1, 2, 2])
+        np.testing.assert_array_equal(
+            hru_attributes['landuse_code'], [83, 41, 0, 83])
+        np.testing.assert_array_equal(
+            hru_attributes['soil_code'], [2, 1, 2, 0])
+        np.testing.assert_array_equal(
+            hru_attributes['slope_code'], [0, 1, 0, 0])
@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from common import txtinout
+
+
+class TestTxtInOutIndex(unittest.TestCase):
+    def test_txtinout_index_reads_headers_and_is_reused(self):
+        """
+        Test that the hru file headers are indexed in file name order,
+        that output.hru is left out and that the saved index is only
+        reused until the directory changes.
+        """
+        txt_in_out_dir = os.path.join(tempfile.mkdtemp(), 'TxtInOut')
+        self.addCleanup(shutil.rmtree, os.path.dirname(txt_in_out_dir))
+        os.makedirs(txt_in_out_dir)
+        header = (' .hru file Watershed HRU:{0} Subbasin:{1} HRU:1 Luse:{2} '
+                  'Soil: {3} Slope 0-9999 1/31/2009 12:00:00 AM ArcSWAT\r\n'
+                  '       0.0023468    | HRU_FR\r\n')
+        for filename, values in (('000020001.hru', (3, 2, 'FRSD', 'HENRY')),
+                                 ('000010001.hru', (1, 1, 'URLD', 'TWO W')),
+                                 ('output.hru', (0, 0, '', ''))):
+            with open(os.path.join(txt_in_out_dir, filename), 'w') as f:
+                f.write(header.format(*values))
+
+        txt_in_out_index = txtinout.TxtInOutIndex.load(txt_in_out_dir)
+
+        np.testing.assert_array_equal(txt_in_out_index.hru_ids, [1, 3])
+        np.testing.assert_array_equal(txt_in_out_index.subbasin_ids, [1, 2])
+        np.testing.assert_array_equal(
+            txt_in_out_index.landuse_abbrevs, ['URLD', 'FRSD'])
+        np.testing.assert_array_equal(
+            txt_in_out_index.soil_codes, ['TWO W', 'HENRY'])
+        np.testing.assert_array_equal(
+            txt_in_out_index.slope_ranges, ['0-9999', '0-9999'])
+        self.assertTrue(os.path.exists(
+            txtinout.TxtInOutIndex.get_cache_filepath(txt_in_out_dir)))
+
+        os.remove(os.path.join(txt_in_out_dir, '000020001.hru'))
+        directory_mtime = os.stat(txt_in_out_dir).st_mtime_ns + 10 ** 9
+        os.utime(txt_in_out_dir, ns=(directory_mtime, directory_mtime))
+
+        txt_in_out_index = txtinout.TxtInOutIndex.load(txt_in_out_dir)
+
+        np.testing.assert_array_equal(txt_in_out_index.hru_ids, [1])
+        np.testing.assert_array_equal(
+            txt_in_out_index.soil_codes, ['TWO W'])
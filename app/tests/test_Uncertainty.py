@@ -0,0 +1,94 @@
+import importlib.util
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from uncertainty.process import UncertaintyProcess
+
+
+class TestUncertaintyProcess(unittest.TestCase):
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workspace)
+        os.makedirs(os.path.join(self.workspace, 'Output'))
+
+        self.process = UncertaintyProcess(logging.getLogger(__name__))
+        self.process.results_dir = self.workspace
+
+        self.fractional_areas = np.array([
+            [0.25, 0.1234565, 1 / 3.],
+            [0.5, 0.0000004, 0.9999996],
+        ])
+        self.realizations = pd.DataFrame({
+            'landuse_code': [82, 82],
+            'realization': [1, 2],
+            'error': [-5, 5],
+        })
+
+    def test_write_realization_file(self):
+        """
+        Test that a realization is written with a header and one
+        'HRU_ID, HRU_AREA' row per hru (6 decimals) and that writing it
+        again replaces the file.
+        """
+        filepath = os.path.join(self.workspace, 'Output', 'file82_1_-5_perc.dat')
+        fractional_areas = self.fractional_areas[0]
+
+        # the rows as they were written one value at a time
+        expected = 'HRU_ID, HRU_AREA'
+        for hru_idx in range(0, len(fractional_areas)):
+            expected += '\n' + str(hru_idx + 1) + ', ' + '{0:.6f}'.format(
+                round(fractional_areas[hru_idx], 6))
+        expected += '\n'
+
+        self.process.write_realization_file(filepath, fractional_areas)
+        self.process.write_realization_file(filepath, fractional_areas)
+
+        with open(filepath) as realization_file:
+            self.assertEqual(realization_file.read(), expected)
+
+    def test_write_npz_realization_archive(self):
+        """
+        Test that the .npz archive holds each realization's attributes
+        and its fractional areas by hru.
+        """
+        self.process.realization_archive_format = 'npz'
+
+        self.process.write_realization_archive(
+            self.realizations, self.fractional_areas)
+
+        with np.load(os.path.join(
+                self.workspace, 'Output', 'realizations.npz')) as archive:
+            np.testing.assert_array_equal(archive['landuse_code'], [82, 82])
+            np.testing.assert_array_equal(archive['realization'], [1, 2])
+            np.testing.assert_array_equal(archive['error'], [-5, 5])
+            np.testing.assert_array_equal(archive['hru_ids'], [1, 2, 3])
+            np.testing.assert_array_equal(
+                archive['fractional_areas'], self.fractional_areas)
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'),
+                         'pyarrow is not installed')
+    def test_write_parquet_realization_archive(self):
+        """
+        Test that the .parquet archive holds one row per realization and
+        hru.
+        """
+        self.process.realization_archive_format = 'parquet'
+
+        self.process.write_realization_archive(
+            self.realizations, self.fractional_areas)
+
+        archive = pd.read_parquet(os.path.join(
+            self.workspace, 'Output', 'realizations.parquet'))
+        self.assertEqual(
+            list(archive.columns),
+            ['landuse_code', 'realization', 'error', 'hru_id', 'hru_area'])
+        np.testing.assert_array_equal(archive['realization'], [1, 1, 1, 2, 2, 2])
+        np.testing.assert_array_equal(archive['hru_id'], [1, 2, 3, 1, 2, 3])
+        np.testing.assert_array_equal(
+            archive['hru_area'], self.fractional_areas.ravel())
@@ -1,172 +1,310 @@
-from tkFileDialog import askdirectory, askopenfilename
-from tkMessageBox import showwarning
-from subprocess import check_call
-import glob
-import os
-import shutil
-import Tkinter
-
-
-def get_realization_filepaths(cwd):
-    """
-    Check current working directory for realization .dat files using glob. Exclude
-    the lup.dat file from the results.
-
-    Parameters
-    ----------
-    cwd: string
-        Current working directory
-
-    Returns
-    -------
-    realization_files: list
-        List of the filepaths to the realization files
-    """
-
-    # get realization files filepaths (*.dat - be sure to exclude lup.dat)
-    realization_files = []
-    for dat_file in glob.glob(os.path.join(cwd, '*.dat')):
-        if os.path.basename(dat_file) != 'lup.dat':
-            realization_files.append(dat_file)
-
-    return realization_files
-
-
-def run_swatexe_with_realizations(cwd, realization_files, swatexe_filepath):
-    """
-    Loop through each realization file, rename it to file1.dat, and
-    run the swatexe. After it finishes rename the realization from
-    file1.dat to something more meaningful and copy it along with
-    the output results to a new directory.
-
-    Parameters
-    ----------
-    cwd: string
-        Directory path to the current working directory
-
-    realization_files: list of strings
-        List of filepaths to the realization files
-
-    swatexe_filepath: string
-        Filepath to the swat exe
-
-    Returns
-    -------
-    None
-    """
-
-    # get the swat exe directory
-    swatexe_dir = os.path.dirname(swatexe_filepath)
-
-    # loop through each realization file
-    for realization in realization_files:
-
-        # rename to file1.dat and copy to swatexe directory
-        shutil.copy(realization, os.path.join(swatexe_dir, 'file1.dat'))
-
-        # temporarily change working directory to swat exe directory
-        os.chdir(swatexe_dir)
-
-        # run the swatexe
-        call_status = check_call([os.path.basename(swatexe_filepath)])
-
-        # switch back to original working directory
-        os.chdir(cwd)
-
-        # if call successful
-        if call_status is 0:
-
-            # create new directory for file1.dat and output files
-            output_directory = os.path.join(cwd, os.path.splitext(realization)[0])
-
-            # check if it already exists, if so remove it
-            if os.path.exists(output_directory):
-                shutil.rmtree(output_directory)
-
-            # create the new directory
-            os.makedirs(output_directory)
-
-            # copy realization .dat file to the new directory
-            shutil.copy(realization, output_directory)
-
-            # copy output files to new directory
-            shutil.copy(os.path.join(swatexe_dir, 'output.std'), output_directory)
-            shutil.copy(os.path.join(swatexe_dir, 'output.rch'), output_directory)
-            shutil.copy(os.path.join(swatexe_dir, 'output.sub'), output_directory)
-            shutil.copy(os.path.join(swatexe_dir, 'output.hru'), output_directory)
-
-
-def main():
-    """
-    Directs workflow for copying realization files to the directory
-    containing the SWAT executable, processing the realization files
-    (sequentially) and putting the output results in a new directory.
-
-    Returns
-    -------
-    None
-    """
-
-    # for later drawing dialog that asks for the SWAT exe directory
-    root = Tkinter.Tk()
-    root.withdraw()
-
-    # go back one directory and set it as the current working
-    # directory (should be output's root directory)
-    os.chdir('..')
-    cwd = os.getcwd()
-
-    # get realization files
-    realization_files = get_realization_filepaths(cwd)
-
-    # check if realization files were found
-    if not realization_files:
-
-        # warn user about missing files
-        showwarning(
-            'Can\'t find',
-            'Unable to locate realization files. Please select the directory containing ' +
-            'your LUU Uncertainty output. The output directory should have the realization ' +
-            '.dat files inside it.'
-        )
-
-        # ask user to select folder containing their LUU Uncertainty output (realization .dat files)
-        dialog_title = 'Please select the folder containing your realization .dat files'
-        cwd = askdirectory(
-            initialdir=cwd,
-            parent=root,
-            title=dialog_title,
-            mustexist=True,
-        )
-
-        # get realization files from selected folder
-        realization_files = get_realization_filepaths(cwd)
-
-        # check if we were able to find the files
-        if not realization_files:
-            # warn user that we still cannot locate the files and terminate program
-            showwarning(
-                'Can\'t find',
-                'Still unable to locate realization files. Please make sure you have ' +
-                'downloaded and extracted your LUU Uncertainty results. This program ' +
-                'will now close.'
-            )
-            return
-
-    # ask user for path to Swat2009.exe in their Scenarios/Default/TxtInOut folder
-    dialog_title = 'Choose the SWAT executable from your Scenarios/Default/TxtInOut folder'
-    swatexe_filepath = askopenfilename(
-        filetypes=[('SWAT executable file', '*.exe')],
-        initialdir=cwd,
-        parent=root,
-        title=dialog_title)
-
-    # copy lup.dat to the swat exe directory
-    shutil.copy(os.path.join(cwd, 'lup.dat'), os.path.dirname(swatexe_filepath))
-
-    # copy each realization to the swatexe_dir and run the swatexe
-    run_swatexe_with_realizations(cwd, realization_files, swatexe_filepath)
-
-
-if __name__ == '__main__':
-    main()
+"""
+Runs a SWAT model once for each LUU Uncertainty realization and collects
+the outputs of every run in a folder named after the realization.
+
+Each worker runs SWAT in its own copy of the model's TxtInOut folder (a
+sandbox). The unchanged model inputs are hard-linked into the sandboxes
+when possible, so a sandbox costs little space, and the files SWAT
+writes are never shared with the original TxtInOut. Realizations are
+run concurrently in a process pool. A realization's folder only appears
+once its run succeeded, so an interrupted run can be started again and
+only the missing realizations are run.
+
+Usage (from the dist folder of the LUU Uncertainty output):
+    python3 process_realizations.py --txtinout TXTINOUT --swat-exe SWAT_EXE
+        [--workers N] [--realizations OUTPUT_DIR] [--rerun] [--copy]
+"""
+import argparse
+import fnmatch
+import glob
+import os
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+# SWAT output files collected for each realization
+OUTPUT_FILENAMES = ['output.std', 'output.rch', 'output.sub', 'output.hru']
+
+# files in TxtInOut that SWAT writes (or that are replaced for each
+# realization) - these are never linked into the sandboxes
+SANDBOX_EXCLUDED_PATTERNS = [
+    'output*', '*.out', '*.std', 'fin.fin', 'chan.deg', 'watout.dat',
+    'file1.dat', 'lup.dat']
+
+# sandbox of the current worker process (see start_worker)
+worker_sandbox_dir = None
+
+
+def get_realization_filepaths(cwd):
+    """
+    Check current working directory for realization .dat files using
+    glob. Exclude the lup.dat file from the results.
+
+    Parameters
+    ----------
+    cwd: string
+        Current working directory
+
+    Returns
+    -------
+    realization_files: list
+        List of the filepaths to the realization files
+    """
+
+    # get realization files filepaths (*.dat - be sure to exclude lup.dat)
+    realization_files = []
+    for dat_file in glob.glob(os.path.join(cwd, '*.dat')):
+        if os.path.basename(dat_file) != 'lup.dat':
+            realization_files.append(dat_file)
+
+    return sorted(realization_files)
+
+
+def get_output_directory(realization_file):
+    """
+    Folder holding a realization's file1.dat and SWAT outputs (the
+    realization filepath without its extension).
+    """
+    return os.path.splitext(realization_file)[0]
+
+
+def is_excluded_from_sandbox(filename):
+    """ True for files SWAT writes, see SANDBOX_EXCLUDED_PATTERNS. """
+    return any(fnmatch.fnmatch(filename.lower(), pattern)
+               for pattern in SANDBOX_EXCLUDED_PATTERNS)
+
+
+def create_sandbox(txtinout_dir, sandbox_dir, copy_files=False):
+    """
+    Creates a private copy of TxtInOut for one worker. The model inputs
+    are hard-linked (or copied when linking is not possible or
+    copy_files is True) and the files SWAT writes are left out.
+
+    Parameters
+    ----------
+    txtinout_dir: string
+        Path to the model's TxtInOut folder
+    sandbox_dir: string
+        Path to the sandbox folder (created, replaced if it exists)
+    copy_files: boolean
+        Copy the inputs instead of hard-linking them
+    """
+    if os.path.exists(sandbox_dir):
+        shutil.rmtree(sandbox_dir)
+    os.makedirs(sandbox_dir)
+
+    for filename in os.listdir(txtinout_dir):
+        filepath = os.path.join(txtinout_dir, filename)
+        if not os.path.isfile(filepath) or is_excluded_from_sandbox(filename):
+            continue
+
+        sandbox_filepath = os.path.join(sandbox_dir, filename)
+        if not copy_files:
+            try:
+                os.link(filepath, sandbox_filepath)
+                continue
+            except OSError:
+                # e.g. the sandbox is on another file system
+                pass
+        shutil.copy2(filepath, sandbox_filepath)
+
+
+def start_worker(txtinout_dir, sandboxes_dir, copy_files):
+    """
+    Initializes a worker process with its own sandbox, named after the
+    worker's process id.
+    """
+    global worker_sandbox_dir
+
+    worker_sandbox_dir = os.path.join(
+        sandboxes_dir, 'worker_' + str(os.getpid()))
+    create_sandbox(txtinout_dir, worker_sandbox_dir, copy_files)
+
+
+def run_realization(realization_file, lupdat_filepath, swatexe_filepath,
+                    sandbox_dir=None):
+    """
+    Runs SWAT with a realization (as file1.dat) in a sandbox and moves
+    the realization and its outputs to the realization's folder. The
+    outputs are gathered in a temporary folder that is renamed at the
+    end, so the folder only exists for successful runs.
+
+    Parameters
+    ----------
+    realization_file: string
+        Filepath to the realization .dat file
+    lupdat_filepath: string
+        Filepath to lup.dat
+    swatexe_filepath: string
+        Filepath to the SWAT executable
+    sandbox_dir: string
+        Sandbox to run SWAT in, the worker's sandbox by default
+
+    Returns
+    -------
+    realization_file, error: tuple
+        The realization and None when SWAT succeeded, otherwise a
+        description of the failure
+    """
+    sandbox_dir = sandbox_dir or worker_sandbox_dir
+
+    # remove the previous run's outputs and replace the realization
+    for filename in os.listdir(sandbox_dir):
+        if is_excluded_from_sandbox(filename):
+            os.remove(os.path.join(sandbox_dir, filename))
+    shutil.copy(realization_file, os.path.join(sandbox_dir, 'file1.dat'))
+    shutil.copy(lupdat_filepath, os.path.join(sandbox_dir, 'lup.dat'))
+
+    # run the swatexe, keeping what it prints next to its outputs
+    with open(os.path.join(sandbox_dir, 'swat_run.log'), 'w') as log_file:
+        returncode = subprocess.call(
+            [os.path.abspath(swatexe_filepath)],
+            cwd=sandbox_dir, stdout=log_file, stderr=subprocess.STDOUT)
+    if returncode != 0:
+        return realization_file, 'SWAT exited with status {0}, see {1}'.format(
+            returncode, os.path.join(sandbox_dir, 'swat_run.log'))
+
+    missing = [filename for filename in OUTPUT_FILENAMES
+               if not os.path.exists(os.path.join(sandbox_dir, filename))]
+    if missing:
+        return realization_file, 'SWAT did not write ' + ', '.join(missing)
+
+    # create new directory for the realization and output files
+    output_directory = get_output_directory(realization_file)
+    temporary_directory = output_directory + '.tmp'
+    if os.path.exists(temporary_directory):
+        shutil.rmtree(temporary_directory)
+    os.makedirs(temporary_directory)
+
+    shutil.copy(realization_file, temporary_directory)
+    for filename in OUTPUT_FILENAMES + ['swat_run.log']:
+        shutil.move(os.path.join(sandbox_dir, filename),
+                    os.path.join(temporary_directory, filename))
+
+    if os.path.exists(output_directory):
+        shutil.rmtree(output_directory)
+    os.rename(temporary_directory, output_directory)
+
+    return realization_file, None
+
+
+def run_swatexe_with_realizations(cwd, realization_files, swatexe_filepath,
+                                  txtinout_dir, workers=1, resume=True,
+                                  copy_files=False):
+    """
+    Runs SWAT for every realization in a pool of worker processes, each
+    with its own sandbox of TxtInOut.
+
+    Parameters
+    ----------
+    cwd: string
+        Folder holding the realization files and lup.dat
+    realization_files: list of strings
+        List of filepaths to the realization files
+    swatexe_filepath: string
+        Filepath to the swat exe
+    txtinout_dir: string
+        Path to the model's TxtInOut folder
+    workers: int
+        Number of realizations run at the same time
+    resume: boolean
+        Skip realizations that already have an output folder
+    copy_files: boolean
+        Copy the inputs into the sandboxes instead of hard-linking them
+
+    Returns
+    -------
+    failures: dict
+        Description of the failure by realization file
+    """
+    if resume:
+        realization_files = [
+            realization_file for realization_file in realization_files
+            if not os.path.isdir(get_output_directory(realization_file))]
+    if not realization_files:
+        return {}
+
+    lupdat_filepath = os.path.join(cwd, 'lup.dat')
+    sandboxes_dir = os.path.join(cwd, 'sandboxes')
+
+    failures = {}
+    try:
+        with ProcessPoolExecutor(
+                max_workers=max(1, min(workers, len(realization_files))),
+                initializer=start_worker,
+                initargs=(txtinout_dir, sandboxes_dir, copy_files)) as pool:
+            runs = [
+                pool.submit(run_realization, realization_file,
+                            lupdat_filepath, swatexe_filepath)
+                for realization_file in realization_files]
+
+            for done, run in enumerate(as_completed(runs), 1):
+                realization_file, error = run.result()
+                status = 'failed: ' + error if error else 'done'
+                print('[{0}/{1}] {2} {3}'.format(
+                    done, len(runs), os.path.basename(realization_file),
+                    status))
+                if error:
+                    failures[realization_file] = error
+    finally:
+        shutil.rmtree(sandboxes_dir, ignore_errors=True)
+
+    return failures
+
+
+def main(argv=None):
+    """
+    Runs every realization in the LUU Uncertainty output folder (the
+    folder above this script by default) and reports the failures.
+
+    Returns
+    -------
+    status: int
+        0 when every realization ran, 1 otherwise
+    """
+    parser = argparse.ArgumentParser(
+        description='Run a SWAT model with each LUU Uncertainty realization.')
+    parser.add_argument(
+        '--txtinout', required=True,
+        help='Scenarios/Default/TxtInOut folder of the SWAT project uploaded '
+             'to LUU Uncertainty')
+    parser.add_argument(
+        '--swat-exe', required=True, help='SWAT executable')
+    parser.add_argument(
+        '--realizations', default=os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), os.pardir),
+        help='folder with the realization .dat files and lup.dat')
+    parser.add_argument(
+        '--workers', type=int, default=os.cpu_count() or 1,
+        help='number of realizations run at the same time')
+    parser.add_argument(
+        '--rerun', action='store_true',
+        help='run realizations that already have an output folder again')
+    parser.add_argument(
+        '--copy', action='store_true',
+        help='copy TxtInOut into the worker sandboxes instead of linking it')
+    args = parser.parse_args(argv)
+
+    cwd = os.path.abspath(args.realizations)
+    realization_files = get_realization_filepaths(cwd)
+    if not realization_files:
+        print('Unable to locate realization files in ' + cwd + '. Please '
+              'select the folder containing your LUU Uncertainty output '
+              'with --realizations.', file=sys.stderr)
+        return 1
+
+    failures = run_swatexe_with_realizations(
+        cwd, realization_files, args.swat_exe, os.path.abspath(args.txtinout),
+        workers=args.workers, resume=not args.rerun, copy_files=args.copy)
+
+    for realization_file, error in sorted(failures.items()):
+        print(os.path.basename(realization_file) + ': ' + error,
+              file=sys.stderr)
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,10 @@
 import csv
 import numpy as np
 import os
+import pandas as pd
 import shutil
 
+from django.conf import settings
 from django.core.mail import send_mail
 from django.utils import timezone
 
@@ -12,6 +14,11 @@ from swatluu import swattools
 from swatusers.models import UserTask
 
 
+# formats of the optional file packing every realization ('' for none),
+# see write_realization_archive
+REALIZATION_ARCHIVE_FORMATS = ('', 'npz', 'parquet')
+
+
 class UncertaintyProcess(object):
     def __init__(self, logger, data=''):
 
@@ -32,6 +39,7 @@ class UncertaintyProcess(object):
             self.task_id = ''
             self.user_email = ''
             self.user_first_name = ''
+            self.realization_archive_format = ''
         else:
             self.results_dir = data['results_dir']
             self.process_root_dir = data['process_root_dir']
@@ -49,15 +57,25 @@ class UncertaintyProcess(object):
             self.task_id = data['task_id']
             self.user_email = data['user_email']
             self.user_first_name = data['user_first_name']
+            # optional file packing every realization ('npz' or
+            # 'parquet'), next to the .dat file for each realization
+            self.realization_archive_format = data.get(
+                'realization_archive_format', '')
 
         self.dominant_hrus = ''
-        self.hru_indexes = ''
+        self.hru_index = ''
         self.old_hru_areas = ''
         self.unique_subbasin_ids = ''
         self.tool_name = 'LUU Uncertainty'
 
         self.logger = logger
 
+        # intermediate rasters (converted hrus1 and landuse layers)
+        self.raster_workspace = geotools.RasterWorkspace(
+            os.path.join(self.process_root_dir, 'RasterWorkspace'))
+        self.hrus1_tif_filepath = ''
+        self.landuse_tif_filepaths = {}
+
     def start(self):
         """
         """
@@ -82,9 +100,11 @@ class UncertaintyProcess(object):
 
         # convert hrus1 grid to tif
         try:
+            self.hrus1_tif_filepath = \
+                self.raster_workspace.create_filepath_like(
+                    'hrus1.tif', self.results_dir + '/Raster/hrus1')
             geotools.convert_adf_to_tif(
-                self.results_dir + '/Raster/hrus1',
-                self.results_dir + '/Raster/hrus1/hrus1.tif')
+                self.results_dir + '/Raster/hrus1', self.hrus1_tif_filepath)
         except Exception as e:
             self.logger.error(str(e))
             self.logger.error('Unable to convert raster from .adf to .tif.')
@@ -234,9 +254,12 @@ class UncertaintyProcess(object):
 
             # convert landuse files to tiff files
             layer_path = self.landuse_dir + '/' + layer_name
-            converted_layer_path = self.results_dir + '/Raster/' + layer_name + '.tif'
             try:
+                converted_layer_path = \
+                    self.raster_workspace.create_filepath_like(
+                        layer_name + '.tif', layer_path)
                 geotools.convert_adf_to_tif(layer_path, converted_layer_path)
+                self.landuse_tif_filepaths[layer_name] = converted_layer_path
             except Exception as e:
                 self.logger.error(str(e))
                 self.logger.error(
@@ -325,8 +348,7 @@ class UncertaintyProcess(object):
         """
         self.logger.info('Reading hrus1.tif into numpy array.')
         try:
-            hrus, hru_info = geotools.read_raster(
-                os.path.join(self.results_dir, 'Raster', 'hrus1', 'hrus1.tif'))
+            hrus, hru_info = geotools.read_raster(self.hrus1_tif_filepath)
         except Exception as e:
             self.logger.error(str(e))
             self.logger.error('Unable to read hrus1.tif.')
@@ -367,8 +389,14 @@ class UncertaintyProcess(object):
         # for example, dominant hru 5838 (OBJECTID) may become hru 10 (HRU_ID)
         new_hrus = sorted_hru[:, hru1_field_positions['hru_id']]
 
-        # merge non-dominant hrus into nearby dominant hrus
-        hrus = swattools.merge(hrus, dominant_hrus, hru_info[1])
+        # merge non-dominant hrus into nearby dominant hrus, reusing the
+        # merge cached by an earlier task on the same model
+        hrus, hru_index = swattools.merge_with_cache(
+            swattools.MergeCache(
+                settings.MERGE_CACHE_DIR, settings.MERGE_CACHE_MAX_BYTES),
+            hrus, dominant_hrus, new_hrus, hru_info[1],
+            os.path.join(self.swat_dir, 'Watershed', 'Shapes', 'hru1.dbf'),
+            self.logger)
 
         self.logger.info('Creating final_HRU.tif from merged hrus array.')
         try:
@@ -384,6 +412,7 @@ class UncertaintyProcess(object):
         self.hrus = hrus
         self.dominant_hrus = dominant_hrus
         self.hru_info = hru_info
+        self.hru_index = hru_index
 
     def create_fractional_values(self):
         """
@@ -409,14 +438,9 @@ class UncertaintyProcess(object):
 
         Returns
         -------
-        inside_watershed_indexes: array
-            Array of the index positions for cells in the hrus1 raster that
-            are inside the watershed
-
-        hru_indexes: array or arrays
-            Each row in the array represents a hru and each hru has
-            an array of the index positions where it is located in the
-            hru1 raster
+        hru_index: HruPixelIndex
+            Index of the cells in the hrus1 raster that belong to each
+            dominant hru
 
         old_hru_areas: list
             Each element represents the fractional area for a hru
@@ -424,53 +448,20 @@ class UncertaintyProcess(object):
         self.logger.info(
             'Calculating fractional areas for each hru inside the watershed.')
         pixel_size = self.hru_info[0]
-        # isolate the pixels with hru values from the nodata pixels
-        inside_watershed_indexes = np.nonzero(self.hrus != self.hru_info[1])
-        inside_watershed_hrus = self.hrus[inside_watershed_indexes]
 
-        # create a text file called hru_area.txt using append mode
+        # cells inside the watershed indexed by the dominant hru they
+        # belong to (see merge_thresholds) - position k in the index is
+        # the hru at position k in the dominant hrus array
+        hru_index = self.hru_index
+
+        # create a text file called hru_area.txt
         hru_areas_file = open(self.results_dir + '/Output/hru_areas.txt', 'w')
         # write header for file
         hru_areas_file.write('HRU_ID, HRU_AREA')
 
-        # put dominant hrus in set type
-        dominant_hrus_set = set(self.dominant_hrus)
-
-        # dictionary where each key is a dominant hru and
-        # the value is a list containing the indexes where
-        # the dominant hru appears in the watershed -
-        # found in variable inside_watershed_hrus
-
-        # initialize dictionary
-        dominant_hrus_inside_watershed_indexes = {}
-        for hru in dominant_hrus_set:
-            dominant_hrus_inside_watershed_indexes[hru] = []
-
-        # loop through hrus inside the watershed and append indexes (values)
-        # for the dominant hrus (keys)
-        for hru_index, hru_val in enumerate(inside_watershed_hrus):
-            if hru_val in dominant_hrus_set:
-                dominant_hrus_inside_watershed_indexes[hru_val].append(
-                    hru_index)
-
-        old_hru_areas = np.zeros(len(self.dominant_hrus))
-
-        # loop through dominant hrus and calculate fractional area
-        hru_indexes = []
-        for dominant_hru_index, dominant_hru_value in enumerate(
-                self.dominant_hrus):
-            # i don't understand why the next two lines are necessary....
-            hru_index = np.array(
-                dominant_hrus_inside_watershed_indexes[dominant_hru_value])
-            hru_indexes.append(hru_index)
-
-            # number of instances of the hru
-            hru_count = len(
-                dominant_hrus_inside_watershed_indexes[dominant_hru_value])
-            # convert area from square meter to acres and multiply by count
-            hru_area = (pixel_size ** 2 * 10 ** -6) * hru_count
-            # store area in array
-            old_hru_areas[dominant_hru_index] = hru_area
+        # convert area from square meter to square kilometer and
+        # multiply by the number of instances of each hru
+        old_hru_areas = hru_index.areas(pixel_size)
 
         self.logger.info('Writing fractional areas to hru_areas.txt.')
         # write fractional areas to the open file
@@ -483,8 +474,7 @@ class UncertaintyProcess(object):
         # close the text file
         hru_areas_file.close()
 
-        self.inside_watershed_indexes = inside_watershed_indexes
-        self.hru_indexes = hru_indexes
+        self.hru_index = hru_index
         self.old_hru_areas = list(old_hru_areas)
 
     def extract_hru_files_data(self):
@@ -498,10 +488,11 @@ class UncertaintyProcess(object):
         to find the numerical code for each landuse abbreviation extracted 
         from the hru files. Unique soil, slope, and subbasin codes are found
         and placed into individual arrays. Ultimately these arrays are merged
-        into a single array that is the same size as the dominant hrus array.
-        Each row in the array represents a hru and each column an attribute
-        for the hru. There are six columns (hru id, hru index range (starts
-        at 0), subbasin id, landuse code, soil code, and slope range code)
+        into a single structured array that is the same size as the dominant
+        hrus array. Each row in the array represents a hru and each field an
+        attribute for the hru. There are six fields (dominant_hru, hru_index
+        (starts at 0), subbasin, landuse_code, soil_code, and slope_code),
+        see swattools.HRU_ATTRIBUTE_DTYPE
 
         Parameters
         ----------
@@ -517,8 +508,8 @@ class UncertaintyProcess(object):
         Returns
         -------
         hru_files_data: array
-            Each row represents a hru and each column a attribute associated
-            with the hru - see description for more information on the columns
+            Each row represents a hru and each field a attribute associated
+            with the hru - see description for more information on the fields
 
         unique_subbasin_ids: array
             Array of the watershed's unique subbasin ids
@@ -531,9 +522,6 @@ class UncertaintyProcess(object):
             # separate out the different attribute lists
             hru_ids_from_hru_files = hru_files_read[0]
             subbasin_ids_from_hru_files = hru_files_read[1]
-            landuse_abbrevs_from_hru_files = hru_files_read[2]
-            soil_codes_from_hru_files = hru_files_read[3]
-            slope_ranges_from_hru_files = hru_files_read[4]
         except Exception as e:
             self.logger.error(str(e))
             self.logger.info('Unable to read the hru files in TxtInOut.')
@@ -550,41 +538,14 @@ class UncertaintyProcess(object):
 
         self.logger.info(
             'Collecting subbasin ids, landuse codes, soil codes, slope ranges, and subbasin ids.')
-        # get each hru's landuse code
-        landuse_codes = np.zeros(len(landuse_abbrevs_from_hru_files), int)
-        for code_index in range(0, len(self.lookup_info) - 1):
-            landuse_codes[np.nonzero(np.array(landuse_abbrevs_from_hru_files) ==
-                                     self.lookup_info[code_index + 1][1])] = \
-                self.lookup_info[code_index + 1][0]
-
-        # get each hru's soil code
-        unique_soil_codes = list(set(soil_codes_from_hru_files))
-        soil_codes = np.zeros(len(soil_codes_from_hru_files), int)
-        for i in range(0, len(unique_soil_codes)):
-            soil_codes[np.nonzero(
-                np.array(soil_codes_from_hru_files) == unique_soil_codes[
-                    i])] = i
-
-        # get each hru's slope range
-        unique_slope_ranges = list(set(slope_ranges_from_hru_files))
-        slope_ranges = np.zeros(len(slope_ranges_from_hru_files), int)
-        for i in range(0, len(unique_slope_ranges)):
-            slope_ranges[np.nonzero(
-                np.array(slope_ranges_from_hru_files) == unique_slope_ranges[
-                    i])] = i
-
         # get unique subbasin ids
-        unique_subbasin_ids = list(set(subbasin_ids_from_hru_files))
+        unique_subbasin_ids = np.unique(subbasin_ids_from_hru_files).tolist()
 
         self.logger.info('Packing hru information into a single array.')
-        # put all this hru info into a single array
-        hru_files_data = np.transpose([
-            self.dominant_hrus,
-            range(0, len(hru_ids_from_hru_files)),
-            subbasin_ids_from_hru_files,
-            landuse_codes,
-            soil_codes,
-            slope_ranges])
+        # landuse abbreviations are looked up once per unique abbreviation
+        # and the soil and slope codes come from np.unique
+        hru_files_data = swattools.create_hru_attribute_table(
+            self.dominant_hrus, hru_files_read, self.lookup_info)
 
         self.hru_files_data = hru_files_data
         self.unique_subbasin_ids = unique_subbasin_ids
@@ -595,7 +556,7 @@ class UncertaintyProcess(object):
 
         landuse_array, layer_info = geotools.create_raster_array(
             self.results_dir + '/Raster/hrus1',
-            self.results_dir + '/Raster/' + landuse_lyr_name + '.tif')
+            self.landuse_tif_filepaths[landuse_lyr_name])
         # get the nodata value
         landuse_nodata = layer_info[1]
 
@@ -605,28 +566,17 @@ class UncertaintyProcess(object):
         # updated landuse numpy array with the nodata values removed
         landuse_array = landuse_array[landuse_indexes]
 
-        # initiate a variable to store hru fractional area
-        hru_subbasin_fractional_areas = np.zeros(len(list(self.old_hru_areas)))
-        new_fractional_hru_areas = np.zeros(len(list(self.old_hru_areas)))
-        hru_areas = np.array(list(self.old_hru_areas))
-
-        # each element represents a hru's subbasin
-        hru_subbasins = np.array(self.hru_files_data[:, -4])
-
-        # loop through each subbasin
-        for subbasin_id in self.unique_subbasin_ids:
-            # find indexes in hru subbasins array matching the current subbasin
-            hrus_in_sub_idx = np.nonzero(hru_subbasins == subbasin_id)
+        # group the hrus by subbasin once, the realizations of each
+        # landuse code are calculated for every hru at once
+        realization_engine = swattools.RealizationEngine(
+            self.hru_files_data['subbasin'],
+            self.hru_files_data['landuse_code'],
+            np.array(list(self.old_hru_areas))[
+                self.hru_files_data['hru_index']])
 
-            # get area for HRUs in the subbasin
-            hrus_in_sub_areas = hru_areas[hrus_in_sub_idx]
-
-            # get total area for HRUs in the subbasin
-            hrus_in_sub_total_area = sum(hru_areas[hrus_in_sub_idx])
-
-            # calculate fractional areas
-            fractional_area = hrus_in_sub_areas / hrus_in_sub_total_area
-            hru_subbasin_fractional_areas[hrus_in_sub_idx] = fractional_area
+        # realizations kept for the archive (see write_realization_archive)
+        archived_realizations = []
+        archived_areas = []
 
         # loop through each LULC code
         for i in range(0, len(self.lookup_info) - 1):
@@ -647,90 +597,104 @@ class UncertaintyProcess(object):
                     self.logger.error(str(e))
                     error_range = range(-error, error + 1, int(2 * error))
 
-                # loop through number of realization range
+                # new fractional areas for every realization (rows) and
+                # hru (columns)
+                realized_areas = np.zeros(
+                    (realization, len(self.old_hru_areas)))
+                realized_areas[:, self.hru_files_data['hru_index']] = \
+                    realization_engine.realize(
+                        int(self.lookup_info[i + 1][0]),
+                        [error_range[j] for j in range(0, realization)])
+
+                # write each realization to a suitable output file
                 for j in range(0, realization):
+                    self.write_realization_file(
+                        self.results_dir + '/Output/file' + str(
+                            self.lookup_info[i + 1][0]) + '_' + str(
+                            j + 1) + '_' + str(error_range[j]) + '_perc.dat',
+                        realized_areas[j, :len(self.dominant_hrus)])
+
+                if self.realization_archive_format:
+                    archived_realizations.append(pd.DataFrame({
+                        'landuse_code': int(self.lookup_info[i + 1][0]),
+                        'realization': np.arange(1, realization + 1),
+                        'error': [error_range[j]
+                                  for j in range(0, realization)],
+                    }))
+                    archived_areas.append(
+                        realized_areas[:, :len(self.dominant_hrus)])
+
+        if self.realization_archive_format and archived_areas:
+            self.write_realization_archive(
+                pd.concat(archived_realizations, ignore_index=True),
+                np.concatenate(archived_areas))
+
+    def write_realization_file(self, filepath, fractional_areas):
+        """
+        Writes a realization's fractional area for each hru (HRU_ID are
+        the new hru ids assigned in hru1.shp) with 6 decimals. The rows
+        are formatted at once and written in a single call, replacing
+        the file if it already exists.
 
-                    # loop through subbasins
-                    for k in range(0, len(self.unique_subbasin_ids)):
-                        # identify HRUs that are in subbasin k
-                        hrus_in_sub = self.hru_files_data[np.where(
-                            self.hru_files_data[:, 2] ==
-                            self.unique_subbasin_ids[k])]
-
-                        # identify HRUs that have landuse i AND are located in subbasin k
-                        hrus_in_sub_with_lulc = hrus_in_sub[np.where(
-                            hrus_in_sub[:, 3] == int(
-                                self.lookup_info[i + 1][0]))]
-
-                        # fetch fractional areas for HRUs in sub with the current lulc
-                        matching_hrus_fractional_areas = \
-                            hru_subbasin_fractional_areas[
-                                hrus_in_sub_with_lulc[:, 1]]
-
-                        # calculate cumulative fractional area
-                        matching_hrus_cumulative_fractional_area = sum(
-                            matching_hrus_fractional_areas)
-
-                        # calculate portion of cumulative area subject to error
-                        error_area = (error_range[
-                            j] / 100.0) * matching_hrus_cumulative_fractional_area
-
-                        # calculate each HRUs area percentage
-                        matching_hrus_percentage_area = matching_hrus_fractional_areas / \
-                            matching_hrus_cumulative_fractional_area
-
-                        # increase/decrease the area of affected HRUs based on error range
-                        new_fractional_hru_areas[hrus_in_sub_with_lulc[:,
-                                                                       1]] = matching_hrus_fractional_areas + (
-                            error_area * matching_hrus_percentage_area)
-
-                        # identify the unaffected HRUs (i.e. those in subbasin
-                        # k that do not have lulc i)
-                        hrus_in_sub_without_lulc = hrus_in_sub[np.where(
-                            hrus_in_sub[:, 3] != int(
-                                self.lookup_info[i + 1][0]))]
-
-                        # fetch fractional areas for HRUs in sub with the current lulc
-                        matching_hrus_without_lulc_fractional_areas = \
-                            hru_subbasin_fractional_areas[
-                                hrus_in_sub_without_lulc[:, 1]]
-
-                        # find how much area needs to be adjusted
-                        fractional_area_diff = sum(
-                            matching_hrus_fractional_areas) - sum(
-                            new_fractional_hru_areas[
-                                hrus_in_sub_with_lulc[:, 1]])
-
-                        # calculate each HRUs area percentage
-                        matching_hrus_without_lulc_percentage_area = matching_hrus_without_lulc_fractional_areas / sum(
-                            matching_hrus_without_lulc_fractional_areas)
-
-                        # now adjust the non-affected HRUs based on error range
-                        new_fractional_hru_areas[hrus_in_sub_without_lulc[:,
-                                                                          1]] = matching_hrus_without_lulc_fractional_areas + (
-                            fractional_area_diff * matching_hrus_without_lulc_percentage_area)
-
-                    # once realization is processed, write to a suitable output file
-                    hru_fa_file = open(self.results_dir + '/Output/file' + str(
-                        self.lookup_info[i + 1][0]) + '_' + str(
-                        j + 1) + '_' + str(error_range[j]) + '_perc.dat', 'a')
-
-                    # write header columns (HRU_ID are the new HRU ids assigned in hru1.shp
-                    hru_fa_file.write('HRU_ID, HRU_AREA')
-
-                    # loop through hrus and write fractional area to text file
-                    for hru_idx in range(0, len(self.dominant_hrus)):
-                        hru_fa_file.write('\n')
-                        hru_fa_file.write(str(hru_idx + 1))
-                        hru_fa_file.write(', ')
-                        hru_fa_file.write('{0:.6f}'.format(
-                            round(new_fractional_hru_areas[hru_idx], 6)))
-
-                    # add new line at end of file
-                    hru_fa_file.write('\n')
-
-                    # close the file
-                    hru_fa_file.close()
+        Parameters
+        ----------
+        filepath: string
+            Filepath to the realization .dat file
+        fractional_areas: array
+            Fractional area for each hru
+        """
+        rows = np.column_stack((
+            np.arange(1, len(fractional_areas) + 1),
+            fractional_areas)).ravel().tolist()
+
+        with open(filepath, 'w') as hru_fa_file:
+            hru_fa_file.write(
+                'HRU_ID, HRU_AREA\n' +
+                ('%d, %.6f\n' * len(fractional_areas)) % tuple(rows))
+
+    def write_realization_archive(self, realizations, fractional_areas):
+        """
+        Packs every realization into Output/realizations.npz or
+        Output/realizations.parquet (realization_archive_format) so they
+        can be loaded from a single file.
+
+        The .npz file holds the landuse_code, realization (number) and
+        error (%) of each realization, the hru_ids and the
+        fractional_areas with one row per realization. The .parquet
+        file holds one row per realization and hru with the columns
+        landuse_code, realization, error, hru_id and hru_area.
+
+        Parameters
+        ----------
+        realizations: DataFrame
+            landuse_code, realization and error for each realization
+        fractional_areas: array
+            Fractional areas with one row per realization and one
+            column per hru
+        """
+        archive_filepath = self.results_dir + '/Output/realizations.' + \
+            self.realization_archive_format
+        self.logger.info(
+            'Creating ' + os.path.basename(archive_filepath) + '.')
+        hru_ids = np.arange(1, fractional_areas.shape[1] + 1)
+
+        if self.realization_archive_format == 'npz':
+            np.savez_compressed(
+                archive_filepath,
+                landuse_code=realizations['landuse_code'].values.astype(int),
+                realization=realizations['realization'].values.astype(int),
+                error=realizations['error'].values.astype(int),
+                hru_ids=hru_ids,
+                fractional_areas=fractional_areas)
+        elif self.realization_archive_format == 'parquet':
+            realization_table = realizations.loc[
+                realizations.index.repeat(len(hru_ids))].reset_index(drop=True)
+            realization_table['hru_id'] = np.tile(hru_ids, len(realizations))
+            realization_table['hru_area'] = fractional_areas.ravel()
+            realization_table.to_parquet(archive_filepath, index=False)
+        else:
+            raise ValueError('Unrecognized realization archive format: ' +
+                             str(self.realization_archive_format))
 
     def copy_results_to_depot(self):
         """
@@ -749,6 +713,12 @@ class UncertaintyProcess(object):
             os.path.join(self.results_dir, "Output", "dist")
         )
 
+        # Copy the post processing script for running it with Python 3
+        shutil.copy(
+            os.path.join(self.post_processing_dir, "process_realizations.py"),
+            os.path.join(self.results_dir, "Output", "dist")
+        )
+
         # Copy post processing script README.txt
         shutil.copy(
             os.path.join(self.post_processing_dir, "README.txt"),
@@ -5,6 +5,7 @@ from django.shortcuts import render, resolve_url
 from django.template.response import TemplateResponse
 from django.utils import timezone
 
+from .process import REALIZATION_ARCHIVE_FORMATS
 from .tasks import process_task
 from common.utils import fix_file_permissions
 from common.SWATModelZip import SWATModelZip
@@ -536,6 +537,8 @@ def update_error_percentage(request):
         # Get posted error and realization percentages
         posted_errors = request.POST.getlist('errors')
         posted_realizations = request.POST.getlist('realizations')
+        realization_archive_format = request.POST.get(
+            'realization_archive_format', '')
 
         # Loop through error percentages and append to our list
         for error in posted_errors:
@@ -545,6 +548,17 @@ def update_error_percentage(request):
         for realization in posted_realizations:
             realized_errors.append(realization)
 
+        # Verify the archive format matches what we would expect
+        if realization_archive_format not in REALIZATION_ARCHIVE_FORMATS:
+            request.session['error'] = 'Realization archive format is not ' \
+                                       'recognized. Please select one of ' \
+                                       'the Realization archive options.'
+            context = {'uncertainty_lookup_loop_times': request.session.get(
+                'uncertainty_lookup_loop_times')}
+            return render(request, 'uncertainty/index.html', context)
+        request.session['uncertainty_realization_archive_format'] = \
+            realization_archive_format
+
         # Pack error and realizaiton percentages into session variable
         for i in range(0, len(original_errors)):
             request.session['uncertainty_error_data'].append(
@@ -587,6 +601,8 @@ def request_process(request):
         'landuse_day': request.session.get('uncertainty_day'),
         'landuse_layer_name': request.session.get('uncertainty_landuse_layer_filename'),
         'uncertainty_error_data': request.session.get('uncertainty_error_data'),
+        'realization_archive_format': request.session.get(
+            'uncertainty_realization_archive_format', ''),
     }
 
     # run task